@@ -1,14 +1,63 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from transformers import pipeline
-import torch
+# the backend libraries (transformers, torch, requests, openai, httpx, huggingface_hub) and pygments are imported
+# by the functions using them, so that importing this module only pays for the backend which is actually queried
 import json
-import requests
-import openai
-from huggingface_hub import InferenceClient
 from colorama import Fore
-from pygments.lexers import JavaLexer
 import os
+import sys
+import csv
+import glob
 import re
+import threading
+import asyncio
+import sqlite3
+import hashlib
+import time
+import random
+import queue
+import math
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+
+# tokenizers are shared by all the ModelQuerier objects of the process (keyed by model name)
+_TOKENIZERS = {}
+_TOKENIZERS_LOCK = threading.Lock()
+
+# in-flight limits, rate limiters and replica pools are shared by all the ModelQuerier objects of the process which query the same backend
+_INFLIGHT_LIMITS = {}
+_RATE_LIMITERS = {}
+_REPLICA_POOLS = {}
+_INFLIGHT_LIMITS_LOCK = threading.Lock()
+
+# results of the queries pending in this process, keyed by their cache key: identical queries sent at the same time are sent only
+# once (a query is forgotten as soon as it ends, the finished ones are served by the response cache)
+_COALESCED_QUERIES = {}
+_COALESCED_QUERIES_LOCK = threading.Lock()
+
+# HTTP status codes for which a failed request is retried (rate limited, endpoint overloaded or still loading the model)
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+# requests per second sent to the OpenAI API when no rate is given (the other backends are not limited by default)
+OPENAI_REQUESTS_PER_SECOND = 8
+
+def load_tokenizer(model_name, **kwargs):
+    """
+        Description of the Function:
+            loads the tokenizer of a given model only once per process and returns the cached object on later calls.
+
+        Parameters:
+            model_name (str): name of the model on the Hugging Face hub;
+            kwargs: additional arguments given to AutoTokenizer.from_pretrained.
+
+        Returns:
+            the tokenizer of the model.
+    """
+    with _TOKENIZERS_LOCK:
+        if model_name not in _TOKENIZERS:
+            from transformers import AutoTokenizer
+            _TOKENIZERS[model_name] = AutoTokenizer.from_pretrained(model_name, **kwargs)
+        return _TOKENIZERS[model_name]
 
 def extract_signature_codereval(instance, language):
     """
@@ -37,12 +86,1132 @@ def extract_signature_codereval(instance, language):
     else:
         return code.split('\n')[0].strip()
 
+# stop predicates: given the text streamed so far, they tell whether the judgment has already been emitted
+
+def summary_ratings_emitted(text):
+    # all three ratings of a summary are present
+    return parse_summary_judgment(text)[0] is not None
+
+# a rating is either at the start of the output or after the 'Rating' label, which may be followed by the scale in parentheses
+# (e.g., 'Rating (0 or 1): 1'): a digit elsewhere (e.g., in 'on a scale of 0-4') is not a rating
+RATING_PATTERN = r'(?:^|\brating\b(?:\s*\([^)]*\))?)[^\w(]*(\d)'
+
+def rating_emitted(text):
+    # a rating is present and followed by at least one other character
+    return re.search(RATING_PATTERN + r'(?=\D)', text, flags = re.IGNORECASE) is not None
+
+def verdict_emitted(text):
+    # a "yes" or "no" is present and followed by at least one other character
+    return re.search(r'\b(yes|no)\b(?=\W)', text, flags = re.IGNORECASE) is not None
+
+def evaluation_ended(text):
+    return 'End of Evaluation' in text
+
+# parsers of the judgments: they return the rating (None if the output is unparsable) and its probability (None if the rating was generated as text)
+
+def _split_scores(model_output):
+    # multi-step judgments start with the output of the last step; scored labels are followed by their probabilities (see format_scores)
+    verdict = model_output.split('\n\n*************\n\n')[0]
+    if '\n# Label Probabilities: ' not in verdict:
+        return verdict, {}
+    verdict, distribution = verdict.split('\n# Label Probabilities: ', 1)
+    return verdict, json.loads(distribution)
+
+def parse_code_judgment(model_output, judgment_type):
+    verdict, distribution = _split_scores(model_output)
+    if judgment_type in ['slowthinking', 'stepbystep']:
+        match = re.search(r'\b(yes|no)\b', verdict, flags = re.IGNORECASE)
+        rating = match.group(1).capitalize() if match else None
+    else:
+        match = re.search(RATING_PATTERN + r'\b', verdict, flags = re.IGNORECASE)
+        rating = match.group(1) if match and match.group(1) in ('01' if judgment_type == 'bool' else '12345') else None
+    return rating, distribution.get(rating)
+
+def parse_summary_judgment(model_output):
+    # the rating is the tuple (content adequacy, conciseness, fluency); the output may start with the rating of content adequacy, when the prompt ends with 'Content Adequacy:'
+    verdict, _ = _split_scores(model_output)
+    content_adequacy = re.search(r'(?:^\s*|content adequacy\W*)([1-5])\b', verdict, flags = re.IGNORECASE)
+    conciseness = re.search(r'conciseness\W*([1-5])\b', verdict, flags = re.IGNORECASE)
+    fluency = re.search(r'fluency[^0-9\n]*([1-5])\b', verdict, flags = re.IGNORECASE)
+    if not (content_adequacy and conciseness and fluency):
+        return None, None
+    return tuple(int(match.group(1)) for match in [content_adequacy, conciseness, fluency]), None
+
+_EventStoppingCriteria = None
+
+def event_stopping_criteria(event):
+    # stopping criteria ending the generation of an allocated model as soon as the event is set
+    # (the subclass of StoppingCriteria is defined at the first call, when transformers gets imported)
+    global _EventStoppingCriteria
+    if _EventStoppingCriteria is None:
+        import torch
+        from transformers import StoppingCriteria
+
+        class EventStoppingCriteria(StoppingCriteria):
+            def __init__(self, event):
+                self.event = event
+
+            def __call__(self, input_ids, scores, **kwargs):
+                return torch.full((input_ids.shape[0],), self.event.is_set(), dtype = torch.bool, device = input_ids.device)
+
+        _EventStoppingCriteria = EventStoppingCriteria
+    return _EventStoppingCriteria(event)
+
+def is_connection_error(exception):
+    # only the backend libraries already imported can have raised the exception
+    errors = [TimeoutError]
+    if 'requests' in sys.modules:
+        errors += [sys.modules['requests'].ConnectionError, sys.modules['requests'].Timeout]
+    if 'openai' in sys.modules:
+        errors.append(sys.modules['openai'].APIConnectionError)
+    return isinstance(exception, tuple(errors))
+
 def remove_comments_from_python_code(code):
     code = re.sub(r'""".*?"""', '', code, flags = re.DOTALL)
     code = re.sub(r'\'\'\'.*?\'\'\'', '', code, flags = re.DOTALL)
     code = '\n'.join([line for line in code.splitlines() if not line.strip().startswith('#')])
     return code
 
+class QueryFailedError(Exception):
+
+    def __init__(self, model_name, backend, error_class, message, status_code = None, attempts = 1):
+        """
+            Class Description:
+                raised when a query to a model fails and cannot be retried any further. It carries a structured record of the failure.
+
+            Attributes:
+                model_name (str): name of the queried model;
+                backend (str): backend queried (see ModelQuerier.backend_key);
+                error_class (str): name of the class of the last exception raised by the backend;
+                message (str): message of the last exception raised by the backend;
+                status_code (int): HTTP status code of the last response, if any;
+                attempts (int): number of attempts made before giving up.
+        """
+        super().__init__(f'{model_name}: {error_class} after {attempts} attempt(s): {message}')
+        self.model_name = model_name
+        self.backend = backend
+        self.error_class = error_class
+        self.message = message
+        self.status_code = status_code
+        self.attempts = attempts
+
+    def to_record(self):
+        return {
+            'model' : self.model_name,
+            'backend' : self.backend,
+            'error_class' : self.error_class,
+            'message' : self.message,
+            'status_code' : self.status_code,
+            'attempts' : self.attempts
+        }
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity = None, min_rate = .05):
+        """
+            Class Description:
+                thread-safe token bucket which limits the number of requests per second sent to a backend. The rate adapts to the backend:
+                it is halved every time the backend answers 429 (and no request is sent until the Retry-After delay is over), and it slowly
+                grows back to its initial value after each successful request. Without a rate, the requests are not limited, and they
+                are only paused until the Retry-After delay of a 429 is over.
+
+            Attributes:
+                max_rate (float): initial (and maximum) number of requests per second (None for no limit);
+                rate (float): current number of requests per second;
+                capacity (float): maximum number of requests which can be sent in a burst;
+                min_rate (float): minimum number of requests per second.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1., rate or 1.)
+        self.min_rate = min_rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+            Description of the Function:
+                blocks until a request can be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    if now >= self.blocked_until:
+                        return
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if now >= self.blocked_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def penalize(self, retry_after = None):
+        """
+            Description of the Function:
+                called when the backend answers 429: halves the rate and, if given, pauses the requests for retry_after seconds.
+        """
+        with self.lock:
+            if self.rate is not None:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def try_acquire(self):
+        """
+            Description of the Function:
+                returns True (consuming a token) if a request can be sent right away, and False otherwise.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate is None:
+                return now >= self.blocked_until
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def reward(self):
+        """
+            Description of the Function:
+                called after a successful request: additively increases the rate up to max_rate.
+        """
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class LatencyTracker:
+
+    def __init__(self, window = 200, min_samples = 20):
+        """
+            Class Description:
+                keeps the latencies of the last successful requests sent to a backend, to estimate their percentiles.
+
+            Attributes:
+                latencies (deque): latencies (in seconds) of the last window requests;
+                min_samples (int): number of latencies needed before a percentile is estimated.
+        """
+        self.latencies = deque(maxlen = window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, p):
+        """
+            Description of the Function:
+                returns the p-th percentile of the recent latencies, or None if fewer than min_samples latencies were recorded.
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+        raised when a request to a backend does not complete within the request deadline.
+    """
+
+
+class GenerationBatcher:
+
+    def __init__(self, generate_batch, batch_size, max_wait = .05):
+        """
+            Class Description:
+                collects the prompts submitted at the same time by several threads and generates them together, in batches of at
+                most batch_size prompts. Prompts are grouped by max_new_tokens, since a batch is generated with a single value.
+
+            Attributes:
+                generate_batch (callable): function taking a list of prompts and max_new_tokens and returning the list of outputs;
+                batch_size (int): maximum number of prompts generated together;
+                max_wait (float): seconds to wait for other prompts before generating an incomplete batch.
+        """
+        self.generate_batch = generate_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target = self._loop, daemon = True).start()
+
+    def submit(self, prompt, max_new_tokens = None):
+        """
+            Description of the Function:
+                queues a prompt and blocks until its output is generated.
+        """
+        request = {'prompt' : prompt, 'max_new_tokens' : max_new_tokens, 'done' : threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['output']
+
+    def _loop(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get(timeout = max(0., deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request['max_new_tokens'], []).append(request)
+
+            for max_new_tokens, requests in groups.items():
+                try:
+                    outputs = self.generate_batch([request['prompt'] for request in requests], max_new_tokens = max_new_tokens)
+                    for request, output in zip(requests, outputs):
+                        request['output'] = output
+                except Exception as e:
+                    for request in requests:
+                        request['error'] = e
+                for request in requests:
+                    request['done'].set()
+
+
+class ReplicaPool:
+
+    def __init__(self, urls, max_failures = 3, cooldown = 30):
+        """
+            Class Description:
+                pool of the inference endpoints (replicas) serving the same model. Each request is routed to the healthy replica with
+                the fewest requests in flight. A replica failing max_failures requests in a row (connection errors, timeouts or 5xx)
+                is ejected from the pool for cooldown seconds, after which it receives requests again.
+                The replicas of a model are listed in constants/IEPmodels.json: the value of the model is either the url of a single
+                endpoint or a list of urls, e.g. "deepseek-ai/deepseek-coder-33b-instruct" : ["<REPLICA-1-URL>", "<REPLICA-2-URL>"].
+
+            Attributes:
+                replicas (list of dict): for each replica, its url, the number of requests in flight, the number of consecutive failures
+                    and the time until which it is ejected;
+                max_failures (int): number of consecutive failures after which a replica is ejected;
+                cooldown (float): seconds for which an ejected replica receives no requests.
+        """
+        self.replicas = [{'url' : url, 'inflight' : 0, 'failures' : 0, 'ejected_until' : 0.} for url in urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude = ()):
+        """
+            Description of the Function:
+                returns the replica to which the next request is sent: the least loaded among the healthy ones (not in exclude, if possible).
+                If all the replicas are ejected, the one whose ejection ends first is returned.
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [replica for replica in self.replicas if replica['url'] not in exclude] or self.replicas
+            healthy = [replica for replica in candidates if replica['ejected_until'] <= now]
+            if healthy:
+                replica = min(healthy, key = lambda replica: replica['inflight'])
+            else:
+                replica = min(candidates, key = lambda replica: replica['ejected_until'])
+            replica['inflight'] += 1
+            return replica
+
+    def release(self, replica, success):
+        """
+            Description of the Function:
+                records the end of a request sent to the replica (passive health check).
+        """
+        with self.lock:
+            replica['inflight'] -= 1
+            if success:
+                replica['failures'] = 0
+                return
+            replica['failures'] += 1
+            if replica['failures'] >= self.max_failures:
+                print(Fore.RED + f'\nReplica {replica["url"]} ejected for {self.cooldown} seconds.\n' + Fore.BLACK)
+                replica['ejected_until'] = time.monotonic() + self.cooldown
+                replica['failures'] = 0
+
+    @contextmanager
+    def route(self, exclude = ()):
+        """
+            Description of the Function:
+                context manager yielding the url of the replica to query, and recording whether the request succeeded. Requests
+                rejected by the replica (4xx, e.g. 429) do not count as failures of the replica.
+        """
+        replica = self.acquire(exclude = exclude)
+        try:
+            yield replica['url']
+        except Exception as e:
+            status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+            self.release(replica, success = status_code is not None and status_code < 500)
+            raise
+        else:
+            self.release(replica, success = True)
+
+
+class CacheMissError(KeyError):
+    """
+        a query whose output is not in the response cache (in replay mode): the miss is raised as a QueryFailedError whose
+        error_class is the name of this class, so that it is recorded like any other failed query.
+    """
+
+
+class ResponseCache:
+
+    def __init__(self, path, max_size_mb = 1024, replay = False):
+        """
+            Class Description:
+                on-disk cache of the outputs of the models, stored in a SQLite database. Each output is addressed by the hash of
+                the model, the backend, the rendered prompt and the generation parameters. When the outputs stored exceed max_size_mb,
+                the least recently used ones are evicted.
+
+            Attributes:
+                path (str): path of the SQLite database;
+                max_size_mb (float): maximum size of the stored outputs (in MB);
+                replay (bool): if True the cache is opened read-only, and a query whose output is not stored raises QueryFailedError (error_class CacheMissError).
+        """
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if replay:
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri = True, check_same_thread = False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+            self.connection = sqlite3.connect(path, check_same_thread = False)
+            self.connection.execute('PRAGMA journal_mode = WAL') # several sharded runs may share the same cache
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, output TEXT, size INTEGER, last_access REAL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+            self.connection.commit()
+
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(**fields):
+        """
+            Description of the Function:
+                returns the content address (sha256) of a query, given the fields which identify it (e.g., model, prompt ...).
+        """
+        return hashlib.sha256(json.dumps(fields, sort_keys = True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+            Description of the Function:
+                returns the output stored for the given key, or None if the output is not stored.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT output FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if not self.replay:
+                self.connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+                self.connection.commit()
+            return row[0]
+
+    def put(self, key, model, output):
+        """
+            Description of the Function:
+                stores the output of a query and evicts the least recently used outputs if the cache is full.
+        """
+        if self.replay:
+            return
+
+        size = len(output.encode('utf-8'))
+        with self.lock:
+            previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, model, output, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, model, output, size, time.time())
+            )
+            self.size += size - (previous[0] if previous else 0)
+
+            if self.size > self.max_size:
+                # only the least recently used outputs needed to fit the new one are evicted (never the new one)
+                evicted = []
+                for evicted_key, evicted_size in self.connection.execute(
+                    'SELECT key, size FROM responses WHERE key != ? ORDER BY last_access', (key,)
+                ):
+                    if self.size <= self.max_size:
+                        break
+                    evicted.append((evicted_key,))
+                    self.size -= evicted_size
+                self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+# separator of the judges in the name of the results files: several judges judging side by side ('<judge>+<judge>.csv') and
+# the judges of a cascade ('<judge>__escalated_to__<judge>.csv')
+JUDGES_SEPARATOR = '+'
+ESCALATION_SEPARATOR = '__escalated_to__'
+
+def results_file_name(judges, escalated_to = ()):
+    """
+        Description of the Function:
+            returns the name (without extension) of the results file of a run of the judges.
+
+        Parameters:
+            judges (list of str): short names of the judges judging side by side;
+            escalated_to (list of str): short names of the judges to which the uncertain judgments are escalated.
+
+        Returns:
+            str: the name of the file.
+    """
+    return ESCALATION_SEPARATOR.join([JUDGES_SEPARATOR.join(judges)] + list(escalated_to))
+
+def rates_per_judge(requests_per_second, judges):
+    """
+        Description of the Function:
+            returns the requests per second of each judge of a run, given either no value (no limit except the default of the
+            OpenAI API), one value for all the judges or one value per judge.
+
+        Parameters:
+            requests_per_second (list of float): the values given by the user (None or empty if not given);
+            judges (list of str): the judges of the run (those judging side by side, then those to which the judgments are escalated).
+
+        Returns:
+            list of float: the requests per second of each judge (None for no limit).
+    """
+    if not requests_per_second:
+        return [None] * len(judges)
+    if len(requests_per_second) == 1:
+        return list(requests_per_second) * len(judges)
+    if len(requests_per_second) != len(judges):
+        raise ValueError(f'{len(requests_per_second)} request rates given for {len(judges)} judges: give either one value for all of them or one value per judge.')
+    return list(requests_per_second)
+
+def judged_item(task, language, judgment_type, **judged):
+    """
+        Description of the Function:
+            returns what identifies the judgment of an item whatever the wording of the prompts (see ModelQuerier.query_model).
+
+        Parameters:
+            task (str): either 'code_generation' or 'code_summarization';
+            language (str): either 'java' or 'python';
+            judgment_type (str): the judgment type given to the judge script (e.g., 'bool' or 'extended_instructions');
+            judged: the judged item, e.g. rationale, target_id and generator of a code generation candidate, or method and summary
+                of a code summary.
+
+        Returns:
+            dict: the item.
+    """
+    return {'task' : task, 'language' : language, 'judgment_type' : judgment_type, **judged}
+
+def judgment_step(item, step):
+    # identifies the given step (from 1) of the judgment of item, None if the item is not known
+    return None if item is None else {**item, 'step' : step}
+
+
+class Backend(ABC):
+    """
+        interface of the backends which answer the queries of a ModelQuerier: the live services (InferenceEndpointBackend,
+        HuggingFaceAPIBackend, OpenAIBackend and AllocatedModelBackend, chosen by ModelQuerier from the model), or a backend
+        given to ModelQuerier in their place (e.g., ReplayBackend). The backend receives every query of query_model and
+        score_labels, after the coalescing of the identical queries and the response cache.
+
+        Attributes:
+            key (str): identifies the backend (see ModelQuerier.backend_key); queriers with the same key share their in-flight limit
+                and their rate limiter.
+    """
+    key = None
+
+    @abstractmethod
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        """
+            Parameters:
+                prompt (str): model input;
+                max_new_tokens (int): maximum number of generated tokens (None for the default of the querier);
+                stop (callable): if given, the generation can stop as soon as the predicate is true on the text generated so far;
+                prefix_cache (dict): key/value cache shared by the steps of a multi-step judgment (see ModelQuerier.query_model);
+                item (dict): the judged item and the step of the judgment (see ModelQuerier.query_model), if known.
+
+            Returns:
+                str: output of the model (input excluded).
+
+            Raises:
+                QueryFailedError: if the backend cannot answer the query.
+        """
+
+    @abstractmethod
+    def score_labels(self, prompt, labels, item = None):
+        """
+            Returns:
+                dict: probability (not necessarily normalized) of each label following the prompt (see ModelQuerier.score_labels).
+        """
+
+    def cache_parameters(self, prompt, max_new_tokens):
+        """
+            Description of the Function:
+                returns what identifies a query to the backend in the response cache (see ModelQuerier.cache_key).
+
+            Returns:
+                str: name of the backend;
+                the prompt as rendered for the backend;
+                dict: the generation parameters.
+        """
+        return self.key, prompt, {'max_new_tokens' : max_new_tokens}
+
+
+class InferenceEndpointBackend(Backend):
+
+    def __init__(self, querier):
+        """
+            Class Description:
+                the inference endpoint of the model (or its replicas, see ReplicaPool), queried over the keep-alive session of the
+                querier, through its rate limiter and retries (see ModelQuerier.call_with_retries).
+
+            Attributes:
+                key (str): 'endpoint:<model_name>';
+                querier (ModelQuerier): the querier using the backend.
+        """
+        self.querier = querier
+        self.key = f'endpoint:{querier.model_name}'
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        querier = self.querier
+        if stop is not None:
+            model_output = querier.call_with_retries(
+                lambda: querier.stream_huggingface_inference_endpoint(prompt = prompt, stop = stop, max_new_tokens = max_new_tokens)
+            )
+        else:
+            model_output = querier.call_with_retries(
+                lambda: querier.query_huggingface_inference_endpoint(prompt = prompt, max_new_tokens = max_new_tokens)
+            )
+        return model_output.strip('\n\t ')
+
+    def score_labels(self, prompt, labels, item = None):
+        return self.querier.call_with_retries(lambda: self.querier._score_labels_inference_endpoint(prompt, labels))
+
+    def cache_parameters(self, prompt, max_new_tokens):
+        querier = self.querier
+        rendered_prompt = querier.apply_chat_template(prompt) if querier.prompt_with_template else prompt
+        return 'endpoint', rendered_prompt, querier.sampling_parameters(max_new_tokens)
+
+
+class HuggingFaceAPIBackend(Backend):
+
+    def __init__(self, querier):
+        """
+            Class Description:
+                the Hugging Face API, queried through the InferenceClient of the querier, through its rate limiter and retries.
+                The API does not return the probabilities of the tokens, so the labels cannot be scored.
+
+            Attributes:
+                key (str): 'api:<model_name>';
+                querier (ModelQuerier): the querier using the backend.
+        """
+        self.querier = querier
+        self.key = f'api:{querier.model_name}'
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        querier = self.querier
+        if stop is not None:
+            model_output = querier.call_with_retries(lambda: querier._stream_huggingface_api(prompt, stop, max_new_tokens))
+        else:
+            model_output = querier.call_with_retries(
+                lambda: querier.hf_client.text_generation(prompt = prompt, max_new_tokens = max_new_tokens or querier.max_new_tokens)
+            )
+        return model_output.strip('\n\t ')
+
+    def score_labels(self, prompt, labels, item = None):
+        # score_labels can also be called directly, when score is False
+        raise QueryFailedError(
+            model_name = self.querier.model_name,
+            backend = self.key,
+            error_class = NotImplementedError.__name__,
+            message = 'the Hugging Face API does not return the probabilities of the tokens.'
+        )
+
+    def cache_parameters(self, prompt, max_new_tokens):
+        return 'api', prompt, self.querier.sampling_parameters(max_new_tokens)
+
+
+class OpenAIBackend(Backend):
+
+    def __init__(self, querier):
+        """
+            Class Description:
+                the OpenAI API, queried through the OpenAI client of the querier, through its rate limiter and retries.
+
+            Attributes:
+                key (str): 'openai:<model_name>' (the OpenAI rate limits are given per model);
+                querier (ModelQuerier): the querier using the backend.
+        """
+        self.querier = querier
+        self.key = f'openai:{querier.model_name}'
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        return self.querier.query_chatgpt(prompt = prompt, max_new_tokens = max_new_tokens, stop = stop)
+
+    def score_labels(self, prompt, labels, item = None):
+        return self.querier.call_with_retries(lambda: self.querier._score_labels_chatgpt(prompt, labels))
+
+    def cache_parameters(self, prompt, max_new_tokens):
+        querier = self.querier
+        return 'openai', [f'You are an expert {querier.language.capitalize()} developer', prompt], {'temperature' : querier.temperature, 'seed' : 123}
+
+
+class AllocatedModelBackend(Backend):
+
+    def __init__(self, querier):
+        """
+            Class Description:
+                the model allocated on the local GPU by the querier. The prompts are batched with the ones of the other threads
+                (see GenerationBatcher), unless the key/value cache of the previous step is reused or the output is streamed.
+
+            Attributes:
+                key (str): 'allocated:<model_name>';
+                querier (ModelQuerier): the querier using the backend.
+        """
+        self.querier = querier
+        self.key = f'allocated:{querier.model_name}'
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        querier = self.querier
+        if prefix_cache is not None:
+            return querier.query_allocated_model_with_prefix_cache(prompt = prompt, prefix_cache = prefix_cache, max_new_tokens = max_new_tokens)
+        if stop is not None:
+            return querier.stream_allocated_model(prompt = prompt, stop = stop, max_new_tokens = max_new_tokens)
+        return querier.query_allocated_model(prompt = prompt, max_new_tokens = max_new_tokens)
+
+    def score_labels(self, prompt, labels, item = None):
+        return self.querier._score_labels_allocated_model(prompt, labels)
+
+    def cache_parameters(self, prompt, max_new_tokens):
+        return 'allocated', prompt, self.querier.sampling_parameters(max_new_tokens)
+
+
+# judgment types of the results recorded in data/ under other names: the folders of the code summarization results
+# (data/code_summarization/results/<language>/<folder>) and the techniques in the names of the code generation results
+# (data/code_generation/results/cg_judgement_<language>_<technique>.csv)
+RECORDED_JUDGMENTS = {
+    'zeroshot_instructions' : {'judgment_type' : 'extended_instructions'},
+    'automatedCoT' : {'judgment_type' : 'stepbystep'},
+    'zeroshot_norationale' : {'judgment_type' : 'bool', 'rationale' : 'no'}
+}
+
+class ReplayBackend(Backend):
+
+    def __init__(self, paths, model_name):
+        """
+            Class Description:
+                backend serving the outputs recorded in results CSVs in place of the judge. A query is looked up by the sha256 of its
+                prompt and, if the prompt was recorded with another wording (or not at all), by the judged item (see judged_item).
+                The files read are:
+                    - the results written by the judge scripts: the prompt/output pairs of the 'prompt'/'model_output' columns (code
+                      summarization) and of the '<prefix>_prompt'/'<prefix>_judgement' columns (code generation);
+                    - the code summarization results in data/code_summarization/results/<language>/<folder>, recorded with earlier
+                      prompts: they are matched by language, judgment type (the folder, see RECORDED_JUDGMENTS), method ('target'),
+                      summary ('summary_postprocessed') and step;
+                    - the code generation results in data/code_generation/results/cg_judgement_<language>_<technique>.csv, which
+                      have no prompt: the rating of the judge ('<judge>_rating') is served as its output, matched by language,
+                      judgment type and rationale (the technique), target_id and generator ('generated_by').
+                The prompts and the outputs of the multi-step judgments are split into their steps, so that each step can be replayed.
+                Only the files whose name contains the name of the model, or with a rating column of the model, are read; in files
+                holding several judges (named '<judge>+<judge>.csv'), only the columns of the model are read. In the results of a
+                cascade (named '<judge>__escalated_to__<judge>.csv', see results_file_name), only the rows whose judged_by column
+                is the model are read.
+
+            Attributes:
+                key (str): 'replay:<model_name>';
+                model_name (str): model whose outputs are replayed;
+                paths (list of str): the files read (glob patterns are expanded);
+                outputs (dict): sha256 of the prompt -> recorded output;
+                items (dict): sha256 of the judged item and step (see item_hash) -> recorded output.
+        """
+        self.model_name = model_name
+        self.key = f'replay:{model_name}'
+        short_name = model_name.split('/')[-1]
+        self.outputs = {}
+        self.items = {}
+        self.paths = []
+        csv.field_size_limit(sys.maxsize)
+        for path in sorted({path for pattern in paths for path in glob.glob(pattern, recursive = True)}):
+            with open(path, newline = '') as f:
+                reader = csv.DictReader(f)
+                if f'{short_name}_rating' in (reader.fieldnames or []):
+                    self._read_ratings(path, reader, f'{short_name}_rating')
+                elif short_name in os.path.basename(path):
+                    self._read_outputs(path, reader, short_name)
+                else:
+                    continue
+            self.paths.append(path)
+
+    def _read_outputs(self, path, reader, short_name):
+        several_judges = JUDGES_SEPARATOR in os.path.basename(path).split(ESCALATION_SEPARATOR)[0]
+        # (prompt, output, judged_by) columns; judged_by is None if the file is not the result of a cascade
+        pairs = [('prompt', 'model_output', 'judged_by')] if 'prompt' in reader.fieldnames and 'model_output' in reader.fieldnames else []
+        pairs += [
+            (column, column[:-len('_prompt')] + '_judgement', column[:-len('_prompt')] + '_judged_by') for column in reader.fieldnames
+            if column.endswith('_prompt') and column[:-len('_prompt')] + '_judgement' in reader.fieldnames
+        ]
+        pairs = [
+            (prompt_column, output_column, judged_by_column if judged_by_column in reader.fieldnames else None)
+            for prompt_column, output_column, judged_by_column in pairs
+            # the judgments of a cascade are selected by judged_by, whatever judge prefixes the columns
+            if not several_judges or prompt_column.startswith(f'{short_name}_') or judged_by_column in reader.fieldnames
+        ]
+        # the code summarization results are stored in <language>/<judgment type>/ (see judge_code_summarization.py)
+        language, folder = os.path.normpath(os.path.abspath(path)).split(os.sep)[-3:-1]
+        summaries = language in ['java', 'python'] and {'target', 'summary_postprocessed'} <= set(reader.fieldnames)
+        for row in reader:
+            for prompt_column, output_column, judged_by_column in pairs:
+                if judged_by_column is not None and row[judged_by_column] != self.model_name:
+                    continue
+                item = judged_item(
+                    'code_summarization', language, **RECORDED_JUDGMENTS.get(folder, {'judgment_type' : folder}),
+                    method = row['target'], summary = row['summary_postprocessed']
+                ) if summaries else None
+                self._index(row[prompt_column], row[output_column], item)
+
+    def _read_ratings(self, path, reader, rating_column):
+        technique = re.fullmatch(r'cg_judgement_(java|python)_(\w+)\.csv', os.path.basename(path))
+        if technique is None or technique.group(2) not in RECORDED_JUDGMENTS:
+            return
+        language, judgment = technique.group(1), RECORDED_JUDGMENTS[technique.group(2)]
+        for row in reader:
+            if not row[rating_column]:
+                continue
+            # the judge scripts call the human written candidates 'humanwritten'
+            generator = 'humanwritten' if row['generated_by'] == 'human_written' else row['generated_by']
+            item = judged_item('code_generation', language, **judgment, target_id = row['target_id'], generator = generator)
+            self.items.setdefault(self.item_hash(judgment_step(item, 1)), row[rating_column])
+
+    @staticmethod
+    def prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def item_hash(item):
+        return hashlib.sha256(json.dumps(item, sort_keys = True).encode('utf-8')).hexdigest()
+
+    def _index(self, prompt, model_output, item = None):
+        # skipped candidates (<PLACEHOLDER>) and failed queries (empty prompt) have no output
+        if not prompt or prompt == '<PLACEHOLDER>':
+            return
+        # multi-step judgments record the last step first: '<step 2>\n\n*************\n\n<step 1>'
+        prompts = prompt.split('\n\n*************\n\n')
+        model_outputs = model_output.split('\n\n*************\n\n')
+        if len(prompts) != len(model_outputs):
+            # the steps cannot be told apart
+            prompts, model_outputs, item = prompts[:1], [model_output], None
+        for step, (step_prompt, step_output) in enumerate(zip(reversed(prompts), reversed(model_outputs)), start = 1):
+            self.outputs.setdefault(self.prompt_hash(step_prompt), step_output)
+            if item is not None:
+                self.items.setdefault(self.item_hash(judgment_step(item, step)), step_output)
+
+    def _lookup(self, prompt, item):
+        model_output = self.outputs.get(self.prompt_hash(prompt))
+        if model_output is None and item is not None:
+            model_output = self.items.get(self.item_hash(item))
+        if model_output is None:
+            raise QueryFailedError(
+                model_name = self.model_name,
+                backend = self.key,
+                error_class = CacheMissError.__name__,
+                message = f'no recorded output for the prompt ({self.prompt_hash(prompt)}).'
+            )
+        return model_output
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        return self._lookup(prompt, item)
+
+    def score_labels(self, prompt, labels, item = None):
+        # recorded scores are replayed as they are, recorded texts give probability 1 to the label they contain
+        model_output = self._lookup(prompt, item)
+        label, distribution = _split_scores(model_output)
+        if distribution:
+            return {label : probability for label, probability in distribution.items() if label in labels}
+        label = ModelQuerier._match_label(label.split('\n')[0], labels)
+        return {label : 1.} if label is not None else {}
+
+
+class JudgeCascade:
+
+    def __init__(self, queriers, judge, parse, min_probability = .8, scale = False, boundary_margin = 0, audit_rate = 0.):
+        """
+            Class Description:
+                cascade of judges, from the cheapest to the most expensive. Each item is judged by the first judge and is escalated to
+                the next one only if the judgment is uncertain: unparsable, given with a probability lower than min_probability (when
+                the labels are scored) or, on a 5-level scale, within boundary_margin from the middle rating (3). The judgment of the
+                last judge is always kept. A fraction audit_rate of the items kept before the last judge is also judged by the last
+                judge, to estimate how much of the agreement with the last judge the cascade retains.
+
+            Attributes:
+                queriers (list of ModelQuerier): the judges, from the cheapest to the most expensive;
+                judge (callable): function(querier, **kwargs) judging an item with a given judge;
+                parse (callable): function(result of judge) returning the rating and its probability (see parse_code_judgment);
+                min_probability (float): probability under which a scored rating is uncertain;
+                scale (bool): whether the ratings are on a 5-level scale;
+                boundary_margin (float): distance from the middle rating under which a 5-level rating is uncertain (negative to disable the check);
+                audit_rate (float): fraction of the items kept before the last judge which are also judged by the last judge;
+                stats (dict): counters of the calls, kept and escalated judgments of each judge and of the audited items.
+        """
+        self.queriers = queriers
+        self.judge_function = judge
+        self.parse = parse
+        self.min_probability = min_probability
+        self.scale = scale
+        self.boundary_margin = boundary_margin
+        self.audit_rate = audit_rate
+        self.lock = threading.Lock()
+        self.stats = {
+            'calls' : [0] * len(queriers),
+            'kept' : [0] * len(queriers),
+            'escalated' : [0] * len(queriers),
+            'escalated_agreed' : [0] * len(queriers),
+            'audited' : 0,
+            'audited_agreed' : 0
+        }
+
+    def is_uncertain(self, rating, probability):
+        if rating is None:
+            return True
+        if probability is not None and probability < self.min_probability:
+            return True
+        if self.scale:
+            ratings = rating if isinstance(rating, tuple) else (rating,)
+            return any(abs(int(r) - 3) <= self.boundary_margin for r in ratings)
+        return False
+
+    def judge(self, **kwargs):
+        """
+            Description of the Function:
+                judges an item with the cascade of judges.
+
+            Parameters:
+                kwargs: arguments of the judge function (querier excluded).
+
+            Returns:
+                the value returned by the judge function for the judge whose judgment is kept;
+                str: the name of that judge.
+        """
+        ratings = []
+        for level, querier in enumerate(self.queriers):
+            result = self.judge_function(querier = querier, **kwargs)
+            rating, probability = self.parse(result)
+            ratings.append(rating)
+            if level == len(self.queriers) - 1 or not self.is_uncertain(rating, probability):
+                break
+
+        audited_rating = None
+        audited = level < len(self.queriers) - 1 and random.random() < self.audit_rate
+        if audited:
+            audited_rating, _ = self.parse(self.judge_function(querier = self.queriers[-1], **kwargs))
+
+        with self.lock:
+            for escalated_level, escalated_rating in enumerate(ratings[:-1]):
+                self.stats['calls'][escalated_level] += 1
+                self.stats['escalated'][escalated_level] += 1
+                self.stats['escalated_agreed'][escalated_level] += escalated_rating == rating
+            self.stats['calls'][level] += 1
+            self.stats['kept'][level] += 1
+            if audited:
+                self.stats['calls'][-1] += 1
+                self.stats['audited'] += 1
+                self.stats['audited_agreed'] += audited_rating == rating
+
+        return result, querier.model_name
+
+    def report(self):
+        """
+            Description of the Function:
+                summarizes the calls made to each judge, the calls saved on the last judge and the agreement with the last judge.
+        """
+        stats = self.stats
+        items = sum(stats['kept'])
+        lines = [f'Cascade of {len(self.queriers)} judges over {items} items:']
+        for level, querier in enumerate(self.queriers):
+            line = f'  {querier.model_name}: {stats["calls"][level]} calls, {stats["kept"][level]} judgments kept'
+            if level < len(self.queriers) - 1:
+                line += f', {stats["escalated"][level]} escalated (same rating as the kept one for {stats["escalated_agreed"][level]})'
+            lines.append(line)
+
+        saved = items - stats['calls'][-1]
+        lines.append(f'  calls to {self.queriers[-1].model_name} saved: {saved} ({saved / max(items, 1):.1%})')
+        if stats['audited'] > 0:
+            # the items kept by the last judge agree with it by definition, the others are estimated from the audited ones
+            agreement = stats['audited_agreed'] / stats['audited']
+            retained = (stats['kept'][-1] + (items - stats['kept'][-1]) * agreement) / max(items, 1)
+            lines.append(f'  agreement with {self.queriers[-1].model_name} on {stats["audited"]} audited items: {agreement:.1%} '
+                         f'(estimated agreement retained: {retained:.1%})')
+        else:
+            lines.append('  agreement retained not estimated (no item audited, see audit_rate)')
+        return '\n'.join(lines)
+
+
+class Telemetry:
+
+    def __init__(self, trace_path = None, prices_path = '../constants/model_prices.json'):
+        """
+            Class Description:
+                collects an event for every call sent to a backend (shared by all the queriers of a run). Each event is appended to a
+                JSONL trace (if trace_path is given) and aggregated per model, to be exported in the Prometheus text format (see
+                prometheus_text and serve) and summarized at the end of the run.
+
+            Attributes:
+                trace (file): JSONL trace of the events, if any;
+                prices (dict): price of each model (USD per 1M input/output tokens for the APIs, USD per hour for the endpoints);
+                models (dict): for each model, its backend, the number of calls, errors, retries and tokens and the latency of each call;
+                started_at (float): time at which the run started.
+        """
+        self.trace = open(trace_path, 'a') if trace_path else None
+        self.prices = json.load(open(prices_path)) if os.path.exists(prices_path) else {}
+        self.models = {}
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.server = None
+
+    def record(self, model, backend, operation, prompt_tokens, completion_tokens, tokens_estimated, queue_wait, latency, attempts, error_class = None, status_code = None):
+        """
+            Description of the Function:
+                records a call: the tokens are estimated (4 characters per token) when neither the backend nor a tokenizer counts them,
+                queue_wait is the time spent waiting for an in-flight slot and for the rate limiter, latency the time from the first
+                attempt to the answer (retries included).
+        """
+        event = {
+            'timestamp' : time.time(),
+            'model' : model,
+            'backend' : backend,
+            'operation' : operation,
+            'prompt_tokens' : prompt_tokens,
+            'completion_tokens' : completion_tokens,
+            'tokens_estimated' : tokens_estimated,
+            'queue_wait' : round(queue_wait, 6),
+            'latency' : round(latency, 6),
+            'retries' : attempts - 1,
+            'error_class' : error_class,
+            'status_code' : status_code
+        }
+        with self.lock:
+            stats = self.models.setdefault(model, {
+                'backend' : backend, 'calls' : 0, 'errors' : 0, 'retries' : 0,
+                'prompt_tokens' : 0, 'completion_tokens' : 0, 'queue_wait' : 0., 'latencies' : []
+            })
+            stats['calls'] += 1
+            stats['errors'] += error_class is not None
+            stats['retries'] += attempts - 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['queue_wait'] += queue_wait
+            stats['latencies'].append(latency)
+            if self.trace is not None:
+                self.trace.write(json.dumps(event) + '\n')
+                self.trace.flush()
+
+    @staticmethod
+    def _percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.
+
+    def cost(self, model, stats, hours):
+        # APIs are billed per token, endpoints per hour of uptime (at least the duration of the run); allocated models and
+        # offline backends (e.g., replay) are free
+        prices = self.prices.get(model, {})
+        if stats['backend'].startswith(('openai:', 'api:')):
+            return stats['prompt_tokens'] / 1e6 * prices.get('input_per_1m_tokens', 0.) \
+                + stats['completion_tokens'] / 1e6 * prices.get('output_per_1m_tokens', 0.)
+        if stats['backend'].startswith('endpoint:'):
+            return hours * prices.get('per_hour', 0.)
+        return 0.
+
+    def prometheus_text(self):
+        """
+            Description of the Function:
+                returns the metrics aggregated so far in the Prometheus text exposition format.
+        """
+        metrics = {
+            'llm_calls_total' : ('counter', 'Calls sent to the backend.', lambda stats: stats['calls']),
+            'llm_errors_total' : ('counter', 'Calls which failed.', lambda stats: stats['errors']),
+            'llm_retries_total' : ('counter', 'Retries of the calls.', lambda stats: stats['retries']),
+            'llm_prompt_tokens_total' : ('counter', 'Input tokens.', lambda stats: stats['prompt_tokens']),
+            'llm_completion_tokens_total' : ('counter', 'Generated tokens.', lambda stats: stats['completion_tokens']),
+            'llm_queue_wait_seconds_total' : ('counter', 'Time spent waiting for an in-flight slot and the rate limiter.', lambda stats: stats['queue_wait'])
+        }
+        lines = []
+        with self.lock:
+            for name, (kind, description, value) in metrics.items():
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{{model="{model}",backend="{stats["backend"]}"}} {value(stats)}' for model, stats in self.models.items()]
+            lines += ['# HELP llm_call_latency_seconds Latency of the calls (retries included).', '# TYPE llm_call_latency_seconds summary']
+            for model, stats in self.models.items():
+                labels = f'model="{model}",backend="{stats["backend"]}"'
+                lines += [f'llm_call_latency_seconds{{{labels},quantile="{q}"}} {self._percentile(stats["latencies"], 100 * q)}' for q in [.5, .9, .99]]
+                lines += [f'llm_call_latency_seconds_sum{{{labels}}} {sum(stats["latencies"])}', f'llm_call_latency_seconds_count{{{labels}}} {len(stats["latencies"])}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host = '127.0.0.1'):
+        """
+            Description of the Function:
+                exposes the metrics at http://host:port/metrics from a daemon thread.
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.prometheus_text().encode('utf-8')
+                self.send_response(200 if self.path.startswith('/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def summary(self, items = None):
+        """
+            Description of the Function:
+                summarizes the run: for each model the calls, their throughput, latency and tokens, and the estimated cost.
+
+            Parameters:
+                items (int): number of items judged in the run, if the throughput in items per second is to be reported.
+        """
+        seconds = time.monotonic() - self.started_at
+        lines = [f'Run of {seconds:.1f}s' + (f': {items} items ({items / seconds:.2f} items/s)' if items is not None else '')]
+        total_cost = 0.
+        with self.lock:
+            for model, stats in self.models.items():
+                cost = self.cost(model, stats, seconds / 3600)
+                total_cost += cost
+                lines.append(
+                    f'  {model} ({stats["backend"]}): {stats["calls"]} calls ({stats["calls"] / seconds:.2f}/s), {stats["errors"]} errors, '
+                    f'{stats["retries"]} retries, latency p50 {self._percentile(stats["latencies"], 50):.2f}s p99 {self._percentile(stats["latencies"], 99):.2f}s, '
+                    f'queue wait {stats["queue_wait"] / max(stats["calls"], 1):.2f}s/call, '
+                    f'{stats["prompt_tokens"]} + {stats["completion_tokens"]} tokens, ~${cost:.2f}'
+                )
+        lines.append(f'  estimated cost: ~${total_cost:.2f}')
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+        if self.server is not None:
+            self.server.shutdown()
+
+
 class ModelQuerier:
 
     def __init__(
@@ -53,7 +1222,30 @@ class ModelQuerier:
             max_new_tokens = 512,
             temperature = .5,
             top_p = .95,
-            do_sample = True
+            do_sample = True,
+            pool_size = 16,
+            connect_timeout = 10,
+            read_timeout = 300,
+            template_cache_size = 4096,
+            max_inflight = None,
+            cache_path = None,
+            cache_max_size_mb = 1024,
+            replay = False,
+            requests_per_second = None,
+            max_retries = 5,
+            backoff_base = 1,
+            backoff_cap = 60,
+            replica_max_failures = 3,
+            replica_cooldown = 30,
+            request_deadline = None,
+            hedge_percentile = None,
+            batch_size = 1,
+            reuse_prefix_cache = True,
+            score = False,
+            stream = False,
+            coalesce = True,
+            backend = None,
+            telemetry = None
         ):
         """
             Class Description:
@@ -63,9 +1255,51 @@ class ModelQuerier:
                 constants (dict): contains tokens and access keys;
                 prompts (dict): contains prompts for different predefined tasks;
                 model (str): name of the model to query;
-                endpoint_url (str): the URL of the inference endpoint of the model;
+                endpoint_url (str or list of str): the URL of the inference endpoint of the model, or the URLs of its replicas;
+                replicas (ReplicaPool): the replicas of the inference endpoint, among which the requests are routed;
                 max_new_tokens (int): maximum number of tokens generated by the model (input tokens excluded);
-                temperature (float): temperature to set when quering the model.
+                temperature (float): temperature to set when quering the model;
+                pool_size (int): maximum number of keep-alive connections kept open towards the backend (i.e., max number of concurrent requests);
+                connect_timeout (float): seconds to wait for a connection to the backend to be established;
+                read_timeout (float): seconds to wait for the backend to answer a request;
+                session (requests.Session): pooled HTTP session used to query the inference endpoint;
+                openai_client (openai.OpenAI): pooled client used to query the OpenAI API;
+                hf_client (huggingface_hub.InferenceClient): client used to query the Hugging Face API;
+                template_cache_size (int): number of prompts (already rendered with the chat template) kept in memory;
+                max_inflight (int): maximum number of requests sent at the same time to the backend (by default pool_size);
+                cache (ResponseCache): on-disk cache of the model outputs, used only if cache_path is given;
+                replay (bool): if True the outputs are only read from the cache and the backend is never queried;
+                rate_limiter (TokenBucket): adaptive limiter of the requests per second sent to the backend (shared by all the queriers of the backend).
+                    The requests are limited only if requests_per_second is given, or for the OpenAI API (OPENAI_REQUESTS_PER_SECOND by default);
+                max_retries (int): maximum number of times a failed request is retried;
+                backoff_base (float): delay (in seconds) before the first retry, doubled at each further retry (with jitter);
+                backoff_cap (float): maximum delay (in seconds) between two retries;
+                replica_max_failures (int): consecutive failures after which a replica of the endpoint is ejected;
+                replica_cooldown (float): seconds after which an ejected replica receives requests again;
+                request_deadline (float): seconds after which a request still waiting for the backend is abandoned (and retried);
+                hedge_percentile (float): if given, a request still waiting for the backend after this percentile of the recent latencies
+                    is duplicated (the duplicate goes to the least loaded replica, if the endpoint has several), and the first answer is taken.
+                    Since the seed is fixed, the answers are interchangeable;
+                latencies (LatencyTracker): latencies of the recent requests, used to decide when to hedge;
+                batch_size (int): number of prompts generated together by an allocated model;
+                generator (transformers.Pipeline): text-generation pipeline of an allocated model, built once;
+                batcher (GenerationBatcher): collects the prompts submitted concurrently to an allocated model (only if batch_size > 1);
+                reuse_prefix_cache (bool): if True, the step-by-step judgments on an allocated model reuse the key/value cache of the
+                    first step to generate the second one (whose prompt starts with the prompt and the output of the first step);
+                model_lock (threading.Lock): serializes the generations of the allocated model;
+                score (bool): if True, the judgments which only require a label (Boolean and 5-level judgments without rationale, second step
+                    of the slow-thinking judgments) are obtained comparing the probabilities of the allowed labels (see score_labels)
+                    instead of generating and parsing free text. Not available for the models queried through the Hugging Face API;
+                stream (bool): if True, the outputs are streamed and the generation is cancelled as soon as the judgment is emitted
+                    (see the stop predicates, e.g. summary_ratings_emitted);
+                coalesce (bool): if True, a query identical (same rendered prompt and generation parameters) to one already pending
+                    in this process is not sent again, and gets the result of the first one;
+                coalesced_calls (int): number of queries answered with the result of an identical query;
+                backend (Backend): answers the queries: the live service of the model (OpenAIBackend for the GPT models, AllocatedModelBackend
+                    if allocate is True, HuggingFaceAPIBackend or InferenceEndpointBackend depending on constants/IEPmodels.json), or the
+                    backend given in its place (e.g., a ReplayBackend);
+                telemetry (Telemetry): if given, records an event for every call sent to the backend;
+                call_state (threading.local): attempts, rate limiter wait and token usage of the call running in each thread.
         """
         assert language in ['java', 'python'], "language must be either 'java' or 'python'."
 
@@ -87,21 +1321,148 @@ class ModelQuerier:
         self.max_new_tokens = max_new_tokens
         self.model = None
         self.tokenizer = None
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = None
+        self.openai_client = None
+        self.hf_client = None
+        self.endpoint_url = None
+        self.prompt_with_template = False
+        self.replicas = None
+        self.request_deadline = request_deadline
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyTracker()
+        self.hedging_executor = ThreadPoolExecutor(max_workers = 2 * pool_size) if request_deadline or hedge_percentile else None
+        self.hedged_requests = 0
+        self.hedged_requests_lock = threading.Lock()
+        self.coalesce = coalesce
+        self.coalesced_calls = 0
+        self.batch_size = batch_size
+        self.generator = None
+        self.batcher = None
+        self.reuse_prefix_cache = reuse_prefix_cache
+        self.score = score
+        self.stream = stream
+        self.model_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.template_cache_size = template_cache_size
+        self.template_cache = OrderedDict()
+        self.template_cache_lock = threading.Lock()
+        self.cache = ResponseCache(cache_path, max_size_mb = cache_max_size_mb, replay = replay) if cache_path else None
+        if replay and self.cache is None:
+            raise ValueError('replay mode requires a cache_path.')
+        self.backend = backend
+        self.telemetry = telemetry
+        self.call_state = threading.local()
         
-        if self.is_gpt:
+        if backend is not None:
+            self.allocate = False
+        elif self.is_gpt:
             self.allocate = False
             # set the openai API key
             os.environ['OPENAI_API_KEY'] = self.constants['OpenAI API Access Key']
             apikey = os.environ.get('OPENAI_API_KEY')
             if not apikey:
                 raise ValueError('ERROR: OPENAI_API_KEY is not set! Check your .env file.')
+            requests_per_second = requests_per_second or OPENAI_REQUESTS_PER_SECOND
+            import openai
+            import httpx
+            # one client for the whole run: the underlying httpx pool keeps the connections alive and is thread-safe
+            self.openai_client = openai.OpenAI(
+                timeout = openai.Timeout(read_timeout, connect = connect_timeout),
+                max_retries = 0, # retries are handled by call_with_retries
+                http_client = openai.DefaultHttpxClient(
+                    limits = httpx.Limits(max_connections = pool_size, max_keepalive_connections = pool_size)
+                )
+            )
+            self.backend = OpenAIBackend(self)
         elif not self.allocate and not self.is_gpt:
             self.endpoint_url = json.load(open('../constants/IEPmodels.json'))[self.model_name]
             self.prompt_with_template = json.load(open('../constants/prompt_with_template.json'))[self.model_name]
+            if self.endpoint_url == "API":
+                if self.score:
+                    raise ValueError(f'{self.model_name} is queried through the Hugging Face API, which does not return the probabilities of the tokens: it cannot judge with score.')
+                from huggingface_hub import InferenceClient
+                self.hf_client = InferenceClient(model = self.model_name, token = self.constants['Hugging Face API Token'], timeout = read_timeout)
+                self.backend = HuggingFaceAPIBackend(self)
+            else:
+                urls = [self.endpoint_url] if isinstance(self.endpoint_url, str) else self.endpoint_url
+                with _INFLIGHT_LIMITS_LOCK:
+                    self.replicas = _REPLICA_POOLS.setdefault(
+                        self.model_name,
+                        ReplicaPool(urls, max_failures = replica_max_failures, cooldown = replica_cooldown)
+                    )
+                # each replica can take requests_per_second requests
+                requests_per_second = requests_per_second * len(urls) if requests_per_second else None
+                self.session = self._build_session()
+                if self.prompt_with_template:
+                    self.tokenizer = load_tokenizer(self.model_name, use_auth_token = self.constants['Hugging Face Tokenizer Token'])
+                self.backend = InferenceEndpointBackend(self)
         else:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code = True)
+            import torch
+            from transformers import AutoModelForCausalLM, pipeline
+            self.tokenizer = load_tokenizer(self.model_name, trust_remote_code = True)
             self.model = AutoModelForCausalLM.from_pretrained(self.model_name, trust_remote_code = True, torch_dtype = torch.bfloat16).cuda()
+            # batched generation needs a padding token, and decoder-only models are padded on the left
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = 'left'
             self.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
+            self.generator = pipeline('text-generation', model = self.model, tokenizer = self.tokenizer)
+            if self.batch_size > 1:
+                self.batcher = GenerationBatcher(self.query_allocated_model_batch, batch_size = self.batch_size)
+            self.backend = AllocatedModelBackend(self)
+
+        # a locally allocated model takes at most batch_size prompts at a time
+        max_inflight = self.batch_size if self.allocate else (max_inflight or pool_size)
+        with _INFLIGHT_LIMITS_LOCK:
+            self.inflight_limit = _INFLIGHT_LIMITS.setdefault(self.backend_key(), threading.BoundedSemaphore(max_inflight))
+            self.rate_limiter = _RATE_LIMITERS.setdefault(self.backend_key(), TokenBucket(requests_per_second))
+
+
+    def backend_key(self):
+        """
+            Description of the Function:
+                returns a string identifying the backend queried by this object (i.e., the endpoint, the API or the local model).
+        """
+        return self.backend.key
+
+
+    def _build_session(self):
+        """
+            Description of the Function:
+                builds the keep-alive HTTP session used to query the inference endpoint. The connection pool is shared by all the threads
+                using this object: when all the pool_size connections are busy, a new request waits for a free one instead of opening
+                (and then discarding) an extra connection.
+
+            Returns:
+                requests.Session: the pooled session.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections = len(self.replicas.replicas), pool_maxsize = self.pool_size, pool_block = True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+
+    def close(self):
+        """
+            Description of the Function:
+                releases the connections kept open towards the backend.
+        """
+        if self.session is not None:
+            self.session.close()
+        if self.openai_client is not None:
+            self.openai_client.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.hedging_executor is not None:
+            self.hedging_executor.shutdown(wait = False)
             
 
     # a method to replace the tags like <LANGUAGE> in the prompt with the actual language
@@ -123,29 +1484,97 @@ class ModelQuerier:
             prompt = prompt.replace(f'<{name.upper()}>', value)
         return prompt
 
-    def query_huggingface_inference_endpoint(self, prompt):
+    def apply_chat_template(self, prompt):
         """
             Description of the Function:
-                queries the inference endpoint.
+                renders the prompt with the chat template of the model. The last template_cache_size rendered prompts are kept
+                in a LRU cache, so that prompts which are judged more than once (e.g., the human written candidates) are rendered only once.
 
             Parameters:
-                prompt (str): model input;
-                temperature (float): temperature to set when quering the model.
+                prompt (str): model input.
 
             Returns:
-                str: output of the model (input excluded).
+                str: the prompt rendered with the chat template.
         """
+        with self.template_cache_lock:
+            if prompt in self.template_cache:
+                self.template_cache.move_to_end(prompt)
+                return self.template_cache[prompt]
+
         messages = [
             {"role" : "user", "content" : prompt}
         ]
-        tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_auth_token = self.constants['Hugging Face Tokenizer Token'])
-        prompt_with_template = tokenizer.apply_chat_template(messages, tokenize = False) \
-            if self.prompt_with_template else prompt
-        
-        payload = {
+        prompt_with_template = self.tokenizer.apply_chat_template(messages, tokenize = False)
+
+        with self.template_cache_lock:
+            self.template_cache[prompt] = prompt_with_template
+            if len(self.template_cache) > self.template_cache_size:
+                self.template_cache.popitem(last = False)
+        return prompt_with_template
+
+
+    def query_huggingface_inference_endpoint(self, prompt, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the inference endpoint.
+
+            Parameters:
+                prompt (str): model input;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
+
+            Returns:
+                str: output of the model (input excluded).
+        """
+        payload = self._endpoint_payload(prompt, max_new_tokens)
+
+        with self.route_to_replica() as url:
+            response = self.session.post(url = url, json = payload, timeout = self.request_timeout())
+            response.raise_for_status()
+        model_output = response.json()[0]['generated_text']
+
+        return model_output.strip()
+
+
+    def stream_huggingface_inference_endpoint(self, prompt, stop, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the inference endpoint streaming the output (server-sent events), and closes the connection (which cancels
+                the generation on the endpoint) as soon as the stop predicate is true.
+
+            Parameters:
+                prompt (str): model input;
+                stop (callable): predicate on the text generated so far;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
+
+            Returns:
+                str: output of the model (input excluded).
+        """
+        payload = self._endpoint_payload(prompt, max_new_tokens)
+        payload['stream'] = True
+
+        model_output = ''
+        with self.route_to_replica() as url, self.session.post(url = url, json = payload, timeout = self.request_timeout(), stream = True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode = True):
+                if not line or not line.startswith('data:'):
+                    continue
+                event = json.loads(line[len('data:'):])
+                if 'error' in event:
+                    raise RuntimeError(event['error'])
+                if not event['token']['special']:
+                    model_output += event['token']['text']
+                if stop(model_output):
+                    break
+
+        return model_output.strip()
+
+
+    def _endpoint_payload(self, prompt, max_new_tokens = None):
+        prompt_with_template = self.apply_chat_template(prompt) if self.prompt_with_template else prompt
+        return {
             "inputs": prompt_with_template,
             "parameters": {
-                "max_new_tokens" : self.max_new_tokens,
+                "max_new_tokens" : max_new_tokens or self.max_new_tokens,
                 "return_full_text": False,
                 "do_sample": self.do_sample,
                 "top_p": self.top_p,
@@ -154,86 +1583,413 @@ class ModelQuerier:
             }
         }
 
-        model_output = requests.post(url = self.endpoint_url, headers = self.headers, json = payload).json()[0]['generated_text']
 
-        return model_output.strip()
+    def query_allocated_model(self, prompt, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the allocated model. If batch_size > 1, the prompt is generated together with the ones submitted
+                at the same time by other threads.
+
+            Parameters:
+                prompt (str): model input;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
+
+            Returns:
+                str: output of the model (input excluded).
+        """
+        if self.batcher is not None:
+            return self.batcher.submit(prompt, max_new_tokens = max_new_tokens)
+        return self.query_allocated_model_batch([prompt], max_new_tokens = max_new_tokens)[0]
+
+
+    def query_allocated_model_batch(self, prompts, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the allocated model with a list of prompts, batch_size prompts at a time. Prompts are sorted by length
+                before being split into batches, so that prompts of similar length are padded together.
+
+            Parameters:
+                prompts (list of str): model inputs;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
+
+            Returns:
+                list of str: outputs of the model (input excluded), in the same order as prompts.
+        """
+        if self.tokenizer is None or self.model is None:
+            print('Either model or tokenizer is not allocated.')
+            return [''] * len(prompts)
+
+        lengths = [len(input_ids) for input_ids in self.tokenizer(prompts)['input_ids']]
+        order = sorted(range(len(prompts)), key = lambda i: lengths[i])
+
+        model_outputs = [None] * len(prompts)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start : start + self.batch_size]
+            with self.model_lock:
+                generated = self.generator(
+                                        [prompts[i] for i in bucket],
+                                        batch_size = len(bucket),
+                                        max_new_tokens = max_new_tokens or self.max_new_tokens,
+                                        return_full_text = False,
+                                        do_sample = self.do_sample,
+                                        top_p = self.top_p,
+                                        temperature = self.temperature
+                                    )
+            for i, sequences in zip(bucket, generated):
+                model_outputs[i] = sequences[0]['generated_text'].strip()
+
+        return model_outputs
+
+
+    def query_allocated_model_with_prefix_cache(self, prompt, prefix_cache, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the allocated model reusing the key/value cache of a previous generation for the longest common prefix between
+                the previous sequence (prompt + output) and the new prompt. Only the tokens after that prefix are encoded again.
+                The cache of this generation is then stored in prefix_cache, so that a following call can reuse it.
+                These calls are not batched with the ones of other threads.
 
+            Parameters:
+                prompt (str): model input;
+                prefix_cache (dict): the cache of the previous generation ('input_ids', 'past_key_values'), empty on the first call;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
 
-    def query_allocated_model(self, prompt):
+            Returns:
+                str: output of the model (input excluded).
+        """
         if self.tokenizer is None or self.model is None:
             print('Either model or tokenizer is not allocated.')
             return ''
-        
-        code_generator = pipeline('text-generation', model = self.model, tokenizer = self.tokenizer)
-        model_output = code_generator(
-                                    prompt, 
-                                    max_new_tokens = self.max_new_tokens,
-                                    return_full_text = False,
+
+        import torch
+        input_ids = self.tokenizer(prompt, return_tensors = 'pt')['input_ids'].to(self.model.device)
+
+        past_key_values = None
+        if 'input_ids' in prefix_cache:
+            cached_ids = prefix_cache['input_ids']
+            length = min(cached_ids.shape[0], input_ids.shape[1] - 1) # at least one token of the prompt has to be encoded
+            mismatches = (cached_ids[:length] != input_ids[0, :length]).nonzero()
+            common_prefix = int(mismatches[0]) if len(mismatches) > 0 else length
+            if common_prefix > 0:
+                past_key_values = prefix_cache['past_key_values']
+                past_key_values.crop(common_prefix)
+
+        with self.model_lock, torch.no_grad():
+            output = self.model.generate(
+                                    input_ids = input_ids,
+                                    attention_mask = torch.ones_like(input_ids),
+                                    past_key_values = past_key_values,
+                                    max_new_tokens = max_new_tokens or self.max_new_tokens,
                                     do_sample = self.do_sample,
                                     top_p = self.top_p,
-                                    temperature = self.temperature
-                                )[0]['generated_text']
-        
+                                    temperature = self.temperature,
+                                    return_dict_in_generate = True
+                                )
+
+        # the cache covers all the tokens of the sequence but the last generated one
+        prefix_cache['past_key_values'] = output.past_key_values
+        prefix_cache['input_ids'] = output.sequences[0, : output.past_key_values.get_seq_length()]
+
+        model_output = self.tokenizer.decode(output.sequences[0, input_ids.shape[1] :], skip_special_tokens = True)
+        return model_output.strip()
+
+
+    def stream_allocated_model(self, prompt, stop, max_new_tokens = None):
+        """
+            Description of the Function:
+                queries the allocated model streaming the output, and stops the generation as soon as the stop predicate is true.
+                These calls are not batched with the ones of other threads.
+
+            Parameters:
+                prompt (str): model input;
+                stop (callable): predicate on the text generated so far;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens).
+
+            Returns:
+                str: output of the model (input excluded).
+        """
+        if self.tokenizer is None or self.model is None:
+            print('Either model or tokenizer is not allocated.')
+            return ''
+
+        import torch
+        from transformers import TextIteratorStreamer, StoppingCriteriaList
+        input_ids = self.tokenizer(prompt, return_tensors = 'pt')['input_ids'].to(self.model.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt = True, skip_special_tokens = True)
+        stopped = threading.Event()
+        generation = threading.Thread(target = self.model.generate, kwargs = {
+            'input_ids' : input_ids,
+            'attention_mask' : torch.ones_like(input_ids),
+            'max_new_tokens' : max_new_tokens or self.max_new_tokens,
+            'do_sample' : self.do_sample,
+            'top_p' : self.top_p,
+            'temperature' : self.temperature,
+            'streamer' : streamer,
+            'stopping_criteria' : StoppingCriteriaList([event_stopping_criteria(stopped)])
+        })
+
+        model_output = ''
+        with self.model_lock:
+            generation.start()
+            for text in streamer:
+                model_output += text
+                if stop(model_output):
+                    stopped.set()
+                    break
+            generation.join()
+
         return model_output.strip()
     
 
-    def query_chatgpt(self, prompt):
+    def query_chatgpt(self, prompt, max_new_tokens = None, stop = None):
         """
             Description of the Function:
                 queries ChatGPT API with a given prompt and returns ChatGPT response.
 
             Parameters:
                 prompt (str): ChatGPT input;
-                language (str): string indicating a programming language;
+                max_new_tokens (int): ignored, the GPT models are queried without a limit on the number of generated tokens;
+                stop (callable): if given, the output is streamed and the stream is closed as soon as the predicate is true on the text received so far.
 
             Returns:
                 str: ChatGPT output.
         """
+        messages = [
+            {'role' : 'system', 'content' : f'You are an expert {self.language.capitalize()} developer'},
+            {'role' : 'user', 'content' : prompt}
+        ]
+
+        if stop is not None:
+            return self.call_with_retries(lambda: self._stream_chatgpt(messages, stop))
         
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
+        response = self.call_with_retries(lambda: self.openai_client.chat.completions.create(
             model = self.model_name,
-            messages = [
-                {'role' : 'system', 'content' : f'You are an expert {self.language.capitalize()} developer'},
-                {'role' : 'user', 'content' : prompt}
-            ],
+            messages = messages,
             temperature = self.temperature,
-            seed = 123
-        )
+            seed = 123,
+            timeout = self._openai_timeout()
+        ))
 
+        self.call_state.usage = getattr(response, 'usage', None)
         model_output = response.choices[0].message.content
         return model_output.strip()
 
 
-    def call_huggingface_model(self, prompt):
+    def _stream_chatgpt(self, messages, stop):
+        stream = self.openai_client.chat.completions.create(
+            model = self.model_name,
+            messages = messages,
+            temperature = self.temperature,
+            seed = 123,
+            stream = True,
+            timeout = self._openai_timeout()
+        )
+
+        model_output = ''
+        with stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    model_output += chunk.choices[0].delta.content
+                if stop(model_output):
+                    break # closing the stream cancels the generation
+
+        return model_output.strip()
+
+
+    def call_huggingface_model(self, prompt, max_new_tokens = None, stop = None):
         """
             Description of the Function:
-                given a model and a prompt calls the model through the API or Inference Endpoint and returns the output.
+                given a model and a prompt calls the model through the API or Inference Endpoint and returns the output
+                (see HuggingFaceAPIBackend and InferenceEndpointBackend).
 
             Parameters:
                 prompt (str): model input;
-                task (str): just a string which explicits the task ("PREDICTION", "RANKING", "REFINEMENT") in case of failure.
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens);
+                stop (callable): if given, the output is streamed and the generation is cancelled as soon as the predicate is true on the text generated so far.
 
             Returns:
                 str: output of the model.
+
+            Raises:
+                QueryFailedError: if the call still fails after max_retries retries (or fails with a non-retryable error).
         """
-        
-        if self.endpoint_url == "API":
+        return self.backend.generate(prompt = prompt, max_new_tokens = max_new_tokens, stop = stop)
+
+
+    def _stream_huggingface_api(self, prompt, stop, max_new_tokens = None):
+        predicted_output = ''
+        for token in self.hf_client.text_generation(prompt = prompt, max_new_tokens = max_new_tokens or self.max_new_tokens, stream = True):
+            predicted_output += token
+            if stop(predicted_output):
+                break
+        return predicted_output
+
+
+    def call_with_retries(self, request):
+        """
+            Description of the Function:
+                sends a request to the backend through the rate limiter of the backend. Requests failing because of rate limiting (429),
+                an overloaded endpoint (5xx), a timeout or a connection error are retried up to max_retries times, waiting either
+                the Retry-After delay given by the backend or an exponential backoff with jitter.
+
+            Parameters:
+                request (callable): function sending the request and returning its result.
+
+            Returns:
+                the value returned by request.
+
+            Raises:
+                QueryFailedError: if the request fails with a non-retryable error or after max_retries retries.
+        """
+        # replicas to which the request has been sent, avoided by the retries (and by the hedged duplicate, see _send)
+        self.call_state.tried_replicas = []
+        for attempt in range(self.max_retries + 1):
+            waiting_since = time.monotonic()
+            self.rate_limiter.acquire()
+            self.call_state.rate_limit_wait = getattr(self.call_state, 'rate_limit_wait', 0.) + time.monotonic() - waiting_since
+            self.call_state.attempts = attempt + 1
             try:
-                client = InferenceClient(model = self.model_name, token = self.constants['Hugging Face API Token'])
-                predicted_output = client.text_generation(prompt = prompt, max_new_tokens = self.max_new_tokens)
-            except:
-                print(Fore.RED + f'\n{self.model_name}: API FAILED.\n' + Fore.BLACK)
-                predicted_output = f'{self.model_name}: API FAILED.'
-        
-        else:
+                result = self._send(request)
+            except Exception as e:
+                status_code, retry_after = self._parse_error(e)
+                if status_code == 429:
+                    self.rate_limiter.penalize(retry_after)
+
+                retryable = status_code in RETRYABLE_STATUS_CODES if status_code is not None \
+                    else is_connection_error(e)
+                if not retryable or attempt == self.max_retries:
+                    print(Fore.RED + f'\n{self.model_name}: {type(e).__name__} ({status_code}) after {attempt + 1} attempt(s).\n' + Fore.BLACK)
+                    raise QueryFailedError(
+                        model_name = self.model_name,
+                        backend = self.backend_key(),
+                        error_class = type(e).__name__,
+                        message = str(e),
+                        status_code = status_code,
+                        attempts = attempt + 1
+                    ) from e
+
+                backoff = min(self.backoff_cap, self.backoff_base * 2 ** attempt) * random.uniform(.5, 1.5)
+                time.sleep(max(backoff, retry_after or 0))
+            else:
+                self.rate_limiter.reward()
+                return result
+
+
+    def _send(self, request):
+        """
+            Description of the Function:
+                sends a request within the request deadline, hedging it if it takes longer than hedge_percentile of the recent latencies.
+
+            Parameters:
+                request (callable): function sending the request and returning its result.
+
+            Returns:
+                the value returned by the first request to complete successfully.
+
+            Raises:
+                DeadlineExceededError: if no request completes within the deadline;
+                the exception raised by the request, if all the requests sent fail.
+        """
+        start = time.monotonic()
+        if self.hedging_executor is None:
+            result = request()
+            self.latencies.add(time.monotonic() - start)
+            return result
+
+        deadline = start + self.request_deadline if self.request_deadline else None
+        remaining = lambda: max(0., deadline - time.monotonic()) if deadline is not None else None
+        tried_replicas = getattr(self.call_state, 'tried_replicas', None)
+
+        def bounded_request():
+            # the read timeout of the request is cut to the time left before the deadline (taken when a worker picks the request
+            # up), so that an abandoned request (or the loser of a hedge) ends with the deadline instead of holding a connection,
+            # a replica slot and a worker for up to read_timeout
+            if deadline is not None:
+                if remaining() <= 0:
+                    raise DeadlineExceededError(f'{self.model_name}: no answer within {self.request_deadline} seconds.')
+                self.call_state.timeout = (self.timeout[0], min(self.timeout[1], remaining()))
+            # the requests run in the threads of the executor: they share the replicas tried by the call, so that the duplicate
+            # is not routed to the replica of the request it hedges
+            self.call_state.tried_replicas = tried_replicas
             try:
-                predicted_output = self.query_huggingface_inference_endpoint(prompt = prompt)
-            except:
-                print(Fore.RED + f'\n{self.model_name}: IEP FAILED.\n' + Fore.BLACK)
-                predicted_output = f'{self.model_name}: IEP FAILED.'
-        
-        return predicted_output.strip('\n\t ')
+                return request()
+            finally:
+                self.call_state.timeout = None
+                self.call_state.tried_replicas = None
+
+        pending = {self.hedging_executor.submit(bounded_request)}
+        hedge_delay = self.latencies.percentile(self.hedge_percentile) if self.hedge_percentile else None
+        if hedge_delay is not None:
+            done, _ = wait(pending, timeout = hedge_delay if deadline is None else min(hedge_delay, remaining()))
+            # the duplicate is sent only if the rate limit allows it right away
+            if not done and (deadline is None or remaining() > 0) and self.rate_limiter.try_acquire():
+                pending.add(self.hedging_executor.submit(bounded_request))
+                with self.hedged_requests_lock:
+                    self.hedged_requests += 1
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout = remaining(), return_when = FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    # the slower requests are left to complete in background, and their answers are discarded
+                    self.latencies.add(time.monotonic() - start)
+                    return future.result()
+                error = error or future.exception()
+
+        if error is not None and not pending:
+            raise error
+        raise DeadlineExceededError(f'{self.model_name}: no answer within {self.request_deadline} seconds.')
+
+
+    @contextmanager
+    def route_to_replica(self):
+        """
+            Description of the Function:
+                context manager yielding the url of the replica to which the request of the current thread is sent: the replicas
+                already tried by the same call (failed attempts, or the request being hedged) are avoided if another one is available.
+        """
+        tried_replicas = getattr(self.call_state, 'tried_replicas', None)
+        with self.replicas.route(exclude = tuple(tried_replicas or ())) as url:
+            if tried_replicas is not None:
+                tried_replicas.append(url)
+            yield url
+
+
+    def request_timeout(self):
+        """
+            Description of the Function:
+                returns the (connect, read) timeout of the request sent by the current thread: the read timeout is cut to the time
+                left before the request deadline when the request is sent by _send.
+
+            Returns:
+                tuple: connect and read timeout in seconds.
+        """
+        return getattr(self.call_state, 'timeout', None) or self.timeout
+
+
+    def _openai_timeout(self):
+        import openai
+        connect_timeout, read_timeout = self.request_timeout()
+        return openai.Timeout(read_timeout, connect = connect_timeout)
+
+
+    @staticmethod
+    def _parse_error(exception):
+        # returns the HTTP status code and the Retry-After delay (in seconds) of a failed request, if any
+        response = getattr(exception, 'response', None)
+        status_code = getattr(exception, 'status_code', None) or getattr(response, 'status_code', None)
+
+        retry_after = None
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            retry_after = float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            pass
+
+        return status_code, retry_after
 
 
     def codegeneration_codereval(self, target_instance):
@@ -250,15 +2006,17 @@ class ModelQuerier:
         """
         docstring = target_instance['human_label']
         signature = extract_signature_codereval(target_instance, self.language)
+        max_new_tokens = None
         
         if self.is_gpt:
             prompt = self.prompts["Code Generation ChatGPT"]
             
         else:
             prompt = self.prompts["Code Generation"]
+            from pygments.lexers import JavaLexer
             lexer = JavaLexer()
             target_num_tokens = len(list(lexer.get_tokens(target_instance['code'])))
-            self.max_new_tokens = 2 * target_num_tokens
+            max_new_tokens = 2 * target_num_tokens
             
         prompt = self.replace_tags(
             prompt = prompt,
@@ -267,17 +2025,372 @@ class ModelQuerier:
             description = docstring
             )
         
-        model_output = self.query_model(prompt = prompt)
+        model_output = self.query_model(prompt = prompt, max_new_tokens = max_new_tokens)
         return model_output
         
 
-    def query_model(self, prompt):
-        if self.allocate:
-            return self.query_allocated_model(prompt = prompt)
-        elif self.is_gpt:
-            return self.query_chatgpt(prompt = prompt)
+    def query_model(self, prompt, max_new_tokens = None, prefix_cache = None, stop = None, item = None):
+        """
+            Description of the Function:
+                queries the model through its backend. At most max_inflight requests are sent to the same backend at the same time,
+                so that the method can be called concurrently by several threads.
+
+            Parameters:
+                prompt (str): model input;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens);
+                prefix_cache (dict): key/value cache shared by consecutive calls of a multi-step judgment (used only by allocated models,
+                    see query_allocated_model_with_prefix_cache);
+                stop (callable): predicate telling, from the text generated so far, whether the judgment has already been emitted.
+                    If self.stream is True, the output is streamed and the generation stops as soon as the predicate is true;
+                item (dict): the judged item and the step of the judgment (e.g., the language, the judgment type, the target and the
+                    candidate), which identify the query whatever the wording of the prompt (see ReplayBackend).
+
+            Returns:
+                str: output of the model.
+
+            Raises:
+                QueryFailedError: if the backend cannot be queried (see call_with_retries), or, in replay mode, if the output
+                    is not in the cache (error_class CacheMissError).
+        """
+        stop = stop if self.stream else None
+        # an output cut by a stop predicate differs from the complete one
+        stop_name = {'stop' : stop.__name__} if stop is not None else {}
+        cache_key = self.cache_key(prompt = prompt, max_new_tokens = max_new_tokens, **stop_name)
+        return self.coalesced(cache_key, lambda: self._query_model(prompt, max_new_tokens, prefix_cache, stop, item, cache_key))
+
+
+    def _query_model(self, prompt, max_new_tokens, prefix_cache, stop, item, cache_key):
+        if self.cache is not None:
+            model_output = self.cache.get(cache_key)
+            if model_output is not None:
+                return model_output
+            if self.cache.replay:
+                raise QueryFailedError(
+                    model_name = self.model_name,
+                    backend = self.backend_key(),
+                    error_class = CacheMissError.__name__,
+                    message = f'output not in the cache ({cache_key}).'
+                )
+
+        with self.traced_call(prompt, 'generate') as call:
+            model_output = self.backend.generate(prompt = prompt, max_new_tokens = max_new_tokens, stop = stop, prefix_cache = prefix_cache, item = item)
+            call['output'] = model_output
+
+        if self.cache is not None:
+            self.cache.put(cache_key, self.model_name, model_output)
+        return model_output
+
+
+    @contextmanager
+    def traced_call(self, prompt, operation):
+        """
+            Description of the Function:
+                context manager holding an in-flight slot of the backend for the duration of a call, and recording the telemetry
+                event of the call (if telemetry is enabled). The body stores the output of the call in the yielded dict ('output').
+        """
+        queued_at = time.monotonic()
+        with self.inflight_limit:
+            started_at = time.monotonic()
+            self.call_state.attempts, self.call_state.rate_limit_wait, self.call_state.usage = 1, 0., None
+            call = {}
+            try:
+                yield call
+            except Exception as e:
+                self._record_call(prompt, operation, call, queued_at, started_at, error = e)
+                raise
+            self._record_call(prompt, operation, call, queued_at, started_at)
+
+
+    def _record_call(self, prompt, operation, call, queued_at, started_at, error = None):
+        if self.telemetry is None:
+            return
+        latency = time.monotonic() - started_at
+        usage = self.call_state.usage
+        if usage is not None:
+            prompt_tokens, completion_tokens, tokens_estimated = usage.prompt_tokens, usage.completion_tokens, False
         else:
-            return self.call_huggingface_model(prompt = prompt)
+            prompt_tokens = self.count_tokens(prompt)
+            completion_tokens = call.get('completion_tokens') or self.count_tokens(call.get('output', ''))
+            tokens_estimated = self.tokenizer is None
+        self.telemetry.record(
+            model = self.model_name,
+            backend = self.backend_key(),
+            operation = operation,
+            prompt_tokens = prompt_tokens,
+            completion_tokens = completion_tokens,
+            tokens_estimated = tokens_estimated,
+            queue_wait = started_at - queued_at + self.call_state.rate_limit_wait,
+            latency = latency - self.call_state.rate_limit_wait,
+            attempts = getattr(error, 'attempts', self.call_state.attempts),
+            error_class = None if error is None else getattr(error, 'error_class', type(error).__name__),
+            status_code = getattr(error, 'status_code', None)
+        )
+
+
+    def count_tokens(self, text):
+        # exact with the tokenizer of the model, if loaded, estimated as 4 characters per token otherwise
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens = False))
+        return max(1, len(text) // 4)
+
+
+    def coalesced(self, key, query):
+        """
+            Description of the Function:
+                runs query only if no query with the same key is pending in this process; otherwise waits for the result of that
+                query (or for its exception) and returns it. The query is forgotten as soon as it ends, so that the pending queries
+                do not grow with the run: a later identical one is answered by the response cache (if any) or sent again.
+
+            Parameters:
+                key (str): cache key of the query (see cache_key);
+                query (callable): function sending the query and returning its result.
+
+            Returns:
+                the result of query, or of the identical query sent before.
+        """
+        if not self.coalesce:
+            return query()
+
+        with _COALESCED_QUERIES_LOCK:
+            future = _COALESCED_QUERIES.get(key)
+            sender = future is None
+            if sender:
+                future = _COALESCED_QUERIES[key] = Future()
+            else:
+                self.coalesced_calls += 1
+        if not sender:
+            return future.result()
+
+        try:
+            result = query()
+        except BaseException as e:
+            with _COALESCED_QUERIES_LOCK:
+                del _COALESCED_QUERIES[key]
+            future.set_exception(e)
+            raise
+        # the waiting queries already hold the future
+        with _COALESCED_QUERIES_LOCK:
+            del _COALESCED_QUERIES[key]
+        future.set_result(result)
+        return result
+
+
+    def cache_key(self, prompt, max_new_tokens = None, **extra_parameters):
+        """
+            Description of the Function:
+                returns the address of a query in the response cache, computed from the model, the backend, the prompt as rendered
+                for the backend and the generation parameters.
+
+            Parameters:
+                prompt (str): model input;
+                max_new_tokens (int): maximum number of generated tokens (by default self.max_new_tokens);
+                extra_parameters: any other parameter which changes the output of the query (e.g., the labels scored by score_labels).
+
+            Returns:
+                str: the key of the query.
+        """
+        backend, rendered_prompt, parameters = self.backend.cache_parameters(prompt, max_new_tokens or self.max_new_tokens)
+        parameters.update(extra_parameters)
+        return ResponseCache.make_key(model = self.model_name, backend = backend, prompt = rendered_prompt, parameters = parameters)
+
+
+    def sampling_parameters(self, max_new_tokens = None):
+        # generation parameters of the Hugging Face models, which change their outputs (see cache_key)
+        return {
+            'max_new_tokens' : max_new_tokens or self.max_new_tokens,
+            'temperature' : self.temperature,
+            'top_p' : self.top_p,
+            'do_sample' : self.do_sample,
+            'seed' : 123
+        }
+
+
+    def score_labels(self, prompt, labels, item = None):
+        """
+            Description of the Function:
+                asks the model which of the given labels follows the prompt, without generating free text. The probabilities of the
+                labels are read from the distribution of the next token: an allocated model runs a single forward pass over the prompt,
+                the inference endpoint and the OpenAI API return the log-probabilities of the most likely tokens of the first
+                position at which the model outputs a label. The probabilities are normalized over the labels.
+
+            Parameters:
+                prompt (str): model input, ending right before the label;
+                labels (list of str): the allowed labels (e.g., ['0', '1'] or ['Yes', 'No']);
+                item (dict): the judged item and the step of the judgment (see query_model).
+
+            Returns:
+                str: the most likely label (None if no label is among the most likely tokens returned by the backend);
+                dict: probability of each label.
+        """
+        cache_key = self.cache_key(prompt = prompt, max_new_tokens = 1, labels = labels)
+        return self.coalesced(cache_key, lambda: self._score_labels(prompt, labels, item, cache_key))
+
+
+    def _score_labels(self, prompt, labels, item, cache_key):
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached = json.loads(cached)
+                return cached['label'], cached['distribution']
+            if self.cache.replay:
+                raise QueryFailedError(
+                    model_name = self.model_name,
+                    backend = self.backend_key(),
+                    error_class = CacheMissError.__name__,
+                    message = f'scores not in the cache ({cache_key}).'
+                )
+
+        with self.traced_call(prompt, 'score') as call:
+            probabilities = self.backend.score_labels(prompt, labels, item = item)
+            call['completion_tokens'] = 1 # a single forward pass, or the first generated tokens
+
+        total = sum(probabilities.values())
+        distribution = {label : round(probabilities.get(label, 0.) / total, 4) if total > 0 else 0. for label in labels}
+        label = max(distribution, key = distribution.get) if total > 0 else None
+
+        if self.cache is not None:
+            self.cache.put(cache_key, self.model_name, json.dumps({'label' : label, 'distribution' : distribution}))
+        return label, distribution
+
+
+    @staticmethod
+    def _match_label(token, labels):
+        # returns the label matching a generated token (ignoring case and surrounding white spaces), if any
+        token = token.strip().lower()
+        for label in labels:
+            if token == label.lower():
+                return label
+        return None
+
+
+    def _score_labels_allocated_model(self, prompt, labels):
+        import torch
+        input_ids = self.tokenizer(prompt, return_tensors = 'pt')['input_ids'].to(self.model.device)
+        with self.model_lock, torch.no_grad():
+            logits = self.model(input_ids = input_ids).logits[0, -1].float()
+        log_probabilities = torch.log_softmax(logits, dim = -1)
+
+        # a label may be generated with or without a leading space and with any capitalization
+        probabilities = {}
+        for label in labels:
+            token_ids = set()
+            for variant in {label, label.lower(), label.capitalize(), f' {label}', f' {label.lower()}', f' {label.capitalize()}'}:
+                encoded = self.tokenizer.encode(variant, add_special_tokens = False)
+                if encoded and self._match_label(self.tokenizer.decode(encoded[:1]), [label]):
+                    token_ids.add(encoded[0])
+            probabilities[label] = sum(math.exp(log_probabilities[token_id].item()) for token_id in token_ids)
+        return probabilities
+
+
+    def _score_labels_inference_endpoint(self, prompt, labels):
+        payload = {
+            "inputs": self.apply_chat_template(prompt) if self.prompt_with_template else prompt,
+            "parameters": {
+                "max_new_tokens" : 8,
+                "return_full_text": False,
+                "do_sample": False,
+                "details": True,
+                "top_n_tokens": 5
+            }
+        }
+        with self.route_to_replica() as url:
+            response = self.session.post(url = url, json = payload, timeout = self.request_timeout())
+            response.raise_for_status()
+        details = response.json()[0]['details']
+
+        for generated, top_tokens in zip(details['tokens'], details['top_tokens']):
+            if self._match_label(generated['text'], labels) is None:
+                continue
+            return self._sum_label_probabilities([(token['text'], token['logprob']) for token in top_tokens], labels)
+        return {}
+
+
+    def _score_labels_chatgpt(self, prompt, labels):
+        response = self.openai_client.chat.completions.create(
+            model = self.model_name,
+            messages = [
+                {'role' : 'system', 'content' : f'You are an expert {self.language.capitalize()} developer'},
+                {'role' : 'user', 'content' : prompt}
+            ],
+            temperature = self.temperature,
+            seed = 123,
+            max_tokens = 8,
+            logprobs = True,
+            timeout = self._openai_timeout(),
+            top_logprobs = 20
+        )
+
+        for generated in response.choices[0].logprobs.content:
+            if self._match_label(generated.token, labels) is None:
+                continue
+            return self._sum_label_probabilities([(token.token, token.logprob) for token in generated.top_logprobs], labels)
+        return {}
+
+
+    @classmethod
+    def _sum_label_probabilities(cls, top_tokens, labels):
+        # sums the probabilities of the (token, log-probability) pairs matching each label
+        probabilities = {}
+        for token, logprob in top_tokens:
+            label = cls._match_label(token, labels)
+            if label is not None:
+                probabilities[label] = probabilities.get(label, 0.) + math.exp(logprob)
+        return probabilities
+
+
+    @staticmethod
+    def format_scores(label, distribution):
+        """
+            Description of the Function:
+                formats the result of score_labels as the output of the model: the label on the first line, followed by the probabilities.
+        """
+        return f'{label}\n# Label Probabilities: {json.dumps(distribution)}'
+
+
+    def run_concurrently(self, function, calls, concurrency = 1, progress = None):
+        """
+            Description of the Function:
+                runs function(**kwargs) for each kwargs in calls on an asyncio event loop, with at most concurrency calls in flight.
+                Each call runs in a worker thread as a whole, so multi-step judgments (e.g., slow-thinking pt1 -> pt2) keep their order
+                while different calls overlap.
+
+            Parameters:
+                function (callable): function to run (e.g., self.judge_code_summary);
+                calls (list of dict): keyword arguments of each call;
+                concurrency (int): maximum number of calls running at the same time;
+                progress (tqdm): optional progress bar, updated each time a call ends.
+
+            Returns:
+                list: the values returned by the calls, in the same order as calls.
+        """
+        if concurrency <= 1:
+            results = []
+            for kwargs in calls:
+                results.append(function(**kwargs))
+                if progress is not None:
+                    progress.update(1)
+            return results
+
+        return asyncio.run(self._run_concurrently(function, calls, concurrency, progress))
+
+
+    @staticmethod
+    async def _run_concurrently(function, calls, concurrency, progress):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            async def run(kwargs):
+                async with semaphore:
+                    result = await loop.run_in_executor(executor, lambda: function(**kwargs))
+                if progress is not None:
+                    progress.update(1)
+                return result
+
+            # gather returns the results in the order of the calls, regardless of the order in which they complete
+            return await asyncio.gather(*[run(kwargs) for kwargs in calls])
 
     
     def summarygeneration(self, method):
@@ -325,6 +2438,7 @@ class ModelQuerier:
         """
         description = target_instance['human_label']
         signature = extract_signature_codereval(target_instance, self.language)
+        item = judged_item('code_generation', self.language, judgment_type, rationale = rationale, target_id = target_instance['_id'], generator = generator)
         
         if self.language == 'python':
             candidate = remove_comments_from_python_code(candidate)
@@ -337,7 +2451,8 @@ class ModelQuerier:
                 generator = generator,
                 model_code_dict = model_code_dict,
                 model_output_dict = model_output_dict,
-                model_prompt_dict = model_prompt_dict
+                model_prompt_dict = model_prompt_dict,
+                item = item
             )
 
         elif judgment_type == 'stepbystep':
@@ -348,7 +2463,8 @@ class ModelQuerier:
                 generator = generator,
                 model_code_dict = model_code_dict,
                 model_output_dict = model_output_dict,
-                model_prompt_dict = model_prompt_dict
+                model_prompt_dict = model_prompt_dict,
+                item = item
             )
 
         else:
@@ -361,14 +2477,18 @@ class ModelQuerier:
                 generator = generator,
                 model_code_dict = model_code_dict,
                 model_output_dict = model_output_dict,
-                model_prompt_dict = model_prompt_dict
+                model_prompt_dict = model_prompt_dict,
+                item = item
             )
 
         return model_code_dict, model_output_dict, model_prompt_dict
     
 
 
-    def judge_code_correctness_zeroshot(self, judgment_type, rationale, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict):
+    def judge_code_correctness_zeroshot(self, judgment_type, rationale, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict, item = None):
+        labels = ['0', '1'] if judgment_type == 'bool' else ['1', '2', '3', '4', '5']
+        score = self.score and rationale == 'no'
+        stop = rating_emitted if rationale == 'no' else None # without a rationale, nothing relevant follows the rating
         judgment_type = 'Boolean' if judgment_type == 'bool' else '5-Level'
         rationale = ' No Rationale' if rationale == 'no' else ''
         prompt = self.prompts[f"Judge Code Generation {judgment_type}{rationale}"]
@@ -380,7 +2500,12 @@ class ModelQuerier:
             candidate = candidate
         )
 
-        model_output = self.query_model(prompt = prompt)
+        if score:
+            # the prompt ends with '#': the rating is requested right away, and the most likely label is taken as rating
+            prompt = prompt + ' Rating:'
+            model_output = self.format_scores(*self.score_labels(prompt = prompt, labels = labels, item = judgment_step(item, 1)))
+        else:
+            model_output = self.query_model(prompt = prompt, stop = stop, item = judgment_step(item, 1))
         
         model_code_dict.setdefault(generator, []).append(candidate)
         model_output_dict.setdefault(generator, []).append(model_output)
@@ -389,7 +2514,7 @@ class ModelQuerier:
         return model_code_dict, model_output_dict, model_prompt_dict
 
 
-    def judge_code_correctness_slowthinking(self, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict):
+    def judge_code_correctness_slowthinking(self, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict, item = None):
         prompt_pt1 = self.prompts["Judge Code Generation Slow-Thinking Pt1"]
         prompt_pt1 = self.replace_tags(
             prompt = prompt_pt1,
@@ -400,7 +2525,7 @@ class ModelQuerier:
         )
         
         # first step of the slow-thinking process: ask for an analysis about the correctness of a candidate implementation
-        analysis = self.query_model(prompt = prompt_pt1)
+        analysis = self.query_model(prompt = prompt_pt1, stop = evaluation_ended, item = judgment_step(item, 1))
 
         if 'End of Evaluation' in analysis:
             analysis = analysis.split('End of Evaluation')[0].strip('# ')
@@ -412,10 +2537,11 @@ class ModelQuerier:
         )
 
         # second step of the slow-thinking process: take as input the analysis of the previous step and output "yes" if the analysis describes a correct candidate, and "no" otherwise
-        max_new_tokens = self.max_new_tokens # stores the current value of max_new_tokens
-        self.max_new_tokens = 32 # for the second step of the slow-thinking process, we set max_new_tokens to 128 (the model simply has to reply "yes" or "no")
-        model_output = self.query_model(prompt = prompt_pt2)
-        self.max_new_tokens = max_new_tokens # restore the original value of max_new_tokens
+        # for the second step of the slow-thinking process, we set max_new_tokens to 32 (the model simply has to reply "yes" or "no")
+        if self.score:
+            model_output = self.format_scores(*self.score_labels(prompt = prompt_pt2, labels = ['Yes', 'No'], item = judgment_step(item, 2)))
+        else:
+            model_output = self.query_model(prompt = prompt_pt2, max_new_tokens = 32, stop = verdict_emitted, item = judgment_step(item, 2))
 
         model_code_dict.setdefault(generator, []).append(candidate)
         model_output_dict.setdefault(generator, []).append(f'{model_output}\n\n*************\n\n{analysis}')
@@ -424,7 +2550,7 @@ class ModelQuerier:
         return model_code_dict, model_output_dict, model_prompt_dict
     
     
-    def judge_code_correctness_stepbystep(self, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict):
+    def judge_code_correctness_stepbystep(self, description, signature, candidate, generator, model_code_dict, model_output_dict, model_prompt_dict, item = None):
         prompt_pt1 = self.prompts["Judge Code Generation Step-By-Step Pt1"]
         prompt_pt1 = self.replace_tags(
             prompt = prompt_pt1,
@@ -434,7 +2560,9 @@ class ModelQuerier:
             candidate = candidate
         )
 
-        reasoning = self.query_model(prompt = prompt_pt1)
+        # the prompt of the second step starts with the prompt and the output of the first one: an allocated model reuses their key/value cache
+        prefix_cache = {} if self.allocate and self.reuse_prefix_cache else None
+        reasoning = self.query_model(prompt = prompt_pt1, prefix_cache = prefix_cache, item = judgment_step(item, 1))
 
         prompt_pt2 = self.prompts["Judge Code Generation Step-By-Step Pt2"]
         prompt_pt2 = self.replace_tags(
@@ -443,10 +2571,8 @@ class ModelQuerier:
         )
         prompt_pt2 = prompt_pt1 + prompt_pt2
         
-        max_new_tokens = self.max_new_tokens # stores the current value of max_new_tokens
-        self.max_new_tokens = 128 # for the second step of the slow-thinking process, we set max_new_tokens to 128 (the model simply has to reply "yes" or "no")
-        model_output = self.query_model(prompt = prompt_pt2)
-        self.max_new_tokens = max_new_tokens # restore the original value of max_new_tokens
+        # for the second step of the step-by-step process, we set max_new_tokens to 128 (the model simply has to reply "yes" or "no")
+        model_output = self.query_model(prompt = prompt_pt2, max_new_tokens = 128, prefix_cache = prefix_cache, stop = verdict_emitted, item = judgment_step(item, 2))
 
         model_code_dict.setdefault(generator, []).append(candidate)
         model_output_dict.setdefault(generator, []).append(f'{model_output}\n\n*************\n\n{reasoning}')
@@ -455,7 +2581,7 @@ class ModelQuerier:
         return model_code_dict, model_output_dict, model_prompt_dict
     
     
-    def judge_summary_quality_stepbystep(self, method, summary, judgment_type):
+    def judge_summary_quality_stepbystep(self, method, summary, judgment_type, item = None):
         prompt_pt1 = self.prompts["Judge Code Summarization Step-By-Step Pt1"]
         prompt_pt1 = self.replace_tags(
             prompt = prompt_pt1,
@@ -464,7 +2590,9 @@ class ModelQuerier:
             comment = summary
         )
 
-        reasoning = self.query_model(prompt = prompt_pt1)
+        # the prompt of the second step starts with the prompt and the output of the first one: an allocated model reuses their key/value cache
+        prefix_cache = {} if self.allocate and self.reuse_prefix_cache else None
+        reasoning = self.query_model(prompt = prompt_pt1, prefix_cache = prefix_cache, item = judgment_step(item, 1))
 
         prompt_pt2 = self.prompts["Judge Code Summarization With Instructions Step-By-Step Pt2"] if 'extended_instructions' in judgment_type\
             else self.prompts["Judge Code Summarization Step-By-Step Pt2"]
@@ -474,10 +2602,8 @@ class ModelQuerier:
         )
         prompt_pt2 = prompt_pt1 + prompt_pt2
         
-        max_new_tokens = self.max_new_tokens # stores the current value of max_new_tokens
-        self.max_new_tokens = 128 # for the second step of the slow-thinking process, we set max_new_tokens to 128 (the model simply has to reply "yes" or "no")
-        model_output = self.query_model(prompt = prompt_pt2)
-        self.max_new_tokens = max_new_tokens # restore the original value of max_new_tokens
+        # for the second step of the step-by-step process, we set max_new_tokens to 128 (the model simply has to rate the three criteria)
+        model_output = self.query_model(prompt = prompt_pt2, max_new_tokens = 128, prefix_cache = prefix_cache, stop = summary_ratings_emitted, item = judgment_step(item, 2))
 
         model_output = f'{model_output}\n\n*************\n\n{reasoning}'
         prompt = f'{prompt_pt2}\n\n*************\n\n{prompt_pt1}'
@@ -485,7 +2611,7 @@ class ModelQuerier:
         return prompt, model_output
 
 
-    def judge_summary_quality_zeroshot(self, method, summary, judgment_type):
+    def judge_summary_quality_zeroshot(self, method, summary, judgment_type, item = None):
         prompt = self.prompts["Judge Code Summarization With Instructions"] if judgment_type == 'extended_instructions' \
             else self.prompts["Judge Code Summarization"]
         prompt = self.replace_tags(
@@ -500,7 +2626,7 @@ class ModelQuerier:
         else:
             prompt = prompt + '#'
         
-        model_output = self.query_model(prompt = prompt)
+        model_output = self.query_model(prompt = prompt, stop = summary_ratings_emitted, item = judgment_step(item, 1))
 
         return prompt, model_output
 
@@ -520,19 +2646,22 @@ class ModelQuerier:
                 str: prompt given to the model;
                 str: output of the model.
         """
+        item = judged_item('code_summarization', self.language, judgment_type, method = method, summary = summary)
 
         if 'stepbystep' in judgment_type:
             prompt, model_output = self.judge_summary_quality_stepbystep(
                 method = method,
                 summary = summary,
-                judgment_type = judgment_type
+                judgment_type = judgment_type,
+                item = item
             )
         
         else:
             prompt, model_output = self.judge_summary_quality_zeroshot(
                 method = method,
                 summary = summary,
-                judgment_type = judgment_type
+                judgment_type = judgment_type,
+                item = item
             )
 
         return prompt, model_output
\ No newline at end of file
@@ -1,9 +1,98 @@
+import io
+import os
+import glob
 import json
 import pandas as pd
-from datetime import datetime
 import numpy as np
 import lizard
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+
+# placeholders of the quotes, which lizard would take as the delimiters of strings, in the order in which they are replaced:
+# the quoted brackets come before the single quotes
+_QUOTE_PLACEHOLDERS = {
+    "\"(\"" : "<DOUBLE_QUOTE_OPENING_ROUND>",
+    "\")\"" : "<DOUBLE_QUOTE_CLOSING_ROUND>",
+    "\"[\"" : "<DOUBLE_QUOTE_OPENING_SQUARE>",
+    "\"]\"" : "<DOUBLE_QUOTE_CLOSING_SQUARE>",
+    "\"{\"" : "<DOUBLE_QUOTE_OPENING_CURLY>",
+    "\"}\"" : "<DOUBLE_QUOTE_CLOSING_CURLY>",
+    "'('" : "<SINGLE_QUOTE_OPENING_ROUND>",
+    "')'" : "<SINGLE_QUOTE_CLOSING_ROUND>",
+    "'['" : "<SINGLE_QUOTE_OPENING_SQUARE>",
+    "']'" : "<SINGLE_QUOTE_CLOSING_SQUARE>",
+    "'{'" : "<SINGLE_QUOTE_OPENING_CURLY>",
+    "'}'" : "<SINGLE_QUOTE_CLOSING_CURLY>",
+    "'" : "<SINGLE_QUOTE>",
+    "\"" : "<DOUBLE_QUOTE>"
+}
+_QUOTES = {placeholder : quote for quote, placeholder in _QUOTE_PLACEHOLDERS.items()}
+# position of each quoted bracket in the table: it decides which of two overlapping quoted brackets is replaced
+_QUOTED_BRACKETS = {quote : priority for priority, quote in enumerate(quote for quote in _QUOTE_PLACEHOLDERS if len(quote) > 1)}
+# quoted brackets of the same quote overlap when they follow one another (e.g. '")"("'): each match of the regex is a run of
+# overlapping quoted brackets (most often a single one), so a single pass of the regex finds all of them
+_QUOTED_BRACKETS_REGEX = re.compile(r'"(?:[()\[\]{}]")+|\'(?:[()\[\]{}]\')+')
+# the placeholders cannot overlap, so they can be decoded in any order: the ones of the quoted brackets in a single pass of the
+# alternation, the ones of the quotes with two str.replace
+_QUOTED_BRACKET_PLACEHOLDERS_REGEX = re.compile('|'.join(re.escape(_QUOTE_PLACEHOLDERS[quote]) for quote in _QUOTED_BRACKETS))
+
+def _to_placeholders(match):
+    run = match.group(0)
+    if len(run) == 3:
+        return _QUOTE_PLACEHOLDERS[run]
+
+    # the overlapping quoted brackets of the run are replaced as the replaces in the order of the table would: by position
+    # in the table, then from left to right, skipping the ones which overlap a quoted bracket already replaced
+    replaced = set()
+    for i in sorted(range(len(run) // 2), key = lambda i: (_QUOTED_BRACKETS[run[2 * i : 2 * i + 3]], i)):
+        if i - 1 not in replaced and i + 1 not in replaced:
+            replaced.add(i)
+
+    pieces, position = [], 0
+    while position < len(run):
+        if position % 2 == 0 and position // 2 in replaced:
+            pieces.append(_QUOTE_PLACEHOLDERS[run[position : position + 3]])
+            position += 3
+        else:
+            pieces.append(run[position])
+            position += 1
+    return ''.join(pieces)
+
+def _to_quote(match):
+    return _QUOTES[match.group(0)]
+
+# extractor of the worker processes of extract_predicted_methods, created once per process
+_WORKER_EXTRACTOR = None
+
+def _init_extraction_worker(debug_mode):
+    global _WORKER_EXTRACTOR
+    _WORKER_EXTRACTOR = ResultExtractor(debug_mode)
+
+def _extract_method_worker(item, extractor = None):
+    # returns (method, error): the error of an item is returned, so that it does not stop the whole batch
+    model_output, file_extention, gpt_flag, hat, method_index = item
+    extractor = extractor or _WORKER_EXTRACTOR
+    try:
+        return str(extractor.extract_predicted_method_from_output(model_output, file_extention, gpt_flag = gpt_flag, hat = hat, method_index = method_index)), None
+    except Exception as e:
+        return '', f'{type(e).__name__}: {e}'
+
+def _remove_assert_worker(method_implementation, extractor = None):
+    # returns (method, error) of a method of MultiPL-E
+    extractor = extractor or _WORKER_EXTRACTOR
+    try:
+        return extractor.remove_assert_from_java_method(method_implementation), None
+    except Exception as e:
+        return method_implementation, f'{type(e).__name__}: {e}'
+
+def _multiple_test_output_worker(file_path, extractor = None):
+    # returns (results, error) of a test output of MultiPL-E
+    extractor = extractor or _WORKER_EXTRACTOR
+    try:
+        return extractor.extract_results_from_multiple_test_output(file_path), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
 
 class ResultExtractor:
     def __init__(self, debug_mode='../'):
@@ -15,6 +104,7 @@ class ResultExtractor:
             "Authorization": f"Bearer {self.constants['Hugging Face Inference Endpoints Token']}",
             "Content-Type": "application/json"
         }
+        self.prediction_indexes = {} # path of a predictions file -> (size and modification time of the file, {_id : [byte offsets of its lines]})
 
     @staticmethod
     def _load_json(file_path : str):
@@ -52,38 +142,22 @@ class ResultExtractor:
             return model_name
     
     @staticmethod
-    def _replace_quotes_with_placeholders(input_string : str):
-        return input_string.replace("\"(\"", "<DOUBLE_QUOTE_OPENING_ROUND>")\
-                        .replace("\")\"", "<DOUBLE_QUOTE_CLOSING_ROUND>")\
-                        .replace("\"[\"", "<DOUBLE_QUOTE_OPENING_SQUARE>")\
-                        .replace("\"]\"", "<DOUBLE_QUOTE_CLOSING_SQUARE>")\
-                        .replace("\"{\"", "<DOUBLE_QUOTE_OPENING_CURLY>")\
-                        .replace("\"}\"", "<DOUBLE_QUOTE_CLOSING_CURLY>")\
-                        .replace("'('", "<SINGLE_QUOTE_OPENING_ROUND>")\
-                        .replace("')'", "<SINGLE_QUOTE_CLOSING_ROUND>")\
-                        .replace("'['", "<SINGLE_QUOTE_OPENING_SQUARE>")\
-                        .replace("']'", "<SINGLE_QUOTE_CLOSING_SQUARE>")\
-                        .replace("'{'", "<SINGLE_QUOTE_OPENING_CURLY>")\
-                        .replace("'}'", "<SINGLE_QUOTE_CLOSING_CURLY>")\
-                        .replace("'", "<SINGLE_QUOTE>")\
-                        .replace("\"", "<DOUBLE_QUOTE>")
+    def _replace_quotes_with_placeholders(input_string):
+        # input_string can be a string or a pandas Series of strings (converted one by one). The quoted brackets are replaced
+        # in a single pass of _QUOTED_BRACKETS_REGEX, the remaining quotes with two str.replace (faster than a regex or
+        # str.translate, since quotes are frequent); the result is the one of the replaces in the order of _QUOTE_PLACEHOLDERS
+        if isinstance(input_string, pd.Series):
+            return input_string.map(ResultExtractor._replace_quotes_with_placeholders, na_action = 'ignore')
+        input_string = _QUOTED_BRACKETS_REGEX.sub(_to_placeholders, input_string)
+        return input_string.replace("'", "<SINGLE_QUOTE>").replace("\"", "<DOUBLE_QUOTE>")
     
     @staticmethod
-    def _replace_placeholders_with_quotes(input_string : str):
-        return input_string.replace("<DOUBLE_QUOTE_OPENING_ROUND>", "\"(\"")\
-                .replace("<DOUBLE_QUOTE_CLOSING_ROUND>", "\")\"")\
-                .replace("<DOUBLE_QUOTE_OPENING_SQUARE>", "\"[\"")\
-                .replace("<DOUBLE_QUOTE_CLOSING_SQUARE>", "\"]\"")\
-                .replace("<DOUBLE_QUOTE_OPENING_CURLY>", "\"{\"")\
-                .replace("<DOUBLE_QUOTE_CLOSING_CURLY>", "\"}\"")\
-                .replace("<SINGLE_QUOTE_OPENING_ROUND>", "'('")\
-                .replace("<SINGLE_QUOTE_CLOSING_ROUND>", "')'")\
-                .replace("<SINGLE_QUOTE_OPENING_SQUARE>", "'['")\
-                .replace("<SINGLE_QUOTE_CLOSING_SQUARE>", "']'")\
-                .replace("<SINGLE_QUOTE_OPENING_CURLY>", "'{'")\
-                .replace("<SINGLE_QUOTE_CLOSING_CURLY>", "'}'")\
-                .replace("<SINGLE_QUOTE>", "'")\
-                .replace("<DOUBLE_QUOTE>", "\"")
+    def _replace_placeholders_with_quotes(input_string):
+        if isinstance(input_string, pd.Series):
+            return input_string.map(ResultExtractor._replace_placeholders_with_quotes, na_action = 'ignore')
+        if '_QUOTE_' in input_string: # the placeholder of a quoted bracket
+            input_string = _QUOTED_BRACKET_PLACEHOLDERS_REGEX.sub(_to_quote, input_string)
+        return input_string.replace("<SINGLE_QUOTE>", "'").replace("<DOUBLE_QUOTE>", "\"")
     
     @staticmethod
     def _extract_docstring_from_multiple_test_output(row):
@@ -102,19 +176,20 @@ class ResultExtractor:
     
     
     @staticmethod
-    def _search_java_function(file_path : str):
+    def _search_java_function(file_path : str, source_code = None):
         """
         Description of the Function:
             returns the Start line and End line of all the java methods found in a given input file.
 
         Parameters:
-            file_path (str): path to the file to read.
+            file_path (str): path to the file to read (its extension selects the language);
+            source_code (str): optional content of the file, when given the file is not read (and does not need to exist).
 
         Returns:
             list of lists [N x 3]: for each java method found, it returns a list containing the Name of the method, the Start line and the End line of the method.
     """
         
-        liz = lizard.analyze_file(file_path)
+        liz = lizard.analyze_file(file_path) if source_code is None else lizard.analyze_file.analyze_source_code(file_path, source_code)
         functions_info = []
         for liz_elem in liz.function_list:
             functions_info.append([liz_elem.long_name, liz_elem.start_line, liz_elem.end_line])
@@ -122,30 +197,63 @@ class ResultExtractor:
         return functions_info
 
     
-    def extract_method_from_multiple_test_output(self, row):
+    @staticmethod
+    def _extract_method_from_program(program : str, signature : str):
         # return as method what is in between the signature (included) and the last occurrence of the end_pattern (the beginning of tests automatically added by multiple)
-        start_pattern = row['signature']
+        # the first occurrence of the signature and the last one of the end_pattern are found with a linear scan each
         end_pattern = "public static void main(String[] args) {"
 
-        regex = re.compile(f"({re.escape(start_pattern)}.*)(?={re.escape(end_pattern)}(?!.*{re.escape(end_pattern)}))", re.DOTALL)
-        match = regex.search(row['program'])
-
-        if match:
-            method = match.group(1).strip()
-            return method
-        else:
+        end = program.rfind(end_pattern)
+        start = program.find(signature)
+        if end == -1 or start == -1 or start + len(signature) > end:
             return ''
+        return program[start : end].strip()
+
+
+    def extract_method_from_multiple_test_output(self, row):
+        return self._extract_method_from_program(row['program'], row['signature'])
     
     
+    @staticmethod
+    def _build_prediction_source(model_output, file_extention, gpt_flag = False, hat = ''):
+        """
+        Description of the Function:
+            returns the lines of the source file made of the hat followed by the model output (the quotes must already be
+            replaced with placeholders). The lines are the ones that would be read back from the file written with this content.
+
+        Parameters:
+            model_output (str): output of the model;
+            file_extention (str): extension of the file ('java' or 'py');
+            gpt_flag (bool): True if the output comes from a GPT model;
+            hat (str): optional "hat" to prepend to the model output.
+
+        Returns:
+            list: the lines of the source file, each one ending with a newline.
+        """
+        source = hat
+        source += '\n' if model_output[0] != '\n' else '' # models are expected to continue writing the function starting from the signature, so the first char must be a newline
+        source += '    ' if file_extention == 'py' and not gpt_flag else '' # if the target is a python method the first line after the signature is indentated
+
+        # special attention to methods with annotation
+        was_hat = True if len(hat) > 0 and hat[0] == '@' else False
+        for line in model_output.split('\n'):
+            source += '{}\n'.format(line.strip(' ')) if was_hat else f'{line}\n' # the line following the one of the annotation is stripped
+            was_hat = True if len(line) > 0 and line [0] == '@' else False
+
+        # universal newlines, as when the source is read from a file opened in text mode
+        return io.StringIO(source, newline = None).readlines()
+
+
     def extract_predicted_method_from_output(self, model_output, file_extention, gpt_flag = False, hat = '', method_index = 0, tempfile_name = 'tempFile'):
         """
         Description of the Function:
-            returns all the methods found in the output of a model.
+            returns all the methods found in the output of a model. The output is parsed in memory, no file is written.
 
         Parameters:
             model_output (str): output of the model in which to search for java methods;
             hat (str): optional "hat" to prepend to the model output;
-            method_index (int or array): index of the method that wants to be extracted (ie, if [0,1] the first and the second method are extracted).
+            method_index (int or array): index of the method that wants to be extracted (ie, if [0,1] the first and the second method are extracted);
+            tempfile_name (str): unused, kept for the callers which still pass it.
 
         Returns:
             list: list of the java methods extracted. If no java methods are present in the model output, an empty list is returned.
@@ -157,44 +265,26 @@ class ResultExtractor:
             return '' #if multiple else methods_found
         
         model_output = self._replace_quotes_with_placeholders(model_output)
+        lines = self._build_prediction_source(model_output, file_extention, gpt_flag = gpt_flag, hat = hat)
 
-        # write the model output to a .java/.py file
-        prediction_file = '{0}data/temp/{1}{2}.{3}'.format(self.debug_mode, tempfile_name.split('/')[-1], datetime.now(), file_extention)
-        with open(prediction_file, 'w') as w:
-            w.write(hat)
-            w.write('\n') if model_output[0] != '\n' else w.write('') # models are expected to continue writing the function starting from the signature, so the first char must be a newline
-            w.write('    ') if file_extention == 'py' and not gpt_flag else w.write('') # if the target is a python method the first line after the signature is indentated
-            
-            # special attention to methods with annotation
-            was_hat = True if len(hat) > 0 and hat[0] == '@' else False
-            for line in model_output.split('\n'):
-                w.write('{}\n'.format(line.strip(' '))) if was_hat else w.write(f'{line}\n') # the line following the one of the annotation is stripped
-                was_hat = True if len(line) > 0 and line [0] == '@' else False
-
-        w.close()
-
-        listMethods = self._search_java_function(prediction_file) # run the parser on the written file
+        listMethods = self._search_java_function(f'prediction.{file_extention}', source_code = ''.join(lines)) # run the parser on the source
         
-        with open(prediction_file, 'r') as r:
-            # loop over the methods that were found by the parser
-            for method in listMethods:
-                methodStartLine, methodEndLine = int(method[1]) - 1, int(method[2]) - 1
-                method_to_append = ''
-                r.seek(0)
-                for i, line in enumerate(r):
-                    line = self._replace_placeholders_with_quotes(line)
-                    
-                    # check the line before the start line of the method
-                    if i == methodStartLine - 1 and len(line.strip('\n\t \"\'')) > 0 and line.strip('\n\t \"\'')[0] == '@': #if the line before the method signature there is an annotation
-                        annotation = line.strip('\n')
-                        method_to_append += f'{annotation}\n' if file_extention == 'py' else f'{annotation} '
-                        
-                    # append the lines of the method
-                    if i >= methodStartLine and i <= methodEndLine:
-                        method_to_append += f'{line}'
-                
-                methods_found.append(method_to_append.strip('\n\t \"\''))
-        r.close()
+        # loop over the methods that were found by the parser, slicing their lines
+        for method in listMethods:
+            methodStartLine, methodEndLine = int(method[1]) - 1, int(method[2]) - 1
+            method_to_append = ''
+
+            # check the line before the start line of the method
+            if methodStartLine >= 1:
+                line = self._replace_placeholders_with_quotes(lines[methodStartLine - 1])
+                if len(line.strip('\n\t \"\'')) > 0 and line.strip('\n\t \"\'')[0] == '@': #if the line before the method signature there is an annotation
+                    annotation = line.strip('\n')
+                    method_to_append += f'{annotation}\n' if file_extention == 'py' else f'{annotation} '
+
+            # append the lines of the method
+            method_to_append += self._replace_placeholders_with_quotes(''.join(lines[methodStartLine : methodEndLine + 1]))
+
+            methods_found.append(method_to_append.strip('\n\t \"\''))
             
         methods_found = np.array(methods_found)
 
@@ -211,6 +301,59 @@ class ResultExtractor:
                 return '' #if multiple else methods_found
 
 
+    def _map_in_processes(self, worker, items, workers = None, chunksize = 16):
+        # applies worker to the items across a pool of processes (each one with its own extractor), in the order of the items
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(items) <= chunksize:
+            # not worth starting the processes
+            return [worker(item, self) for item in items]
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_extraction_worker, initargs = (self.debug_mode,)) as executor:
+            return list(executor.map(worker, items, chunksize = chunksize))
+
+
+    def extract_predicted_methods(self, model_outputs, file_extention, gpt_flag = False, hats = None, method_index = 0, workers = None, chunksize = 16):
+        """
+        Description of the Function:
+            extracts the predicted method from each one of a batch of model outputs (as extract_predicted_method_from_output),
+            parsing the outputs across a pool of processes. The results are in the order of the outputs; the error raised by
+            an output is recorded with its result instead of stopping the batch.
+
+        Parameters:
+            model_outputs (list or pandas.DataFrame): outputs of the model, or a dataframe with a 'model_output' column
+                (and optionally a 'hat' column);
+            file_extention (str): extension of the source files ('java' or 'py');
+            gpt_flag (bool): True if the outputs come from a GPT model;
+            hats (list): optional "hat" to prepend to each output (overrides the 'hat' column of the dataframe);
+            method_index (int): index of the method to extract from each output;
+            workers (int): number of processes (None for one per CPU, 1 to extract in this process);
+            chunksize (int): number of outputs sent to a process at a time.
+
+        Returns:
+            pandas.DataFrame: dataframe with the index of model_outputs and the following columns
+                -> predicted_method (str): the method extracted from the output ('' if none was found or the extraction failed);
+                -> error (str): the error raised by the extraction ('ErrorClass: message'), None if the extraction succeeded.
+        """
+        if isinstance(model_outputs, pd.DataFrame):
+            index = model_outputs.index
+            if hats is None and 'hat' in model_outputs.columns:
+                hats = model_outputs['hat'].fillna('').tolist()
+            model_outputs = model_outputs['model_output'].fillna('').tolist()
+        else:
+            model_outputs = list(model_outputs)
+            index = pd.RangeIndex(len(model_outputs))
+        hats = [''] * len(model_outputs) if hats is None else list(hats)
+        assert len(hats) == len(model_outputs), "there must be a hat for each model output."
+
+        items = [(model_output, file_extention, gpt_flag, hat, method_index) for model_output, hat in zip(model_outputs, hats)]
+        results = self._map_in_processes(_extract_method_worker, items, workers = workers, chunksize = chunksize)
+
+        methods, errors = zip(*results) if results else ((), ())
+        return pd.DataFrame({
+            'predicted_method' : pd.Series(methods, index = index, dtype = object),
+            'error' : pd.Series(errors, index = index, dtype = object) # object, so that the missing errors stay None
+            })
+
+
     def extract_results_from_multiple_test_output(self, file_path):
         """
         Description of the Function:
@@ -242,13 +385,91 @@ class ResultExtractor:
         test_output_df['target_id'] = test_output_list['name']
         test_output_df['generated_by'] = self._extract_generatedby_from_multiple_filename(input_path)
         test_output_df['signature'] = test_output_list['prompt'].split('\n')[-2].strip()
-        test_output_df['method'] = test_output_df.apply(self.extract_method_from_multiple_test_output, axis = 1)
+        test_output_df['method'] = [self._extract_method_from_program(program, signature) for program, signature in zip(test_output_df['program'], test_output_df['signature'])]
         # test_output_df['method'] = test_output_df['program'].apply(lambda x : x)
         test_output_df['description'] = test_output_df.apply(self._extract_docstring_from_multiple_test_output, axis = 1)
 
         return test_output_df[['dataset', 'target_id', 'description', 'signature', 'method', 'generated_by', 'exit_code']]
     
 
+    def iter_ispass_from_codereval_test_output(self, file_path, chunk_rows = 100000):
+        """
+        Description of the Function:
+            streams the files produced by the test suites of the CoderEval dataset: the lines are parsed one at a time into
+            columnar buffers, which are turned into a dataframe (one row per candidate) every chunk_rows candidates. Only a chunk
+            is kept in memory, whatever the size of the file. The candidates of a target may be split between two chunks.
+
+        Parameters:
+            file_path (str): .jsonl file containing the output of the tests;
+            chunk_rows (int): number of candidates in each dataframe (the last one may have fewer).
+
+        Returns:
+            generator of DataFrames with the columns of extract_ispass_from_codereval_test_output.
+        """
+        def to_dataframe(ids, counts, generated_code, is_pass):
+            # one row per candidate: the ids are repeated as many times as the candidates of their target
+            return pd.DataFrame({
+                'target_id': np.repeat(np.array(ids, dtype = object), counts),
+                'generated_code': generated_code,
+                'is_pass': is_pass
+                })
+
+        ids, counts, generated_code, is_pass = [], [], [], []
+        with open(file_path, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                json_obj = json.loads(line)
+                results = json_obj['generate_results']
+                start = 0
+                while True:
+                    # the candidates of the target which still fit in the chunk
+                    end = start + min(len(results) - start, chunk_rows - len(generated_code))
+                    ids.append(json_obj['_id'])
+                    counts.append(end - start)
+                    generated_code.extend(result['generate_code'] for result in results[start : end])
+                    is_pass.extend(result['is_pass'] for result in results[start : end])
+                    start = end
+
+                    if len(generated_code) == chunk_rows:
+                        yield to_dataframe(ids, counts, generated_code, is_pass)
+                        ids, counts, generated_code, is_pass = [], [], [], []
+                    if start == len(results):
+                        break
+
+        if generated_code:
+            yield to_dataframe(ids, counts, generated_code, is_pass)
+
+
+    def extract_results_from_multiple_test_outputs(self, root_path, pattern = '**/*.results.json', workers = None):
+        """
+        Description of the Function:
+            parses all the files produced by the test suites of the MultiPL-E dataset under a folder (as
+            extract_results_from_multiple_test_output), across a pool of processes, and returns a single dataframe.
+            The files which cannot be parsed are reported and skipped.
+
+        Parameters:
+            root_path (str): folder with the results of MultiPL-E (one subfolder per dataset, language and generator);
+            pattern (str): glob pattern, relative to root_path, of the files to parse;
+            workers (int): number of processes (None for one per CPU, 1 to parse in this process).
+
+        Returns:
+            DataFrame with the columns of extract_results_from_multiple_test_output, the rows of the files in the order of their paths.
+        """
+        file_paths = sorted(glob.glob(os.path.join(root_path, pattern), recursive = True))
+        results = self._map_in_processes(_multiple_test_output_worker, file_paths, workers = workers, chunksize = 1)
+
+        test_output_dfs = []
+        for file_path, (test_output_df, error) in zip(file_paths, results):
+            if error:
+                print(f'Skipping {file_path}: {error}')
+            else:
+                test_output_dfs.append(test_output_df)
+
+        columns = ['dataset', 'target_id', 'description', 'signature', 'method', 'generated_by', 'exit_code']
+        return pd.concat(test_output_dfs, ignore_index = True) if test_output_dfs else pd.DataFrame(columns = columns)
+    
+
     def extract_ispass_from_codereval_test_output(self, file_path):
         """
         Description of the Function:
@@ -263,25 +484,48 @@ class ResultExtractor:
                 -> generated_code (str): the candidate implementation automatically generated;
                 -> is_pass (int): 0 if the candidate is wrong (ie, fails the tests) or 1 if it is correct.
         """
-        data = self._load_json(file_path)
-        df = pd.DataFrame(data)
-        method_id = [df._id.iloc[i] for i in range(df.shape[0]) for _ in range(len(df.generate_results.iloc[i]))]
-        is_pass = [df.generate_results.iloc[i][j]['is_pass'] for i in range(df.shape[0]) for j in range(len(df.generate_results.iloc[i]))]
-        generated_code = [df.generate_results.iloc[i][j]['generate_code'] for i in range(df.shape[0]) for j in range(len(df.generate_results.iloc[i]))]
-
-        return pd.DataFrame({
-            'target_id': method_id,
-            'generated_code': generated_code,
-            'is_pass': is_pass
-            })
+        chunks = list(self.iter_ispass_from_codereval_test_output(file_path))
+        if not chunks:
+            return pd.DataFrame({'target_id': [], 'generated_code': [], 'is_pass': []})
+        return pd.concat(chunks, ignore_index = True) if len(chunks) > 1 else chunks[0]
     
     
+    def _index_predictions(self, file_path):
+        """
+        Description of the Function:
+            returns the byte offset of the lines of each target id of a jsonl file of predictions. The index is built by reading
+            the file once and is rebuilt only when the file changes.
+
+        Parameters:
+            file_path (str): path to the jsonl file which contains a set of predictions of the CoderEval dataset.
+
+        Returns:
+            dict: target id -> list of the byte offsets of its lines, in the order of the file.
+        """
+        stat = os.stat(file_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if file_path in self.prediction_indexes and self.prediction_indexes[file_path][0] == signature:
+            return self.prediction_indexes[file_path][1]
+
+        index = {}
+        with open(file_path, 'rb') as file:
+            offset = 0
+            for line in file:
+                if line.strip():
+                    index.setdefault(json.loads(line)['_id'], []).append(offset)
+                offset += len(line)
+
+        self.prediction_indexes[file_path] = (signature, index)
+        return index
+
+
     def extract_predictions_for_codereval(self, file_path, batch_ids = None):
         """
         Description of the Function:
             given a path to a jsonl file containing predictions of the CoderEval dataset, 
             it returns a dataframe containing the target_id and the candidate implementation. 
-            It only returns the instances specified in the batch_ids list.
+            It only returns the instances specified in the batch_ids list, which are read by seeking to their lines
+            (the offsets of the lines are indexed the first time the file is read).
             This function handles the case in which to each target was associated only one candidate (beam = 1).
 
         Parameters:
@@ -294,16 +538,26 @@ class ResultExtractor:
                 -> generated_code (str): a candidate function;
     """
         results = {}
-        with open(file_path, 'r') as file:
-            for line in file:
-                json_obj = json.loads(line)
-                tid = json_obj['_id']
-                if batch_ids and tid not in batch_ids:
-                    continue
-                results.setdefault('target_id', []).append(tid)
-                results.setdefault('generated_code', [])
-                results['generated_code'].append(json_obj['generate_results'][0]) \
-                    if len(json_obj['generate_results']) > 0 else results['generated_code'].append('')
+        if batch_ids:
+            index = self._index_predictions(file_path)
+            # the lines of the batch, in the order of the file
+            offsets = sorted(offset for tid in set(batch_ids) for offset in index.get(tid, []))
+            with open(file_path, 'rb') as file:
+                lines = []
+                for offset in offsets:
+                    file.seek(offset)
+                    lines.append(file.readline())
+        else:
+            with open(file_path, 'r') as file:
+                lines = file.readlines()
+
+        for line in lines:
+            json_obj = json.loads(line)
+            tid = json_obj['_id']
+            results.setdefault('target_id', []).append(tid)
+            results.setdefault('generated_code', [])
+            results['generated_code'].append(json_obj['generate_results'][0]) \
+                if len(json_obj['generate_results']) > 0 else results['generated_code'].append('')
 
         return pd.DataFrame(results)
 
@@ -313,39 +567,65 @@ class ResultExtractor:
 
 
     def remove_assert_from_java_method(self, method_implementation):
+        """
+        Description of the Function:
+            removes the internal main function (where MultiPL-E puts the asserts of the tests) from a java method. The method
+            is parsed in memory, so the function can run in several threads or processes at the same time.
+
+        Parameters:
+            method_implementation (str): implementation of the java method.
 
-        # write the original implementation from the second line to the second to last
-        with open('/home/giuseppe/law_school/data/temp/wo_first_last.java', 'w') as w:
-            original_lines = method_implementation.splitlines()
-            for line in original_lines[1:-1]:
-                line = self._replace_quotes_with_placeholders(line)
-                w.write(f'{line}\n')
-        w.close()
+        Returns:
+            str: the implementation without the internal main function (the implementation as it is if there is none).
+        """
+        # the original implementation from the second line to the second to last
+        original_lines = method_implementation.splitlines()
+        inner_lines = [self._replace_quotes_with_placeholders(line) for line in original_lines[1:-1]]
 
         # look for internal java methods
-        method_list = self._search_java_function('/home/giuseppe/law_school/data/temp/wo_first_last.java')
+        method_list = self._search_java_function('wo_first_last.java', source_code = ''.join(f'{line}\n' for line in inner_lines))
 
         found_assert = False
         for method in method_list:
             start_line, end_line = int(method[1]) - 1, int(method[2]) - 1
-            with open('/home/giuseppe/law_school/data/temp/wo_first_last.java', 'r') as r:
-                for line_number, line in enumerate(r):
-                    if line_number == start_line:
-                        line = self._replace_placeholders_with_quotes(line)
-
-                        if line.strip().startswith('public static void main'): # if finds an internal main function
-                            found_assert = True
-                            break
-            r.close()
-        
+            if start_line < len(inner_lines) and self._replace_placeholders_with_quotes(inner_lines[start_line]).strip().startswith('public static void main'): # if finds an internal main function
+                found_assert = True
+
         if not found_assert:
             return method_implementation
 
-        # retrieves all the lines but the ones of the internal main function
+        # retrieves all the lines but the ones of the internal main function (the span of the last internal method found)
         lines_toretrieve = []
         for iline, line in enumerate(original_lines):
-            if not iline in np.arange(start_line + 1, end_line + 2):
+            if not start_line + 1 <= iline <= end_line + 1:
                 lines_toretrieve.append(line)
         
         return '\n'.join(lines_toretrieve)
-    
\ No newline at end of file
+
+
+    def remove_assert_from_java_methods(self, method_implementations, workers = None, chunksize = 16):
+        """
+        Description of the Function:
+            removes the internal main function from each one of a batch of java methods (as remove_assert_from_java_method),
+            across a pool of processes. The results are in the order of the methods; the error raised by a method is recorded
+            with its result instead of stopping the batch.
+
+        Parameters:
+            method_implementations (list or pandas.Series): implementations of the java methods (e.g., the 'method' column of
+                extract_results_from_multiple_test_outputs);
+            workers (int): number of processes (None for one per CPU, 1 to work in this process);
+            chunksize (int): number of methods sent to a process at a time.
+
+        Returns:
+            pandas.DataFrame: dataframe with the index of method_implementations and the following columns
+                -> method (str): the implementation without the internal main function (the original one if the removal failed);
+                -> error (str): the error raised by the removal ('ErrorClass: message'), None if the removal succeeded.
+        """
+        index = method_implementations.index if isinstance(method_implementations, pd.Series) else pd.RangeIndex(len(method_implementations))
+        results = self._map_in_processes(_remove_assert_worker, list(method_implementations), workers = workers, chunksize = chunksize)
+
+        methods, errors = zip(*results) if results else ((), ())
+        return pd.DataFrame({
+            'method' : pd.Series(methods, index = index, dtype = object),
+            'error' : pd.Series(errors, index = index, dtype = object)
+            })
@@ -0,0 +1,83 @@
+import os
+import sys
+import glob
+import json
+import timeit
+import argparse
+import importlib.util
+import pandas as pd
+
+# the module is loaded from its file, whose name (tse-ResultExtractor.py) cannot be imported
+RESULT_EXTRACTOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tse-ResultExtractor.py')
+spec = importlib.util.spec_from_file_location('ResultExtractor', RESULT_EXTRACTOR_PATH)
+ResultExtractor = importlib.util.module_from_spec(spec)
+sys.modules['ResultExtractor'] = ResultExtractor
+spec.loader.exec_module(ResultExtractor)
+
+
+# the placeholders of the quotes as they were computed before the codec of ResultExtractor: a chain of replaces, applied in this order
+CHAIN = list(ResultExtractor._QUOTE_PLACEHOLDERS.items())
+
+def chain_encode(input_string):
+    for quote, placeholder in CHAIN:
+        input_string = input_string.replace(quote, placeholder)
+    return input_string
+
+def chain_decode(input_string):
+    for quote, placeholder in CHAIN:
+        input_string = input_string.replace(placeholder, quote)
+    return input_string
+
+# quoted brackets which overlap: the encoding depends on the order in which the patterns are replaced
+OVERLAPPING = ['")"("', '"("("', "')'('", "'['[']'", '"{"}"', '"(")"]"', "'('\")\"", 'return ")"(";', 'f("]"["]"[");']
+
+def load_predictions(predictions_path):
+    prediction_files = glob.glob(os.path.join(predictions_path, '*.jsonl')) if os.path.isdir(predictions_path) else [predictions_path]
+    return [prediction for prediction_file in sorted(prediction_files)
+            for line in open(prediction_file) if line.strip()
+            for prediction in json.loads(line)['generate_results'] if prediction]
+
+def best_of(statement, repeat):
+    return min(timeit.repeat(statement, number = 1, repeat = repeat))
+
+if __name__ == '__main__':
+
+    # the benchmark fails if a prediction does not survive the round trip through the placeholders
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--predictions_path', dest = 'predictions_path', help = "A <generator>.jsonl file or a folder of them.", default = '../../data/code_generation/predictions')
+    parser.add_argument('--repeat', dest = 'repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    encode = ResultExtractor.ResultExtractor._replace_quotes_with_placeholders
+    decode = ResultExtractor.ResultExtractor._replace_placeholders_with_quotes
+    predictions = load_predictions(args.predictions_path)
+    column = pd.Series(predictions, dtype = object)
+    encoded = [encode(prediction) for prediction in predictions]
+    encoded_column = pd.Series(encoded, dtype = object)
+    # extract_predicted_method_from_output used to decode the output line by line, once for each method found
+    encoded_lines = [line for text in encoded for line in text.splitlines(keepends = True)]
+
+    failed = [i for i, prediction in enumerate(predictions) if decode(encode(prediction)) != prediction]
+    failed_column = (decode(encode(column)) != column).sum()
+    differences = sum(encode(prediction) != chain_encode(prediction) for prediction in predictions + OVERLAPPING)
+    failed += [case for case in OVERLAPPING if decode(encode(case)) != case]
+
+    print(f'{len(predictions)} predictions, {sum(map(len, predictions)) / 2**20:.1f} MB, best of {args.repeat} runs:')
+    for name, chain, codec in [
+        ('encode', lambda: [chain_encode(p) for p in predictions], lambda: [encode(p) for p in predictions]),
+        ('decode', lambda: [chain_decode(p) for p in encoded], lambda: [decode(p) for p in encoded]),
+        ('encode column', lambda: column.map(chain_encode), lambda: encode(column)),
+        ('decode column', lambda: encoded_column.map(chain_decode), lambda: decode(encoded_column)),
+        ('decode lines', lambda: [chain_decode(line) for line in encoded_lines], lambda: [decode(line) for line in encoded_lines])
+    ]:
+        chain_seconds, codec_seconds = best_of(chain, args.repeat), best_of(codec, args.repeat)
+        print(f'{name:<15} chain of replaces {1000 * chain_seconds:8.2f} ms, codec {1000 * codec_seconds:8.2f} ms ({chain_seconds / codec_seconds:.1f}x)')
+
+    if differences:
+        print(f'FAILED: {differences} strings (predictions and overlapping quoted brackets) are encoded differently from the chain of replaces.')
+    if failed or failed_column:
+        print(f'FAILED: {len(failed)} strings ({failed_column} in the column) do not survive the round trip.')
+    if differences or failed or failed_column:
+        sys.exit(1)
+    print('PASSED.')
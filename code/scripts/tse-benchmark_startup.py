@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+# libraries that importing ModelQuerier must not load: they are imported only by the backend which is queried
+HEAVY_MODULES = ['torch', 'transformers', 'requests', 'openai', 'httpx', 'huggingface_hub', 'pygments']
+
+MODEL_QUERIER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tse-ModelQuerier.py')
+
+# run in a fresh interpreter, so that every measure includes the whole import of the module and of its dependencies
+# (the module is loaded from its path, since the file name has the tse- prefix)
+MEASURE = '''
+import json, resource, sys, time, importlib.util
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('ModelQuerier', %r)
+ModelQuerier = importlib.util.module_from_spec(spec)
+sys.modules['ModelQuerier'] = ModelQuerier
+spec.loader.exec_module(ModelQuerier)
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds' : elapsed,
+    'max_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'loaded' : [module for module in %r if module in sys.modules]
+}))
+''' % (MODEL_QUERIER_PATH, HEAVY_MODULES)
+
+def measure_import(python):
+    output = subprocess.run([python, '-c', MEASURE], capture_output = True, text = True, check = True).stdout
+    return json.loads(output.splitlines()[-1])
+
+if __name__ == '__main__':
+
+    # the benchmark fails when the import of ModelQuerier loads a backend library or takes longer than max_seconds
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', action = "store", dest = 'runs', default = 10, type = int)
+    parser.add_argument('--max_seconds', action = "store", dest = 'max_seconds', default = 1., type = float)
+    parser.add_argument('--python', action = "store", dest = 'python', default = sys.executable)
+    args = parser.parse_args()
+
+    measures = [measure_import(args.python) for _ in range(args.runs)]
+    seconds = [measure['seconds'] for measure in measures]
+    max_rss_mb = max(measure['max_rss_mb'] for measure in measures)
+    loaded = sorted({module for measure in measures for module in measure['loaded']})
+
+    print(f'import ModelQuerier ({args.runs} runs): median {statistics.median(seconds):.3f}s, '
+          f'min {min(seconds):.3f}s, max {max(seconds):.3f}s, max RSS {max_rss_mb:.1f} MB')
+
+    failed = False
+    if loaded:
+        print(f'FAILED: the import loaded {", ".join(loaded)}.')
+        failed = True
+    if statistics.median(seconds) > args.max_seconds:
+        print(f'FAILED: the median import time exceeds {args.max_seconds}s.')
+        failed = True
+    if not failed:
+        print('PASSED.')
+    sys.exit(1 if failed else 0)
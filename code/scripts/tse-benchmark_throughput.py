@@ -0,0 +1,186 @@
+import os
+import sys
+import csv
+import json
+import time
+import shlex
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+
+
+# the judge scripts are run, unchanged, in a scratch copy of the repository whose constants point the judges to the mock server
+# (tse-mock_server.py): the inference endpoint of the endpoint judges is the mock server, and so is the OpenAI base url
+
+SCRIPTS = ['ModelQuerier', 'ResultExtractor', 'judge_code_summarization', 'judge_code_generation']
+SCRIPTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def server_stats(url, reset = False):
+    with urllib.request.urlopen(f'{url}/stats' + ('?reset=1' if reset else '')) as response:
+        return json.loads(response.read())
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else float('nan')
+
+def build_scratch_tree(root, args, url):
+    scripts = os.path.join(root, 'code', 'scripts')
+    os.makedirs(scripts)
+    for script in SCRIPTS:
+        shutil.copy(os.path.join(SCRIPTS_PATH, f'tse-{script}.py'), os.path.join(scripts, f'{script}.py'))
+    shutil.copytree(os.path.join(SCRIPTS_PATH, '..', 'constants'), os.path.join(root, 'code', 'constants'))
+
+    # every endpoint judge is served by the mock server, without chat template (the tokenizer would be downloaded)
+    iep_path = os.path.join(root, 'code', 'constants', 'IEPmodels.json')
+    template_path = os.path.join(root, 'code', 'constants', 'prompt_with_template.json')
+    endpoints, templates = json.load(open(iep_path)), json.load(open(template_path))
+    for model in args.models:
+        endpoints[model], templates[model] = url, False
+    json.dump(endpoints, open(iep_path, 'w'))
+    json.dump(templates, open(template_path, 'w'))
+
+    # the first items of the code summarization benchmark
+    benchmark = os.path.join(root, 'code_summarization_benchmark')
+    os.makedirs(benchmark)
+    file_name = f'CS-benchmark-{args.language.capitalize()}.csv'
+    with open(os.path.join(SCRIPTS_PATH, '..', '..', 'code_summarization_benchmark', file_name), newline = '') as fin, \
+         open(os.path.join(benchmark, file_name), 'w', newline = '') as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout)
+        writer.writerow(next(reader))
+        for _, row in zip(range(args.items), reader):
+            writer.writerow(row)
+
+    # the first instances of CoderEval, whose candidates are read from the predictions of the generators
+    if 'generation' in args.judges:
+        os.makedirs(os.path.join(root, 'code', 'data', 'input'))
+        os.makedirs(os.path.join(root, 'code', 'data', 'results', 'icse25', 'code_generation'))
+        records = json.load(open(args.codereval_input))['RECORDS']
+        # each instance has up to 9 candidates (8 generators and the human written one)
+        json.dump({'RECORDS' : records[:max(1, args.items // 9)]}, open(os.path.join(root, 'code', 'data', 'input', f'CoderEval4{args.language.capitalize()}.json'), 'w'))
+        os.symlink(os.path.abspath(args.predictions_path), os.path.join(root, 'code', 'data', 'results', 'icse25', 'code_generation', args.language))
+    return scripts
+
+def count_items(path, judge):
+    # judged items in the result table: rows for code summarization, judged candidates for code generation
+    with open(path, newline = '') as f:
+        reader = csv.DictReader(f)
+        if judge == 'summarization':
+            return sum(1 for _ in reader)
+        columns = [column for column in reader.fieldnames if column.endswith('_judgement')]
+        return sum(1 for row in reader for column in columns if row[column] not in ['', '<PLACEHOLDER>'])
+
+def run_judge(scripts, url, args, judge, model, concurrency):
+    if judge == 'summarization':
+        command = ['judge_code_summarization.py', '--judgment_type', 'zeroshot']
+        output_path = os.path.join(scripts, '..', 'data', 'code_summarization', 'results', args.language, 'zeroshot')
+    else:
+        command = ['judge_code_generation.py', '--judgment_type', 'bool']
+        output_path = os.path.join(scripts, '..', 'data', 'results', args.language, 'bool')
+    command = [sys.executable] + command + [
+        '--model', model,
+        '--language', args.language,
+        '--concurrency', str(concurrency),
+        '--batch_size', str(args.items), # a single batch, so that the checkpoints do not limit the concurrency
+        '--requests_per_second', str(args.requests_per_second),
+        '--trace_path', os.path.join(scripts, f'trace_{judge}.jsonl')
+    ] + shlex.split(args.script_args)
+    env = dict(os.environ, OPENAI_BASE_URL = f'{url}/v1')
+
+    server_stats(url, reset = True)
+    if os.path.exists(os.path.join(scripts, f'trace_{judge}.jsonl')):
+        os.remove(os.path.join(scripts, f'trace_{judge}.jsonl'))
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    subprocess.run(command, cwd = scripts, env = env, check = True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = server_stats(url)
+    # latencies of the calls as seen by the judge (retries included), from the telemetry trace
+    with open(os.path.join(scripts, f'trace_{judge}.jsonl')) as f:
+        latencies = [json.loads(line)['latency'] for line in f]
+
+    model_name = model if 'gpt-' in model else model.split('/')[-1]
+    items = count_items(os.path.join(output_path, f'{model_name}.csv'), judge)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        'judge' : judge,
+        'model' : model,
+        'concurrency' : concurrency,
+        'items' : items,
+        'seconds' : round(seconds, 3),
+        'items_per_second' : round(items / seconds, 3),
+        'p50_ms' : round(1000 * percentile(latencies, 50), 1),
+        'p99_ms' : round(1000 * percentile(latencies, 99), 1),
+        'server_p50_ms' : round(1000 * percentile(stats['latencies'], 50), 1),
+        'cpu_ms_per_item' : round(1000 * cpu_seconds / max(items, 1), 2),
+        'requests' : stats['requests'],
+        'errors' : stats['errors']
+    }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--judges', dest = 'judges', nargs = '+', choices = ['summarization', 'generation'], default = ['summarization', 'generation'])
+    parser.add_argument('--models', dest = 'models', nargs = '+', help = "Judges to benchmark (endpoint models and/or GPT models).",
+                        default = ['deepseek-ai/deepseek-coder-1.3b-instruct', 'gpt-3.5-turbo'])
+    parser.add_argument('--concurrency', dest = 'concurrency', nargs = '+', type = int, default = [1, 8, 32])
+    parser.add_argument('--items', dest = 'items', type = int, help = "Number of items judged by each run.", default = 100)
+    parser.add_argument('--language', dest = 'language', choices = ['java', 'python'], default = 'java')
+    parser.add_argument('--codereval_input', dest = 'codereval_input', help = "CoderEval4<Language>.json (required by the code generation judge).", default = None)
+    parser.add_argument('--predictions_path', dest = 'predictions_path', help = "Folder with the predictions of the generators (<generator>.jsonl).", default = None)
+    parser.add_argument('--latency_median', dest = 'latency_median', type = float, default = .2)
+    parser.add_argument('--latency_sigma', dest = 'latency_sigma', type = float, default = .5)
+    parser.add_argument('--error_rate', dest = 'error_rate', type = float, default = 0)
+    parser.add_argument('--output_tokens', dest = 'output_tokens', type = int, default = 64)
+    parser.add_argument('--requests_per_second', dest = 'requests_per_second', type = float, help = "Rate limit given to the judges.", default = 1000)
+    parser.add_argument('--script_args', dest = 'script_args', help = "Further arguments of the judge scripts (e.g., '--stream yes').", default = '')
+    parser.add_argument('--results_path', dest = 'results_path', help = "JSONL file to which the results are appended.", default = None)
+    args = parser.parse_args()
+
+    if 'generation' in args.judges and not (args.codereval_input and args.predictions_path):
+        print('Skipping the code generation judge: --codereval_input and --predictions_path are required.')
+        args.judges = [judge for judge in args.judges if judge != 'generation']
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen([
+        sys.executable, os.path.join(SCRIPTS_PATH, 'tse-mock_server.py'),
+        '--port', str(port),
+        '--latency_median', str(args.latency_median),
+        '--latency_sigma', str(args.latency_sigma),
+        '--error_rate', str(args.error_rate),
+        '--output_tokens', str(args.output_tokens)
+    ], stdout = subprocess.PIPE, text = True)
+    server.stdout.readline() # the server is listening
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            scripts = build_scratch_tree(root, args, url)
+            print(f'{"judge":<14}{"model":<44}{"conc.":>6}{"items":>7}{"items/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"cpu ms/item":>13}{"errors":>8}')
+            for judge in args.judges:
+                for model in args.models:
+                    for concurrency in args.concurrency:
+                        result = run_judge(scripts, url, args, judge, model, concurrency)
+                        results.append(result)
+                        print(f'{judge:<14}{model:<44}{concurrency:>6}{result["items"]:>7}{result["items_per_second"]:>9.2f}'
+                              f'{result["p50_ms"]:>9.1f}{result["p99_ms"]:>9.1f}{result["cpu_ms_per_item"]:>13.2f}{result["errors"]:>8}')
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.results_path:
+        with open(args.results_path, 'a') as fout:
+            for result in results:
+                fout.write(json.dumps({**result, 'latency_median' : args.latency_median, 'latency_sigma' : args.latency_sigma,
+                                       'error_rate' : args.error_rate, 'output_tokens' : args.output_tokens, 'script_args' : args.script_args}) + '\n')
@@ -1,6 +1,5 @@
 import json
 import os
-import subprocess
 import argparse
 import ModelQuerier
 import ResultExtractor
@@ -33,6 +32,7 @@ if __name__ == '__main__':
     parser.add_argument('--beam', action = "store", dest = 'beam', default = 1, type = int)
     parser.add_argument('--allocate', action = "store", dest = 'allocate', default = False, type = bool)
     parser.add_argument('--sleep_time_s', action = "store", dest = 'sleep', default = 0, type = int)
+    parser.add_argument('--extraction_workers', action = "store", dest = 'extraction_workers', default = None, type = int)
     args = parser.parse_args()
 
 
@@ -59,34 +59,38 @@ if __name__ == '__main__':
     print(f'Testing {args.model} on {LANGUAGE.upper()}.')
 
     result_dict = {}
+    failures = []
     for ibeam in range(args.beam):
+        # the methods are extracted from the outputs of the whole beam at once, so that parsing does not hold up the queries
+        model_outputs, hats = [], []
         for iinstance in range(len(instances)):
             print(f'\rBeam {ibeam + 1}/{args.beam}, Instance: {iinstance + 1}/{len(instances)}', end = '')
 
-            if querier.is_gpt:
-                model_output = querier.codegeneration_codereval_chatgpt(instances[iinstance], language = LANGUAGE)
-                predicted_method = code_extractor.extract_predicted_method_from_output(model_output, file_extention = file_extention, gpt_flag = querier.is_gpt)
+            try:
+                if querier.is_gpt:
+                    model_output = querier.codegeneration_codereval_chatgpt(instances[iinstance], language = LANGUAGE)
+                    hat = ''
             
-            elif not args.allocate:
-                model_output = querier.codegeneration_codereval(instances[iinstance], language = LANGUAGE)
-                signature = ModelQuerier.extract_signature_codereval(instances[iinstance], LANGUAGE)
-                predicted_method = code_extractor.extract_predicted_method_from_output(model_output, 
-                                                                                       file_extention, 
-                                                                                       gpt_flag = querier.is_gpt, 
-                                                                                       hat = signature,
-                                                                                       tempfile_name = instances[iinstance]['_id']
-                                                                                    )
-            elif args.allocate:
-                model_output = querier.codegeneration_codereval(instances[iinstance], language = LANGUAGE)
-                signature = ModelQuerier.extract_signature_codereval(instances[iinstance], LANGUAGE)
-                predicted_method = code_extractor.extract_predicted_method_from_output(model_output, 
-                                                                                       file_extention, 
-                                                                                       gpt_flag = querier.is_gpt, 
-                                                                                    #    hat = signature,
-                                                                                       tempfile_name = instances[iinstance]['_id']
-                                                                                    )
-
-            method_id = instances[iinstance]['_id']            
+                elif not args.allocate:
+                    model_output = querier.codegeneration_codereval(instances[iinstance], language = LANGUAGE)
+                    hat = ModelQuerier.extract_signature_codereval(instances[iinstance], LANGUAGE)
+
+                elif args.allocate:
+                    model_output = querier.codegeneration_codereval(instances[iinstance], language = LANGUAGE)
+                    hat = ''
+            except ModelQuerier.QueryFailedError as e:
+                # the failure is recorded and the instance is left without a prediction
+                model_output, hat = '', ''
+                failures.append({'_id' : instances[iinstance]['_id'], 'beam' : ibeam, **e.to_record()})
+
+            model_outputs.append(model_output)
+            hats.append(hat)
+
+        extracted = code_extractor.extract_predicted_methods(model_outputs, file_extention, gpt_flag = querier.is_gpt, hats = hats, workers = args.extraction_workers)
+        for iinstance, (predicted_method, error) in enumerate(extracted.itertuples(index = False)):
+            method_id = instances[iinstance]['_id']
+            if error:
+                failures.append({'_id' : method_id, 'beam' : ibeam, 'error_class' : 'ExtractionError', 'message' : error})
             result_dict.setdefault(iinstance, {})
             result_dict[iinstance].setdefault('_id', method_id)
             result_dict[iinstance].setdefault('generate_results', [])
@@ -102,6 +106,11 @@ if __name__ == '__main__':
             json.dump(dict_to_write, fout)
             fout.write('\n') if iinstance != len(result_dict) - 1 else fout.write('')
     fout.close()
+
+    if failures:
+        print(f'\n{len(failures)} queries failed, see {model_name}_failures.jsonl.')
+        with open(os.path.join(OUTPUT_PATH, f'{model_name}_failures.jsonl'), 'w') as fout:
+            for failure in failures:
+                fout.write(json.dumps(failure) + '\n')
     
-    print()
-    subprocess.call(f'rm ../data/temp/*', shell = True)
\ No newline at end of file
+    print()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+import glob
+import json
+import time
+import argparse
+import ModelQuerier
+import ResultExtractor
+
+
+# post-processing pass over the predictions of the generators: the method is (re-)extracted from each raw output of the
+# <generator>.jsonl files ({'_id' : ..., 'generate_results' : [...]}) with a pool of processes, and written in the same format
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--predictions_path', dest = 'predictions_path', help = "A <generator>.jsonl file or a folder of them.")
+    parser.add_argument('--output_path', dest = 'output_path', help = "Folder to which the extracted predictions are written.")
+    parser.add_argument('--language', dest = 'language', choices = ['java', 'python'], default = 'java')
+    parser.add_argument('--codereval_input', dest = 'codereval_input', help = "CoderEval4<Language>.json, whose signatures are prepended to the outputs of the generators which are not GPT models.", default = None)
+    parser.add_argument('--workers', dest = 'workers', type = int, help = "Number of processes (one per CPU by default).", default = None)
+    parser.add_argument('--chunksize', dest = 'chunksize', type = int, default = 16)
+    args = parser.parse_args()
+
+    file_extention = 'py' if args.language == 'python' else args.language
+    extractor = ResultExtractor.ResultExtractor()
+
+    signatures = {}
+    if args.codereval_input:
+        signatures = {instance['_id'] : ModelQuerier.extract_signature_codereval(instance, args.language)
+                      for instance in json.load(open(args.codereval_input))['RECORDS']}
+
+    if os.path.isdir(args.predictions_path):
+        prediction_files = sorted(path for path in glob.glob(os.path.join(args.predictions_path, '*.jsonl')) if not path.endswith('_failures.jsonl'))
+    else:
+        prediction_files = [args.predictions_path]
+
+    os.makedirs(args.output_path, exist_ok = True)
+    for prediction_file in prediction_files:
+        generator = os.path.basename(prediction_file)[:-len('.jsonl')]
+        gpt_flag = 'gpt-' in generator
+        predictions = extractor._load_json(prediction_file)
+
+        # one row per candidate, in the order of the file
+        ids = [prediction['_id'] for prediction in predictions for _ in prediction['generate_results']]
+        model_outputs = [output for prediction in predictions for output in prediction['generate_results']]
+        hats = [signatures.get(tid, '') if not gpt_flag else '' for tid in ids]
+
+        start = time.perf_counter()
+        extracted = extractor.extract_predicted_methods(model_outputs, file_extention, gpt_flag = gpt_flag, hats = hats, workers = args.workers, chunksize = args.chunksize)
+        seconds = time.perf_counter() - start
+
+        failures = [{'_id' : tid, 'error_class' : 'ExtractionError', 'message' : error} for tid, error in zip(ids, extracted['error']) if error]
+
+        methods = iter(extracted['predicted_method'])
+        with open(os.path.join(args.output_path, f'{generator}.jsonl'), 'w') as fout:
+            for prediction in predictions:
+                generate_results = [next(methods) for _ in prediction['generate_results']]
+                fout.write(json.dumps({'_id' : prediction['_id'], 'generate_results' : generate_results}) + '\n')
+
+        print(f'{generator}: {len(model_outputs)} outputs in {seconds:.2f}s, {len(failures)} failed.')
+        if failures:
+            with open(os.path.join(args.output_path, f'{generator}_extraction_failures.jsonl'), 'w') as fout:
+                for failure in failures:
+                    fout.write(json.dumps(failure) + '\n')
@@ -23,11 +23,33 @@ def same_signature(row):
     sig2 = extract_signature_py(row['target'])
     return sig1 == sig2
 
+def judge_candidate(querier, target_instance, generator, candidate, judgment_type, rationale):
+    # judges a single candidate and returns its prompt, the candidate as given to the judge, the judgment and the record of the failure (if the judge could not be queried)
+    try:
+        model_code_dict, model_output_dict, model_prompt_dict = querier.judge_code_correctness_codereval(
+                target_instance = target_instance,
+                generator = generator,
+                candidate = candidate,
+                judgment_type = judgment_type,
+                rationale = rationale,
+                model_code_dict = {},
+                model_output_dict = {},
+                model_prompt_dict = {}
+            )
+    except ModelQuerier.QueryFailedError as e:
+        return '', candidate, '', json.dumps(e.to_record())
+    return model_prompt_dict[generator][0], model_code_dict[generator][0], model_output_dict[generator][0], ''
+
 if __name__ == '__main__':
     now = datetime.now()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--model', action = "store", dest = 'model')
+    parser.add_argument(
+        '--model',
+        dest = 'model',
+        nargs = '+',
+        help = "One or more judges: each candidate is given to all of them, and their judgments are saved in the same table."
+        )
     parser.add_argument(
         '--language',
         choices = ['java', 'python'],
@@ -70,6 +92,7 @@ if __name__ == '__main__':
         '--batch_size',
         dest = 'batch_size',
         type = int,
+        help = "Number of instances saved at each checkpoint. With --allocate yes, also the number of prompts the model generates together.",
         default = 10
         )
     parser.add_argument(
@@ -78,7 +101,130 @@ if __name__ == '__main__':
         type = int,
         default = 0
         )
+    parser.add_argument(
+        '--concurrency',
+        dest = 'concurrency',
+        type = int,
+        help = "Number of candidates judged at the same time.",
+        default = 1
+        )
+    parser.add_argument(
+        '--cache_path',
+        dest = 'cache_path',
+        help = "SQLite file in which the outputs of the judge are cached (no cache if not given).",
+        default = None
+        )
+    parser.add_argument(
+        '--cache_max_size_mb',
+        dest = 'cache_max_size_mb',
+        type = float,
+        default = 1024
+        )
+    parser.add_argument(
+        '--replay',
+        choices = ['yes', 'no'],
+        dest = 'replay',
+        help = "If 'yes', the outputs are only read from the cache and the judge is never queried.",
+        default = 'no'
+        )
+    parser.add_argument(
+        '--replay_results',
+        dest = 'replay_results',
+        nargs = '+',
+        help = "Results CSVs (glob patterns) whose recorded outputs are served in place of the judge, which is never queried.",
+        default = None
+        )
+    parser.add_argument(
+        '--reuse_kv_cache',
+        choices = ['yes', 'no'],
+        dest = 'reuse_kv_cache',
+        help = "With --allocate yes, whether the second step of the step-by-step judgments reuses the key/value cache of the first one.",
+        default = 'yes'
+        )
+    parser.add_argument(
+        '--score',
+        choices = ['yes', 'no'],
+        dest = 'score',
+        help = "If 'yes', the judgments requiring only a label (bool/scale with --rationale no, second step of slowthinking) are obtained from the probabilities of the labels (not for the models queried through the Hugging Face API).",
+        default = 'no'
+        )
+    parser.add_argument(
+        '--stream',
+        choices = ['yes', 'no'],
+        dest = 'stream',
+        help = "If 'yes', the outputs are streamed and the generation stops as soon as the judgment is emitted.",
+        default = 'no'
+        )
+    parser.add_argument(
+        '--request_deadline',
+        dest = 'request_deadline',
+        type = float,
+        help = "Seconds after which a request still waiting for the judge is abandoned and retried.",
+        default = None
+        )
+    parser.add_argument(
+        '--hedge_percentile',
+        dest = 'hedge_percentile',
+        type = float,
+        help = "If given, a request slower than this percentile of the recent latencies is duplicated and the first answer is taken.",
+        default = None
+        )
+    parser.add_argument(
+        '--requests_per_second',
+        dest = 'requests_per_second',
+        type = float,
+        nargs = '+',
+        help = "Requests per second sent to each judge given with --model and --escalate_to: either one value for all of them or one value per judge (by default, only the GPT models are limited).",
+        default = None
+        )
+    parser.add_argument(
+        '--escalate_to',
+        dest = 'escalate_to',
+        nargs = '+',
+        help = "Judges (from the cheapest to the most expensive) to which the uncertain judgments of --model are escalated.",
+        default = []
+        )
+    parser.add_argument(
+        '--escalation_probability',
+        dest = 'escalation_probability',
+        type = float,
+        help = "With --score yes, ratings whose probability is lower than this value are escalated to the next judge.",
+        default = .8
+        )
+    parser.add_argument(
+        '--escalation_margin',
+        dest = 'escalation_margin',
+        type = float,
+        help = "With --judgment_type scale, ratings within this distance from 3 are escalated to the next judge (negative to disable).",
+        default = 0
+        )
+    parser.add_argument(
+        '--audit_rate',
+        dest = 'audit_rate',
+        type = float,
+        help = "Fraction of the judgments not escalated which are also given to the last judge, to estimate the agreement retained.",
+        default = 0
+        )
+    parser.add_argument(
+        '--trace_path',
+        dest = 'trace_path',
+        help = "JSONL file to which an event is appended for every call sent to the judges (latency, tokens, retries, errors).",
+        default = None
+        )
+    parser.add_argument(
+        '--metrics_port',
+        dest = 'metrics_port',
+        type = int,
+        help = "If given, the metrics of the calls are exposed in the Prometheus text format at http://127.0.0.1:<port>/metrics.",
+        default = None
+        )
     args = parser.parse_args()
+    if len(args.model) > 1 and args.escalate_to:
+        parser.error('--escalate_to can be used with a single --model only.')
+    try:
+        requests_per_second = dict(zip(args.model + args.escalate_to, ModelQuerier.rates_per_judge(args.requests_per_second, args.model + args.escalate_to)))
+    except ValueError as e:
+        parser.error(f'--requests_per_second: {e}')
 
     OUTPUT_ROOT = f'../data/results/{args.language}'
     INCOMPLETE_IMPLEMENTATIONS = pd.read_csv(f'../constants/{args.language}_incomplete.csv')
@@ -102,13 +248,59 @@ if __name__ == '__main__':
     # judge_model = "gpt-3.5-turbo"
     # judge_model = "gpt-4-turbo"
 
-    querier = ModelQuerier.ModelQuerier(
-                                        model_name = args.model, 
+    telemetry = ModelQuerier.Telemetry(trace_path = args.trace_path)
+    if args.metrics_port:
+        telemetry.serve(args.metrics_port)
+
+    def make_querier(judge_model):
+        return ModelQuerier.ModelQuerier(
+                                        model_name = judge_model, 
                                         language = args.language,
-                                        allocate = args.allocate,
+                                        allocate = args.allocate == 'yes',
                                         max_new_tokens = args.max_new_tokens, 
-                                        temperature = args.temperature
+                                        temperature = args.temperature,
+                                        max_inflight = args.concurrency,
+                                        cache_path = args.cache_path,
+                                        cache_max_size_mb = args.cache_max_size_mb,
+                                        replay = args.replay == 'yes',
+                                        requests_per_second = requests_per_second[judge_model],
+                                        batch_size = args.batch_size,
+                                        reuse_prefix_cache = args.reuse_kv_cache == 'yes',
+                                        stream = args.stream == 'yes',
+                                        request_deadline = args.request_deadline,
+                                        hedge_percentile = args.hedge_percentile,
+                                        score = args.score == 'yes',
+                                        backend = ModelQuerier.ReplayBackend(args.replay_results, judge_model) if args.replay_results else None,
+                                        telemetry = telemetry
+                                    )
+
+    def short_name(judge_model):
+        return judge_model if 'gpt-' in judge_model else judge_model.split('/')[-1]
+
+    # each judge has its own querier, hence its own rate limiter and in-flight limit; without --escalate_to, the cascade of a judge
+    # is made of the judge only and never escalates
+    cascades = {}
+    for judge_model in args.model:
+        cascades[short_name(judge_model)] = ModelQuerier.JudgeCascade(
+                                        queriers = [make_querier(model) for model in [judge_model] + args.escalate_to],
+                                        judge = judge_candidate,
+                                        parse = lambda judgment: ModelQuerier.parse_code_judgment(judgment[2], args.judgment_type),
+                                        min_probability = args.escalation_probability,
+                                        scale = args.judgment_type == 'scale',
+                                        boundary_margin = args.escalation_margin,
+                                        audit_rate = args.audit_rate
                                     )
+    queriers = [judge for cascade in cascades.values() for judge in cascade.queriers]
+    querier = queriers[0]
+    # an allocated model generates batch_size prompts together, so at least batch_size instances have to be judged at the same time
+    # (by each judge, since the judges work concurrently)
+    concurrency = max(args.concurrency, args.batch_size) if querier.allocate else args.concurrency
+    concurrency = concurrency * len(cascades)
+
+    def column_prefix(judge_name, generator):
+        # with several judges, the columns of each judge are prefixed by its name
+        return f'{judge_name}_{generator}' if len(cascades) > 1 else generator
+
     extractor = ResultExtractor.ResultExtractor()
     
     generator_models = [
@@ -125,16 +317,22 @@ if __name__ == '__main__':
     prediction_path = f'../data/results/icse25/code_generation/{args.language}'
     
     batches = list(divide_into_batches(data, batch_size = args.batch_size))
-    print(f'Testing {args.model} as judge on {args.language.upper()}.')
+    print(f'Testing {", ".join(" -> ".join([judge_model] + args.escalate_to) for judge_model in args.model)} as judge on {args.language.upper()}.')
+    # with a cascade, the judge which gave each judgment is saved as well
+    keys = ['prompt', 'prediction', 'judgement', 'error'] + (['judged_by'] if args.escalate_to else [])
 
     overall_df = pd.DataFrame()
+    items_judged = 0
     for batch in tqdm(batches[args.start_from_batch:], total = len(batches), initial = args.start_from_batch, desc = "Batch", position = 0):
         batch_ids = [i['_id'] for i in batch]
         batch_target = [i['code'] for i in batch]
         batch_df = pd.DataFrame({'id' : batch_ids, 'target' : batch_target})
 
-        # generate judgments for automatically generated methods
-        for generator in tqdm(generator_models, desc = "Generator", leave = False): # loop over generators models
+        # collect the candidates to judge: the ones automatically generated and the human written ones
+        columns = {} # (judge_)generator -> {'prompt' : [...], 'prediction' : [...], 'judgement' : [...], 'error' : [...], ('judged_by' : [...])}
+        calls = []
+        slots = [] # (generator, row) of each call
+        for generator in generator_models: # loop over generators models
             predictions = extractor.extract_predictions_for_codereval(os.path.join(prediction_path, f'{generator}.jsonl'), batch_ids)
             predictions = predictions.merge(batch_df.rename(columns = {'id' : 'target_id'}), on = 'target_id', how = 'left')
             predictions['id_generatedby'] = predictions['target_id'] + '_' + generator
@@ -143,62 +341,48 @@ if __name__ == '__main__':
             else:
                 predictions['same_sign'] = True
             
-            model_code_dict = {}
-            model_output_dict = {}
-            model_prompt_dict = {}
-
-            for instance in tqdm(predictions.itertuples(index = False), desc = "Instance", leave = False): # loop over predictions of a single generator model
+            for judge_name in cascades:
+                columns[column_prefix(judge_name, generator)] = {key : ["<PLACEHOLDER>"] * predictions.shape[0] for key in keys}
+            for irow, instance in enumerate(predictions.itertuples(index = False)): # loop over predictions of a single generator model
                 if instance.generated_code == '' or instance.same_sign == False or instance.id_generatedby in INCOMPLETE_IMPLEMENTATIONS:
-                    model_code_dict.setdefault(generator, []).append("<PLACEHOLDER>")
-                    model_output_dict.setdefault(generator, []).append("<PLACEHOLDER>")
-                    model_prompt_dict.setdefault(generator, []).append("<PLACEHOLDER>")
-                else:
-                    target_instance = [inst for inst in batch if inst['_id'] == instance.target_id][0]
-                    model_code_dict, model_output_dict, model_prompt_dict = querier.judge_code_correctness_codereval(
-                            target_instance = target_instance,
-                            generator = generator,
-                            candidate = instance.generated_code,
-                            judgment_type = args.judgment_type,
-                            rationale = args.rationale,
-                            model_code_dict = model_code_dict, 
-                            model_output_dict = model_output_dict, 
-                            model_prompt_dict = model_prompt_dict
-                        )
-            
-            to_concat = pd.DataFrame({
-                f'{generator}_prompt' : list(model_prompt_dict.values())[0],
-                f'{generator}_prediction' : list(model_code_dict.values())[0],
-                f'{generator}_judgement' : list(model_output_dict.values())[0]
-            })
-            batch_df = pd.concat([batch_df, to_concat], axis = 1)
+                    continue
+                target_instance = [inst for inst in batch if inst['_id'] == instance.target_id][0]
+                calls.append({'target_instance' : target_instance, 'generator' : generator, 'candidate' : instance.generated_code})
+                slots.append((generator, irow))
 
-        
-        # generate judgments for human written methods
-        model_code_dict = {}
-        model_output_dict = {}
-        model_prompt_dict = {}
-        for target_instance in batch:
-            model_code_dict, model_output_dict, model_prompt_dict = querier.judge_code_correctness_codereval(
-                    target_instance = target_instance,
-                    generator = 'humanwritten',
-                    candidate = target_instance['code'],
-                    judgment_type = args.judgment_type,
-                    rationale = args.rationale,
-                    model_code_dict = model_code_dict, 
-                    model_output_dict = model_output_dict, 
-                    model_prompt_dict = model_prompt_dict
-                )
-        
-        to_concat = pd.DataFrame({
-            f'humanwritten_prompt' : list(model_prompt_dict.values())[0],
-            f'humanwritten_prediction' : list(model_code_dict.values())[0],
-            f'humanwritten_judgement' : list(model_output_dict.values())[0]
-        })
-        batch_df = pd.concat([batch_df, to_concat], axis = 1)
+        for judge_name in cascades:
+            columns[column_prefix(judge_name, 'humanwritten')] = {key : [None] * len(batch) for key in keys}
+        for irow, target_instance in enumerate(batch):
+            calls.append({'target_instance' : target_instance, 'generator' : 'humanwritten', 'candidate' : target_instance['code']})
+            slots.append(('humanwritten', irow))
+
+        for call in calls:
+            call.update({'judgment_type' : args.judgment_type, 'rationale' : args.rationale})
+
+        # each candidate is given to all the judges: the calls of the different judges are interleaved, so that their requests overlap
+        judge_calls = [{'cascade' : cascades[judge_name], **call} for call in calls for judge_name in cascades]
+        judge_slots = [(column_prefix(judge_name, generator), irow) for generator, irow in slots for judge_name in cascades]
+
+        # generate the judgments, several candidates at a time if concurrency > 1
+        with tqdm(total = len(judge_calls), desc = "Candidate", leave = False) as progress:
+            judgments = querier.run_concurrently(lambda cascade, **call: cascade.judge(**call), judge_calls, concurrency = concurrency, progress = progress)
+        items_judged += len(judge_calls)
+
+        for (prefix, irow), ((prompt, prediction, judgement, error), judged_by) in zip(judge_slots, judgments):
+            columns[prefix]['prompt'][irow] = prompt
+            columns[prefix]['prediction'][irow] = prediction
+            columns[prefix]['judgement'][irow] = judgement
+            columns[prefix]['error'][irow] = error
+            if args.escalate_to:
+                columns[prefix]['judged_by'][irow] = judged_by
+
+        for prefix, prefix_columns in columns.items():
+            to_concat = pd.DataFrame({f'{prefix}_{key}' : values for key, values in prefix_columns.items()})
+            batch_df = pd.concat([batch_df, to_concat], axis = 1)
         
 
         # saving results to file
-        model_name = args.model if 'gpt-' in args.model else args.model.split('/')[-1]
+        model_name = ModelQuerier.results_file_name([short_name(judge_model) for judge_model in args.model], [short_name(judge_model) for judge_model in args.escalate_to])
         output_folder = args.judgment_type
         output_path = os.path.join(OUTPUT_ROOT, output_folder)
         os.makedirs(output_path, exist_ok = True)
@@ -208,4 +392,10 @@ if __name__ == '__main__':
         else:
             overall_df.to_csv(os.path.join(output_path, f'{model_name}_{now}.csv'), index = False)
 
-    print()
\ No newline at end of file
+    print()
+    print(f'{sum(judge.coalesced_calls for judge in queriers)} calls saved by coalescing identical requests.')
+    if args.escalate_to:
+        for cascade in cascades.values():
+            print(cascade.report())
+    print(telemetry.summary(items = items_judged))
+    telemetry.close()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import json
 import ModelQuerier
 import pandas as pd
 import argparse
@@ -12,6 +13,14 @@ def divide_into_batches(data, batch_size):
     for i in range(0, len(data), batch_size):
         yield data[i : i + batch_size]
 
+def judge_summary(querier, method, summary, judgment_type):
+    # judges a single summary and returns the prompt, the output of the judge and the record of the failure (if the judge could not be queried)
+    try:
+        prompt, model_output = querier.judge_code_summary(method = method, summary = summary, judgment_type = judgment_type)
+        return prompt, model_output, ''
+    except ModelQuerier.QueryFailedError as e:
+        return '', '', json.dumps(e.to_record())
+
 
 if __name__ == '__main__':
     now = datetime.now()
@@ -53,6 +62,7 @@ if __name__ == '__main__':
         '--batch_size',
         dest = 'batch_size',
         type = int,
+        help = "Number of instances saved at each checkpoint. With --allocate yes, also the number of prompts the model generates together.",
         default = 10
         )
     parser.add_argument(
@@ -61,17 +71,153 @@ if __name__ == '__main__':
         type = int,
         default = 0
         )
+    parser.add_argument(
+        '--concurrency',
+        dest = 'concurrency',
+        type = int,
+        help = "Number of instances judged at the same time.",
+        default = 1
+        )
+    parser.add_argument(
+        '--cache_path',
+        dest = 'cache_path',
+        help = "SQLite file in which the outputs of the judge are cached (no cache if not given).",
+        default = None
+        )
+    parser.add_argument(
+        '--cache_max_size_mb',
+        dest = 'cache_max_size_mb',
+        type = float,
+        default = 1024
+        )
+    parser.add_argument(
+        '--replay',
+        choices = ['yes', 'no'],
+        dest = 'replay',
+        help = "If 'yes', the outputs are only read from the cache and the judge is never queried.",
+        default = 'no'
+        )
+    parser.add_argument(
+        '--replay_results',
+        dest = 'replay_results',
+        nargs = '+',
+        help = "Results CSVs (glob patterns) whose recorded outputs are served in place of the judge, which is never queried.",
+        default = None
+        )
+    parser.add_argument(
+        '--reuse_kv_cache',
+        choices = ['yes', 'no'],
+        dest = 'reuse_kv_cache',
+        help = "With --allocate yes, whether the second step of the step-by-step judgments reuses the key/value cache of the first one.",
+        default = 'yes'
+        )
+    parser.add_argument(
+        '--stream',
+        choices = ['yes', 'no'],
+        dest = 'stream',
+        help = "If 'yes', the outputs are streamed and the generation stops as soon as the judgment is emitted.",
+        default = 'no'
+        )
+    parser.add_argument(
+        '--request_deadline',
+        dest = 'request_deadline',
+        type = float,
+        help = "Seconds after which a request still waiting for the judge is abandoned and retried.",
+        default = None
+        )
+    parser.add_argument(
+        '--hedge_percentile',
+        dest = 'hedge_percentile',
+        type = float,
+        help = "If given, a request slower than this percentile of the recent latencies is duplicated and the first answer is taken.",
+        default = None
+        )
+    parser.add_argument(
+        '--requests_per_second',
+        dest = 'requests_per_second',
+        type = float,
+        nargs = '+',
+        help = "Requests per second sent to the judges given with --model and --escalate_to: either one value for all of them or one value per judge (by default, only the GPT models are limited).",
+        default = None
+        )
+    parser.add_argument(
+        '--escalate_to',
+        dest = 'escalate_to',
+        nargs = '+',
+        help = "Judges (from the cheapest to the most expensive) to which the uncertain judgments of --model are escalated.",
+        default = []
+        )
+    parser.add_argument(
+        '--escalation_margin',
+        dest = 'escalation_margin',
+        type = float,
+        help = "Judgments with a rating within this distance from 3 are escalated to the next judge (negative to disable).",
+        default = 0
+        )
+    parser.add_argument(
+        '--audit_rate',
+        dest = 'audit_rate',
+        type = float,
+        help = "Fraction of the judgments not escalated which are also given to the last judge, to estimate the agreement retained.",
+        default = 0
+        )
+    parser.add_argument(
+        '--trace_path',
+        dest = 'trace_path',
+        help = "JSONL file to which an event is appended for every call sent to the judges (latency, tokens, retries, errors).",
+        default = None
+        )
+    parser.add_argument(
+        '--metrics_port',
+        dest = 'metrics_port',
+        type = int,
+        help = "If given, the metrics of the calls are exposed in the Prometheus text format at http://127.0.0.1:<port>/metrics.",
+        default = None
+        )
     args = parser.parse_args()
+    try:
+        requests_per_second = ModelQuerier.rates_per_judge(args.requests_per_second, [args.model] + args.escalate_to)
+    except ValueError as e:
+        parser.error(f'--requests_per_second: {e}')
     
-    querier = ModelQuerier.ModelQuerier(
-                                        model_name = args.model, 
+    telemetry = ModelQuerier.Telemetry(trace_path = args.trace_path)
+    if args.metrics_port:
+        telemetry.serve(args.metrics_port)
+
+    queriers = [ModelQuerier.ModelQuerier(
+                                        model_name = judge_model, 
                                         language = args.language,
-                                        allocate = args.allocate,
+                                        allocate = args.allocate == 'yes',
                                         max_new_tokens = args.max_new_tokens, 
-                                        temperature = args.temperature
+                                        temperature = args.temperature,
+                                        max_inflight = args.concurrency,
+                                        cache_path = args.cache_path,
+                                        cache_max_size_mb = args.cache_max_size_mb,
+                                        replay = args.replay == 'yes',
+                                        requests_per_second = judge_requests_per_second,
+                                        batch_size = args.batch_size,
+                                        reuse_prefix_cache = args.reuse_kv_cache == 'yes',
+                                        stream = args.stream == 'yes',
+                                        request_deadline = args.request_deadline,
+                                        hedge_percentile = args.hedge_percentile,
+                                        backend = ModelQuerier.ReplayBackend(args.replay_results, judge_model) if args.replay_results else None,
+                                        telemetry = telemetry
+                                    ) for judge_model, judge_requests_per_second in zip([args.model] + args.escalate_to, requests_per_second)]
+    querier = queriers[0]
+    # without --escalate_to, the cascade is made of --model only and never escalates
+    cascade = ModelQuerier.JudgeCascade(
+                                        queriers = queriers,
+                                        judge = judge_summary,
+                                        parse = lambda judgment: ModelQuerier.parse_summary_judgment(judgment[1]),
+                                        scale = True,
+                                        boundary_margin = args.escalation_margin,
+                                        audit_rate = args.audit_rate
                                     )
+    # an allocated model generates batch_size prompts together, so at least batch_size instances have to be judged at the same time
+    concurrency = max(args.concurrency, args.batch_size) if querier.allocate else args.concurrency
     
-    model_name = args.model if querier.is_gpt else args.model.split('/')[-1]
+    judge_names = [judge.model_name if judge.is_gpt else judge.model_name.split('/')[-1] for judge in queriers]
+    model_name = ModelQuerier.results_file_name(judge_names[:1], judge_names[1:])
     output_path = os.path.join(OUTPUT_ROOT, args.language, args.judgment_type)
     os.makedirs(output_path, exist_ok = True)
 
@@ -89,28 +235,26 @@ if __name__ == '__main__':
     data = pd.read_csv(os.path.join(INPUT_PATH, f'CS-benchmark-{args.language.capitalize()}.csv'))
 
     batches = list(divide_into_batches(data, batch_size = args.batch_size))
-    print(f'Evaluating {querier.model_name} as judge on code summarization.\n')
+    print(f'Evaluating {" -> ".join(judge.model_name for judge in queriers)} as judge on code summarization.\n')
     
     overall_df = pd.DataFrame()
+    items_judged = 0
     for batch in tqdm(batches[args.start_from_batch:], total = len(batches), initial = args.start_from_batch, desc = "Batch", position = 0):
         batch = batch[['target_id', 'target', 'generated_by', 'summary', 'summary_postprocessed']]
 
-        prompts = []
-        model_outputs = []
-        for instance in tqdm(batch.itertuples(index = False), desc = "Instance", leave = False):
-            method = instance.target
-            summary = instance.summary_postprocessed
-            
-            prompt, model_output = querier.judge_code_summary(
-                                                                method = method,
-                                                                summary = summary,
-                                                                judgment_type = args.judgment_type
-                                                            )
-            prompts.append(prompt)
-            model_outputs.append(model_output)
+        calls = [
+            {'method' : instance.target, 'summary' : instance.summary_postprocessed, 'judgment_type' : args.judgment_type}
+            for instance in batch.itertuples(index = False)
+        ]
+        with tqdm(total = len(calls), desc = "Instance", leave = False) as progress:
+            judgments = querier.run_concurrently(cascade.judge, calls, concurrency = concurrency, progress = progress)
+        items_judged += len(calls)
 
-        batch['prompt'] = prompts
-        batch['model_output'] = model_outputs
+        batch['prompt'] = [prompt for (prompt, _, _), _ in judgments]
+        batch['model_output'] = [model_output for (_, model_output, _), _ in judgments]
+        batch['error'] = [error for (_, _, error), _ in judgments]
+        if args.escalate_to:
+            batch['judged_by'] = [judged_by for _, judged_by in judgments]
 
         # saving results to file
         overall_df = pd.concat([overall_df, batch])
@@ -119,4 +263,9 @@ if __name__ == '__main__':
         else:
             overall_df.to_csv(os.path.join(output_path, f'{model_name}_{now}.csv'), index = False)
 
-    print()
\ No newline at end of file
+    print()
+    print(f'{sum(judge.coalesced_calls for judge in queriers)} calls saved by coalescing identical requests.')
+    if args.escalate_to:
+        print(cascade.report())
+    print(telemetry.summary(items = items_judged))
+    telemetry.close()
\ No newline at end of file
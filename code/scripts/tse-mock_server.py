@@ -0,0 +1,203 @@
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# local stand-in for the inference endpoints (text-generation-inference protocol) and for the OpenAI chat-completions API:
+# it answers every request with a well-formed judgment after a random delay, so that the judge scripts can be benchmarked
+# without querying (and paying for) the real services
+
+def judgment_for(prompt):
+    # a judgment which the prompt asks for, the rating is fixed for a given prompt. Returns the tokens of the judgment, the
+    # position of the label among them (None if the judgment is not a single label), the labels allowed and the end marker
+    rating = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16)
+    if 'End your evaluation with "# End of Evaluation"' in prompt:
+        return ['The code snippet covers the required functionalities.'], None, [], '\n# End of Evaluation'
+    if '"Yes" or "No"' in prompt or 'output: "Yes"' in prompt:
+        return [['Yes', 'No'][rating % 2]], 0, ['Yes', 'No'], ''
+    if '# Comment' in prompt:
+        return [f'Content adequacy: {rating % 5 + 1}\nConciseness: {rating // 5 % 5 + 1}\nFluency & Understandability: {rating // 25 % 5 + 1}'], None, [], ''
+    if 'Rate the Candidate with either 0 or 1' in prompt:
+        return ['Rating: ', str(rating % 2)], 1, ['0', '1'], ''
+    return ['Rating: ', str(rating % 5 + 1)], 1, ['1', '2', '3', '4', '5'], ''
+
+def label_probability(prompt):
+    # probability of the emitted label, between .5 and .99 (fixed for a given prompt), the rest is spread over the other labels
+    return .5 + int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16) // 1000 % 50 / 100
+
+def output_tokens_for(prompt, num_tokens):
+    # the judgment comes first, followed by a rationale made of filler tokens (the end marker of the analyses comes last).
+    # Returns the tokens and, for each token, the most likely tokens at its position as (token, log-probability) pairs:
+    # at the position of the label, the emitted label and the other labels
+    judgment, label_position, labels, end = judgment_for(prompt)
+    tokens = judgment + ['\n# Rationale:'] + [' token'] * max(0, num_tokens - len(judgment) - 1)
+    tokens = tokens + [end] if end else tokens
+    top_tokens = [[(token, -.1)] for token in tokens]
+    if label_position is not None:
+        probability = label_probability(prompt)
+        label = tokens[label_position]
+        top_tokens[label_position] = [(label, math.log(probability))] + \
+            [(other, math.log((1 - probability) / (len(labels) - 1))) for other in labels if other != label]
+    return tokens, top_tokens
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_median, latency_sigma, error_rate, output_tokens):
+        """
+            Class Description:
+                HTTP server answering POST /v1/chat/completions with the OpenAI protocol and any other POST with the protocol of the
+                inference endpoints (including server-sent events and the details of the tokens). The latency of each request is drawn
+                from a log-normal distribution; a fraction error_rate of the requests fails with 503. GET /stats returns the number
+                of requests and errors and the latency of each request (measured from the end of the request to the end of the
+                response); GET /stats?reset=1 also clears them.
+
+            Attributes:
+                latency_median (float): median of the latencies in seconds;
+                latency_sigma (float): standard deviation of the logarithm of the latencies (the larger, the longer the tail);
+                error_rate (float): fraction of the requests answered with 503;
+                output_tokens (int): number of tokens of each output;
+                stats (dict): requests, errors and latencies recorded since the last reset.
+        """
+        super().__init__(address, MockHandler)
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.output_tokens = output_tokens
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'requests' : 0, 'errors' : 0, 'latencies' : []}
+
+    def draw_latency(self):
+        return self.latency_median * math.exp(random.gauss(0, self.latency_sigma))
+
+    def record(self, latency, error):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['errors'] += error
+            if not error:
+                self.stats['latencies'].append(latency)
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.startswith('/stats'):
+            return self.send_json({'error' : 'not found'}, status = 404)
+        with self.server.stats_lock:
+            stats = dict(self.server.stats)
+        if 'reset=1' in self.path:
+            self.server.reset_stats()
+        self.send_json(stats)
+
+    def do_POST(self):
+        start = time.monotonic()
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+        latency = self.server.draw_latency()
+
+        if random.random() < self.server.error_rate:
+            time.sleep(latency)
+            self.send_json({'error' : 'Service Unavailable'}, status = 503)
+            self.server.record(time.monotonic() - start, error = True)
+            return
+
+        try:
+            if self.path.rstrip('/').endswith('/chat/completions'):
+                self.answer_openai(payload, latency)
+            else:
+                self.answer_endpoint(payload, latency)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client closed a stream as soon as the judgment was emitted
+        self.server.record(time.monotonic() - start, error = False)
+
+    def answer_endpoint(self, payload, latency):
+        parameters = payload.get('parameters', {})
+        tokens, top_tokens = output_tokens_for(payload['inputs'], min(parameters.get('max_new_tokens', self.server.output_tokens), self.server.output_tokens))
+
+        if payload.get('stream'):
+            events = [{'token' : {'id' : i, 'text' : token, 'logprob' : top[0][1], 'special' : False}, 'generated_text' : None, 'details' : None}
+                      for i, (token, top) in enumerate(zip(tokens, top_tokens))]
+            return self.send_events(events, latency)
+
+        time.sleep(latency)
+        answer = {'generated_text' : ''.join(tokens)}
+        if parameters.get('details'):
+            answer['details'] = {
+                'tokens' : [{'id' : i, 'text' : token, 'logprob' : top[0][1], 'special' : False} for i, (token, top) in enumerate(zip(tokens, top_tokens))],
+                'top_tokens' : [[{'id' : j, 'text' : alternative, 'logprob' : logprob, 'special' : False} for j, (alternative, logprob) in enumerate(top[:parameters.get('top_n_tokens') or len(top)])]
+                                for top in top_tokens]
+            }
+        self.send_json([answer])
+
+    def answer_openai(self, payload, latency):
+        prompt = payload['messages'][-1]['content']
+        tokens, top_tokens = output_tokens_for(prompt, min(payload.get('max_tokens') or self.server.output_tokens, self.server.output_tokens))
+        common = {'id' : 'chatcmpl-mock', 'created' : int(time.time()), 'model' : payload.get('model', 'mock'), 'system_fingerprint' : None}
+
+        if payload.get('stream'):
+            events = [{**common, 'object' : 'chat.completion.chunk', 'choices' : [{'index' : 0, 'delta' : {'content' : token}, 'finish_reason' : None}]}
+                      for token in tokens]
+            return self.send_events(events, latency, done = True)
+
+        time.sleep(latency)
+        logprobs = None
+        if payload.get('logprobs'):
+            logprobs = {'content' : [
+                {'token' : token, 'logprob' : top[0][1], 'bytes' : None,
+                 'top_logprobs' : [{'token' : alternative, 'logprob' : logprob, 'bytes' : None} for alternative, logprob in top[:payload.get('top_logprobs') or 1]]}
+                for token, top in zip(tokens, top_tokens)
+            ]}
+        self.send_json({
+            **common,
+            'object' : 'chat.completion',
+            'choices' : [{'index' : 0, 'message' : {'role' : 'assistant', 'content' : ''.join(tokens)}, 'finish_reason' : 'stop', 'logprobs' : logprobs}],
+            'usage' : {'prompt_tokens' : len(prompt.split()), 'completion_tokens' : len(tokens), 'total_tokens' : len(prompt.split()) + len(tokens)}
+        })
+
+    def send_json(self, body, status = 200):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, events, latency, done = False):
+        # server-sent events, spread over the latency of the request; the connection is closed at the end of the stream
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for event in events:
+            time.sleep(latency / len(events))
+            self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        if done:
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', dest = 'host', default = '127.0.0.1')
+    parser.add_argument('--port', dest = 'port', type = int, default = 8080)
+    parser.add_argument('--latency_median', dest = 'latency_median', type = float, help = "Median latency of the requests (seconds).", default = .2)
+    parser.add_argument('--latency_sigma', dest = 'latency_sigma', type = float, help = "Standard deviation of the log-latency (tail of the distribution).", default = .5)
+    parser.add_argument('--error_rate', dest = 'error_rate', type = float, help = "Fraction of the requests answered with 503.", default = 0)
+    parser.add_argument('--output_tokens', dest = 'output_tokens', type = int, help = "Number of tokens of each output.", default = 64)
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), args.latency_median, args.latency_sigma, args.error_rate, args.output_tokens)
+    print(f'Mock server listening on http://{args.host}:{server.server_port}', flush = True)
+    server.serve_forever()
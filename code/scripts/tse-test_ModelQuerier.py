@@ -0,0 +1,305 @@
+import os
+import sys
+import time
+import threading
+from types import SimpleNamespace
+import importlib.util
+import pytest
+
+# run from this folder with: python -m pytest tse-test_ModelQuerier.py
+
+SCRIPTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def load_script(name):
+    # the scripts are loaded from their files, whose names (tse-<name>.py) cannot be imported
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_PATH, f'tse-{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+ModelQuerier = load_script('ModelQuerier')
+
+
+@pytest.mark.parametrize('text, emitted', [
+    ('1', False), # the rating may still be followed by other digits
+    ('1\n', True),
+    ('# Rating: 0 ', True),
+    ('**Rating:** 1.', True),
+    ('Rating (0 or 1', False),
+    ('Rating (0 or 1): ', False),
+    ('Rating (0 or 1): 1\n', True),
+    ('On a scale of 0-4, the candidate', False),
+    ('The candidate uses 2 loops', False)
+])
+def test_rating_emitted_ignores_the_digits_of_the_scale(text, emitted):
+    assert ModelQuerier.rating_emitted(text) == emitted
+
+
+@pytest.mark.parametrize('model_output, judgment_type, rating', [
+    ('1', 'bool', '1'),
+    ('# Rating: 0\n# Rationale: the loop never ends', 'bool', '0'),
+    ('Rating (0 or 1): 1', 'bool', '1'),
+    ('Rating (1-5): 4', 'scale', '4'),
+    ('On a scale of 0-4 the candidate is fine. Rating: 3', 'scale', '3'),
+    ('On a scale of 0-4 the candidate is fine.', 'scale', None),
+    ('The answer is yes, it is correct', 'slowthinking', 'Yes')
+])
+def test_parse_code_judgment(model_output, judgment_type, rating):
+    assert ModelQuerier.parse_code_judgment(model_output, judgment_type)[0] == rating
+
+
+def test_streamed_judgment_is_cut_after_the_rating():
+    # the output is cut at the first prefix on which the predicate is true: the rating parsed from the cut output is the full one
+    model_output = 'Rating (0 or 1): 1\n# Rationale: on a scale of 0-1 the candidate is correct.'
+    cut = next(model_output[:end] for end in range(1, len(model_output) + 1) if ModelQuerier.rating_emitted(model_output[:end]))
+    assert cut == 'Rating (0 or 1): 1\n'
+    assert ModelQuerier.parse_code_judgment(cut, 'bool')[0] == '1'
+
+
+@pytest.mark.parametrize('requests_per_second, rates', [
+    (None, [None, None, None]),
+    ([4.], [4., 4., 4.]),
+    ([4., 2., 1.], [4., 2., 1.])
+])
+def test_rates_per_judge(requests_per_second, rates):
+    assert ModelQuerier.rates_per_judge(requests_per_second, ['judge', 'escalated', 'last']) == rates
+
+
+def test_rates_per_judge_rejects_a_partial_list():
+    with pytest.raises(ValueError):
+        ModelQuerier.rates_per_judge([4., 2.], ['judge', 'escalated', 'last'])
+
+
+def test_identical_pending_queries_are_sent_once_and_forgotten_when_they_end():
+    querier = SimpleNamespace(coalesce = True, coalesced_calls = 0)
+    started, release, sent = threading.Event(), threading.Event(), []
+    def query():
+        sent.append(1)
+        started.set()
+        release.wait()
+        return 'output'
+    results = []
+    first = threading.Thread(target = lambda: results.append(ModelQuerier.ModelQuerier.coalesced(querier, 'key', query)))
+    first.start()
+    started.wait()
+    second = threading.Thread(target = lambda: results.append(ModelQuerier.ModelQuerier.coalesced(querier, 'key', query)))
+    second.start()
+    while querier.coalesced_calls == 0:
+        time.sleep(.001)
+    release.set()
+    first.join()
+    second.join()
+    assert results == ['output', 'output'] and len(sent) == 1
+    assert 'key' not in ModelQuerier._COALESCED_QUERIES
+
+
+class HTTPError(Exception):
+    # error of a request answered with the given status code, as raised by requests (raise_for_status)
+    def __init__(self, status_code, headers = None):
+        super().__init__(f'{status_code} error')
+        self.response = SimpleNamespace(status_code = status_code, headers = headers or {})
+
+
+def bare_querier(**attributes):
+    # querier with only the state used by call_with_retries and _send: no constants, backend or connection needed
+    querier = ModelQuerier.ModelQuerier.__new__(ModelQuerier.ModelQuerier)
+    querier.model_name = 'judge'
+    querier.endpoint_url = 'https://endpoint'
+    querier.call_state = threading.local()
+    querier.rate_limiter = ModelQuerier.TokenBucket(None)
+    querier.latencies = ModelQuerier.LatencyTracker()
+    querier.hedging_executor = None
+    querier.max_retries = 3
+    querier.backoff_base = 0
+    querier.backoff_cap = 0
+    querier.__dict__.update(attributes)
+    return querier
+
+
+def test_retries_are_routed_to_another_replica():
+    querier = bare_querier(replicas = ModelQuerier.ReplicaPool(['https://replica-1', 'https://replica-2']))
+    routed_to = []
+    def request():
+        with querier.route_to_replica() as url:
+            routed_to.append(url)
+            if len(routed_to) == 1:
+                raise HTTPError(503)
+            return url
+    assert querier.call_with_retries(request) == routed_to[1] != routed_to[0]
+
+
+DATA_PATH = os.path.join(SCRIPTS_PATH, '..', '..', 'data')
+
+def read_results(path, rows):
+    import pandas as pd
+    return pd.read_csv(path, dtype = str, keep_default_na = False).head(rows).to_dict('records')
+
+
+@pytest.mark.parametrize('language, folder, judgment_type, model_name', [
+    ('java', 'zeroshot', 'zeroshot', 'codellama/CodeLlama-7b-Instruct-hf'),
+    ('java', 'automatedCoT', 'stepbystep', 'codellama/CodeLlama-34b-Instruct-hf'),
+    ('python', 'zeroshot_instructions', 'extended_instructions', 'gpt-4-turbo')
+])
+def test_replay_of_the_recorded_code_summarization_results(monkeypatch, language, folder, judgment_type, model_name):
+    # the prompts of these results have an earlier wording: the judgments are matched by method, summary and step
+    monkeypatch.chdir(SCRIPTS_PATH)
+    results = os.path.join(DATA_PATH, 'code_summarization', 'results', language, folder)
+    querier = ModelQuerier.ModelQuerier(
+        model_name = model_name,
+        language = language,
+        backend = ModelQuerier.ReplayBackend([os.path.join(results, '*.csv')], model_name)
+    )
+    for row in read_results(os.path.join(results, f'{model_name.split("/")[-1]}_CCF_clean.csv'), 50):
+        _, model_output = querier.judge_code_summary(method = row['target'], summary = row['summary_postprocessed'], judgment_type = judgment_type)
+        assert model_output == row['model_output']
+
+
+@pytest.mark.parametrize('score', [False, True])
+def test_replay_of_the_recorded_code_generation_ratings(monkeypatch, score):
+    # these results have no prompt: the rating of the judge is served by target_id and generator
+    monkeypatch.chdir(SCRIPTS_PATH)
+    model_name = 'deepseek-ai/deepseek-coder-33b-instruct'
+    querier = ModelQuerier.ModelQuerier(
+        model_name = model_name,
+        language = 'java',
+        score = score,
+        backend = ModelQuerier.ReplayBackend([os.path.join(DATA_PATH, 'code_generation', 'results', '*.csv')], model_name)
+    )
+    for row in read_results(os.path.join(DATA_PATH, 'code_generation', 'results', 'cg_judgement_java_zeroshot_norationale.csv'), 200):
+        generator = 'humanwritten' if row['generated_by'] == 'human_written' else row['generated_by']
+        target_instance = {'_id' : row['target_id'], 'human_label' : '', 'code' : row['generated_code']}
+        _, model_output_dict, _ = querier.judge_code_correctness_codereval(target_instance, generator, row['generated_code'], 'bool', 'no', {}, {}, {})
+        rating, _ = ModelQuerier.parse_code_judgment(model_output_dict[generator][0], 'bool')
+        assert rating == (row['deepseek-coder-33b-instruct_rating'] if row['deepseek-coder-33b-instruct_rating'] != '-' else None)
+
+
+def test_replay_misses_are_query_failures(monkeypatch):
+    monkeypatch.chdir(SCRIPTS_PATH)
+    model_name = 'gpt-4-turbo'
+    querier = ModelQuerier.ModelQuerier(model_name = model_name, language = 'java', backend = ModelQuerier.ReplayBackend([], model_name))
+    with pytest.raises(ModelQuerier.QueryFailedError) as failure:
+        querier.judge_code_summary(method = 'int f() { return 0; }', summary = '/** Returns 0. */', judgment_type = 'zeroshot')
+    assert failure.value.error_class == ModelQuerier.CacheMissError.__name__
+
+
+def test_response_cache_stores_and_evicts_the_least_recently_used_outputs(tmp_path):
+    cache = ModelQuerier.ResponseCache(str(tmp_path / 'cache.sqlite'), max_size_mb = 2500 / 1024 / 1024)
+    keys = [ModelQuerier.ResponseCache.make_key(model = 'judge', prompt = f'prompt {i}') for i in range(3)]
+    assert ModelQuerier.ResponseCache.make_key(prompt = 'prompt 0', model = 'judge') == keys[0]
+    assert cache.get(keys[0]) is None
+
+    cache.put(keys[0], 'judge', 'a' * 1000)
+    cache.put(keys[1], 'judge', 'b' * 1000)
+    time.sleep(.01)
+    assert cache.get(keys[0]) == 'a' * 1000 # the second output is now the least recently used one
+    cache.put(keys[2], 'judge', 'c' * 1000)
+    assert cache.size <= cache.max_size
+    assert cache.get(keys[1]) is None and cache.get(keys[2]) == 'c' * 1000
+    cache.close()
+
+    # the outputs persist, and a replayed cache is never written
+    replayed = ModelQuerier.ResponseCache(str(tmp_path / 'cache.sqlite'), replay = True)
+    replayed.put(keys[1], 'judge', 'b')
+    assert replayed.get(keys[1]) is None and replayed.get(keys[2]) == 'c' * 1000
+    replayed.close()
+
+
+def test_token_bucket_without_a_rate_only_waits_for_the_retry_after_delay():
+    bucket = ModelQuerier.TokenBucket(None)
+    start = time.monotonic()
+    for _ in range(1000):
+        bucket.acquire()
+    assert time.monotonic() - start < .5
+
+    bucket.penalize(retry_after = .2)
+    assert bucket.rate is None and not bucket.try_acquire()
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= .15
+
+
+def test_token_bucket_limits_the_rate_and_halves_it_on_429():
+    bucket = ModelQuerier.TokenBucket(20., capacity = 1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= .2 # a burst of one, then one request every 50 ms
+
+    bucket.penalize()
+    assert bucket.rate == 10.
+    bucket.reward()
+    assert bucket.rate == 11.
+
+
+def test_rate_limited_requests_are_retried_after_the_retry_after_delay():
+    penalized = []
+    querier = bare_querier()
+    querier.rate_limiter.penalize = lambda retry_after = None: penalized.append(retry_after)
+    answers = iter([HTTPError(429, {'Retry-After' : '0.05'}), 'output'])
+    def request():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+    start = time.monotonic()
+    assert querier.call_with_retries(request) == 'output'
+    assert penalized == [.05] and time.monotonic() - start >= .05
+    assert querier.call_state.attempts == 2
+
+
+def test_non_retryable_errors_fail_at_once():
+    querier = bare_querier(backend = SimpleNamespace(key = 'endpoint:https://endpoint'))
+    sent = []
+    def request():
+        sent.append(1)
+        raise HTTPError(400)
+    with pytest.raises(ModelQuerier.QueryFailedError) as failure:
+        querier.call_with_retries(request)
+    assert len(sent) == 1
+    assert failure.value.to_record() == {
+        'model' : 'judge', 'backend' : 'endpoint:https://endpoint', 'error_class' : 'HTTPError', 'message' : '400 error', 'status_code' : 400, 'attempts' : 1
+    }
+
+
+def test_retryable_errors_fail_after_max_retries():
+    querier = bare_querier(backend = SimpleNamespace(key = 'endpoint:https://endpoint'))
+    def request():
+        raise HTTPError(503)
+    with pytest.raises(ModelQuerier.QueryFailedError) as failure:
+        querier.call_with_retries(request)
+    assert failure.value.attempts == querier.max_retries + 1 and failure.value.status_code == 503
+
+
+class CountingBackend(ModelQuerier.Backend):
+    # backend answering every query with its number, to count the queries which reach it
+    key = 'counting'
+
+    def __init__(self):
+        self.queries = []
+
+    def generate(self, prompt, max_new_tokens = None, stop = None, prefix_cache = None, item = None):
+        self.queries.append(prompt)
+        return f'output {len(self.queries)}'
+
+    def score_labels(self, prompt, labels, item = None):
+        self.queries.append(prompt)
+        return {label : 1. / len(labels) for label in labels}
+
+
+def test_cached_queries_do_not_reach_the_backend(monkeypatch, tmp_path):
+    monkeypatch.chdir(SCRIPTS_PATH)
+    cache_path = str(tmp_path / 'cache.sqlite')
+    backend = CountingBackend()
+    querier = ModelQuerier.ModelQuerier(model_name = 'gpt-4-turbo', language = 'java', cache_path = cache_path, backend = backend)
+    assert querier.query_model('prompt') == querier.query_model('prompt') == 'output 1'
+    assert querier.query_model('prompt', max_new_tokens = 8) == 'output 2' # other generation parameters, other output
+    assert backend.queries == ['prompt', 'prompt']
+
+    # another run, in replay mode: the cached outputs are served and the others are failures
+    replayed = ModelQuerier.ModelQuerier(model_name = 'gpt-4-turbo', language = 'java', cache_path = cache_path, replay = True, backend = CountingBackend())
+    assert replayed.query_model('prompt') == 'output 1'
+    with pytest.raises(ModelQuerier.QueryFailedError) as failure:
+        replayed.query_model('another prompt')
+    assert failure.value.error_class == ModelQuerier.CacheMissError.__name__
+    assert replayed.backend.queries == []
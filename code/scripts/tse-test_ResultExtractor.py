@@ -0,0 +1,295 @@
+import os
+import re
+import csv
+import sys
+import json
+import random
+import importlib.util
+import lizard
+import numpy as np
+import pandas as pd
+import pytest
+
+# run from this folder with: python -m pytest tse-test_ResultExtractor.py
+
+SCRIPTS_PATH = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.join(SCRIPTS_PATH, '..', '..', 'data')
+BENCHMARK_PATH = os.path.join(SCRIPTS_PATH, '..', '..', 'code_summarization_benchmark')
+
+def load_script(name):
+    # the scripts are loaded from their files, whose names (tse-<name>.py) cannot be imported
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_PATH, f'tse-{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+ResultExtractor = load_script('ResultExtractor')
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    # the extractor reads the constants relative to this folder
+    monkeypatch.chdir(SCRIPTS_PATH)
+    return ResultExtractor.ResultExtractor()
+
+
+# reference implementations: the ones replaced by the in-memory and streaming versions, which must give the same results
+# (the temporary files are written to a folder of the test instead of data/temp)
+
+QUOTE_CHAIN = [
+    ("\"(\"", "<DOUBLE_QUOTE_OPENING_ROUND>"), ("\")\"", "<DOUBLE_QUOTE_CLOSING_ROUND>"),
+    ("\"[\"", "<DOUBLE_QUOTE_OPENING_SQUARE>"), ("\"]\"", "<DOUBLE_QUOTE_CLOSING_SQUARE>"),
+    ("\"{\"", "<DOUBLE_QUOTE_OPENING_CURLY>"), ("\"}\"", "<DOUBLE_QUOTE_CLOSING_CURLY>"),
+    ("'('", "<SINGLE_QUOTE_OPENING_ROUND>"), ("')'", "<SINGLE_QUOTE_CLOSING_ROUND>"),
+    ("'['", "<SINGLE_QUOTE_OPENING_SQUARE>"), ("']'", "<SINGLE_QUOTE_CLOSING_SQUARE>"),
+    ("'{'", "<SINGLE_QUOTE_OPENING_CURLY>"), ("'}'", "<SINGLE_QUOTE_CLOSING_CURLY>"),
+    ("'", "<SINGLE_QUOTE>"), ("\"", "<DOUBLE_QUOTE>")
+]
+
+def reference_quotes_to_placeholders(input_string):
+    for quote, placeholder in QUOTE_CHAIN:
+        input_string = input_string.replace(quote, placeholder)
+    return input_string
+
+def reference_placeholders_to_quotes(input_string):
+    for quote, placeholder in QUOTE_CHAIN:
+        input_string = input_string.replace(placeholder, quote)
+    return input_string
+
+def reference_extract_predicted_method(model_output, file_extention, gpt_flag, hat, temp_path, method_index = 0):
+    methods_found = []
+    if 'FAILED.' in model_output or len(model_output) == 0:
+        return ''
+
+    model_output = reference_quotes_to_placeholders(model_output)
+    prediction_file = os.path.join(temp_path, f'prediction.{file_extention}')
+    with open(prediction_file, 'w') as w:
+        w.write(hat)
+        w.write('\n') if model_output[0] != '\n' else w.write('')
+        w.write('    ') if file_extention == 'py' and not gpt_flag else w.write('')
+        was_hat = True if len(hat) > 0 and hat[0] == '@' else False
+        for line in model_output.split('\n'):
+            w.write('{}\n'.format(line.strip(' '))) if was_hat else w.write(f'{line}\n')
+            was_hat = True if len(line) > 0 and line [0] == '@' else False
+
+    listMethods = [[f.long_name, f.start_line, f.end_line] for f in lizard.analyze_file(prediction_file).function_list]
+    with open(prediction_file, 'r') as r:
+        for method in listMethods:
+            methodStartLine, methodEndLine = int(method[1]) - 1, int(method[2]) - 1
+            method_to_append = ''
+            r.seek(0)
+            for i, line in enumerate(r):
+                line = reference_placeholders_to_quotes(line)
+                if i == methodStartLine - 1 and len(line.strip('\n\t \"\'')) > 0 and line.strip('\n\t \"\'')[0] == '@':
+                    annotation = line.strip('\n')
+                    method_to_append += f'{annotation}\n' if file_extention == 'py' else f'{annotation} '
+                if i >= methodStartLine and i <= methodEndLine:
+                    method_to_append += f'{line}'
+            methods_found.append(method_to_append.strip('\n\t \"\''))
+    methods_found = np.array(methods_found)
+
+    try:
+        if int(listMethods[method_index + 1][1] - 1) < int(listMethods[method_index][1] - 1) and int(listMethods[method_index + 1][2] - 1) > int(listMethods[method_index][2] - 1):
+            return methods_found[method_index + 1]
+        return methods_found[method_index]
+    except IndexError:
+        try:
+            return methods_found[method_index]
+        except IndexError:
+            return ''
+
+def reference_extract_method_from_multiple_test_output(row):
+    start_pattern = row['signature']
+    end_pattern = "public static void main(String[] args) {"
+    regex = re.compile(f"({re.escape(start_pattern)}.*)(?={re.escape(end_pattern)}(?!.*{re.escape(end_pattern)}))", re.DOTALL)
+    match = regex.search(row['program'])
+    return match.group(1).strip() if match else ''
+
+def reference_extract_ispass(file_path):
+    df = pd.DataFrame([json.loads(line) for line in open(file_path)])
+    method_id = [df._id.iloc[i] for i in range(df.shape[0]) for _ in range(len(df.generate_results.iloc[i]))]
+    is_pass = [df.generate_results.iloc[i][j]['is_pass'] for i in range(df.shape[0]) for j in range(len(df.generate_results.iloc[i]))]
+    generated_code = [df.generate_results.iloc[i][j]['generate_code'] for i in range(df.shape[0]) for j in range(len(df.generate_results.iloc[i]))]
+    return pd.DataFrame({'target_id': method_id, 'generated_code': generated_code, 'is_pass': is_pass})
+
+def reference_extract_predictions(file_path, batch_ids = None):
+    results = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            json_obj = json.loads(line)
+            tid = json_obj['_id']
+            if batch_ids and tid not in batch_ids:
+                continue
+            results.setdefault('target_id', []).append(tid)
+            results.setdefault('generated_code', [])
+            results['generated_code'].append(json_obj['generate_results'][0]) \
+                if len(json_obj['generate_results']) > 0 else results['generated_code'].append('')
+    return pd.DataFrame(results)
+
+def reference_remove_assert(method_implementation, temp_path):
+    temp_file = os.path.join(temp_path, 'wo_first_last.java')
+    with open(temp_file, 'w') as w:
+        original_lines = method_implementation.splitlines()
+        for line in original_lines[1:-1]:
+            w.write(f'{reference_quotes_to_placeholders(line)}\n')
+
+    method_list = [[f.long_name, f.start_line, f.end_line] for f in lizard.analyze_file(temp_file).function_list]
+    found_assert = False
+    for method in method_list:
+        start_line, end_line = int(method[1]) - 1, int(method[2]) - 1
+        with open(temp_file, 'r') as r:
+            for line_number, line in enumerate(r):
+                if line_number == start_line:
+                    if reference_placeholders_to_quotes(line).strip().startswith('public static void main'):
+                        found_assert = True
+                        break
+    if not found_assert:
+        return method_implementation
+
+    lines_toretrieve = []
+    for iline, line in enumerate(original_lines):
+        if not iline in np.arange(start_line + 1, end_line + 2):
+            lines_toretrieve.append(line)
+    return '\n'.join(lines_toretrieve)
+
+
+def predicted_outputs():
+    # the recorded predictions, cut after the signature (as the models continue them) and wrapped in chat answers,
+    # and the methods of the code summarization benchmark
+    cases = []
+    with open(os.path.join(DATA_PATH, 'code_generation', 'predictions', 'CodeLlama-7b-Instruct-hf.jsonl')) as f:
+        for line in f:
+            for code in json.loads(line)['generate_results']:
+                signature, _, body = code.partition('\n')
+                cases += [
+                    (code, 'java', False, ''),
+                    (body, 'java', False, signature),
+                    (body, 'java', True, signature),
+                    ('Sure, here it is:\n```java\n@Override\n' + code + '\n```\nclass A { void g(){ int x = "(".length(); } }', 'java', False, '')
+                ]
+    csv.field_size_limit(sys.maxsize)
+    for language, file_extention in [('Python', 'py'), ('Java', 'java')]:
+        with open(os.path.join(BENCHMARK_PATH, f'CS-benchmark-{language}.csv'), newline = '') as f:
+            for row in list(csv.DictReader(f))[:100:2]:
+                signature, _, body = row['target'].partition('\n')
+                cases += [(row['target'], file_extention, False, ''), (body, file_extention, False, signature), ('@decorator\n' + row['target'], file_extention, False, '')]
+    return cases + [('FAILED.', 'java', False, ''), ('', 'java', False, ''), ('{ return 1; }', 'java', False, '@Override\n public int f()')]
+
+
+def random_code(rng, length):
+    return ''.join(rng.choice(['"', "'", '(', ')', '[', ']', '{', '}', 'a', ' ', '\n', '<', '>', '_']) for _ in range(length))
+
+
+def test_quote_codec_matches_the_chain_of_replaces():
+    rng = random.Random(0)
+    for _ in range(20000):
+        text = random_code(rng, rng.randint(0, 24))
+        encoded = ResultExtractor.ResultExtractor._replace_quotes_with_placeholders(text)
+        assert encoded == reference_quotes_to_placeholders(text)
+        assert ResultExtractor.ResultExtractor._replace_placeholders_with_quotes(encoded) == reference_placeholders_to_quotes(encoded) == text
+
+
+def test_quote_codec_over_a_column():
+    rng = random.Random(1)
+    column = pd.Series([random_code(rng, 40) for _ in range(200)] + [None])
+    encoded = ResultExtractor.ResultExtractor._replace_quotes_with_placeholders(column)
+    assert encoded[:200].tolist() == [reference_quotes_to_placeholders(text) for text in column[:200]]
+    assert pd.isna(encoded.iloc[200])
+    assert ResultExtractor.ResultExtractor._replace_placeholders_with_quotes(encoded)[:200].tolist() == column[:200].tolist()
+
+
+def test_in_memory_extraction_matches_the_temporary_files(extractor, tmp_path):
+    for model_output, file_extention, gpt_flag, hat in predicted_outputs():
+        expected = reference_extract_predicted_method(model_output, file_extention, gpt_flag, hat, tmp_path)
+        assert extractor.extract_predicted_method_from_output(model_output, file_extention, gpt_flag = gpt_flag, hat = hat) == expected
+
+
+def test_batch_extraction_keeps_the_order_and_records_the_errors(extractor):
+    cases = [case for case in predicted_outputs() if case[1] == 'java' and not case[2]][:40]
+    model_outputs = pd.DataFrame({'model_output' : [case[0] for case in cases] + [None], 'hat' : [case[3] for case in cases] + ['']}, index = range(100, 141))
+    extracted = extractor.extract_predicted_methods(model_outputs, 'java', workers = 2, chunksize = 4)
+    assert extracted.index.tolist() == model_outputs.index.tolist()
+    assert extracted['predicted_method'].tolist() == [
+        extractor.extract_predicted_method_from_output(model_output, 'java', hat = hat) for model_output, hat in zip(model_outputs['model_output'].fillna(''), model_outputs['hat'])
+    ]
+    assert extracted['error'].isna().all()
+
+
+def test_indexed_predictions_match_the_full_read(extractor):
+    file_path = os.path.join(DATA_PATH, 'code_generation', 'predictions', 'CodeLlama-7b-Instruct-hf.jsonl')
+    ids = reference_extract_predictions(file_path)['target_id'].tolist()
+    for batch_ids in [ids[:10], ids[::7][::-1], ids[-3:] + ['not an id'], None]:
+        pd.testing.assert_frame_equal(extractor.extract_predictions_for_codereval(file_path, batch_ids), reference_extract_predictions(file_path, batch_ids))
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 3, 7, 100000])
+def test_streamed_test_outputs_match_the_full_read(extractor, tmp_path, chunk_rows):
+    rng = random.Random(chunk_rows)
+    file_path = tmp_path / 'test_output.jsonl'
+    with open(file_path, 'w') as f:
+        for target in range(30):
+            candidates = [{'generate_code' : random_code(rng, 10), 'is_pass' : rng.random() < .5} for _ in range(rng.randint(0, 9))]
+            f.write(json.dumps({'_id' : f'target{target}', 'generate_results' : candidates}) + '\n')
+
+    chunks = list(extractor.iter_ispass_from_codereval_test_output(file_path, chunk_rows = chunk_rows))
+    assert all(len(chunk) == chunk_rows for chunk in chunks[:-1]) and len(chunks[-1]) <= chunk_rows
+    expected = reference_extract_ispass(file_path)
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index = True), expected)
+    pd.testing.assert_frame_equal(extractor.extract_ispass_from_codereval_test_output(file_path), expected)
+
+
+MAIN = 'public static void main(String[] args) {'
+
+def multiple_programs():
+    # programs of the MultiPL-E tests: the candidate, followed by the main function with the asserts (which may also
+    # appear in the candidate)
+    candidate = 'public static int add(int x, int y) {\n        return x + y;\n    }'
+    return [
+        f'import java.util.*;\nclass Problem {{\n    {candidate}\n    {MAIN}\n        assert(add(1, 2) == 3);\n    }}\n}}\n',
+        f'class Problem {{\n    {candidate}\n    // {MAIN}\n    {MAIN}\n        assert(add(1, 2) == 3);\n    }}\n}}\n',
+        f'class Problem {{\n    {candidate}\n    {MAIN} }}\n    {MAIN}\n        assert(true);\n    }}\n}}\n',
+        f'class Problem {{\n    {candidate}\n}}\n',
+        f'class Problem {{\n    {MAIN}\n    }}\n}}\n'
+    ]
+
+
+def test_multiple_method_scanner_matches_the_regex(extractor):
+    for program in multiple_programs():
+        for signature in ['public static int add(int x, int y) {', 'public static int sub(int x, int y) {']:
+            row = {'program' : program, 'signature' : signature}
+            assert extractor.extract_method_from_multiple_test_output(row) == reference_extract_method_from_multiple_test_output(row)
+
+
+def test_bulk_multiple_ingestion_matches_the_files_one_by_one(extractor, tmp_path):
+    file_paths = []
+    for generator in ['humaneval-java-codellama_CodeLlama_7b_Instruct_hf-0.2-reworded', 'mbpp-java-gpt-4-turbo-0.2-reworded']:
+        os.makedirs(tmp_path / generator)
+        for problem in range(3):
+            file_path = tmp_path / generator / f'problem{problem}.results.json'
+            results = [{'program' : program, 'exit_code' : index % 2, 'status' : 'OK'} for index, program in enumerate(multiple_programs())]
+            prompt = '// Adds two numbers.\n// >>> add(1, 2)\npublic static int add(int x, int y) {\n'
+            file_path.write_text(json.dumps({'name' : f'problem{problem}', 'prompt' : prompt, 'results' : results}))
+            file_paths.append(str(file_path))
+
+    expected = []
+    for file_path in file_paths:
+        test_output_df = extractor.extract_results_from_multiple_test_output(file_path)
+        assert test_output_df['method'].tolist() == [
+            reference_extract_method_from_multiple_test_output({'program' : program, 'signature' : signature})
+            for program, signature in zip(multiple_programs(), test_output_df['signature'])
+        ]
+        expected.append(test_output_df)
+    pd.testing.assert_frame_equal(extractor.extract_results_from_multiple_test_outputs(str(tmp_path), workers = 2), pd.concat(expected, ignore_index = True))
+
+
+def test_in_memory_assert_removal_matches_the_temporary_file(extractor, tmp_path):
+    methods = [
+        'public static int add(int x, int y) {\n    return x + y;\n}',
+        f'class Problem {{\n    public static int add(int x, int y) {{\n        return x + y;\n    }}\n    {MAIN}\n        assert(add(1, 2) == 3);\n        assert(")".equals(")"));\n    }}\n}}',
+        f'class Problem {{\n    public static char open() {{\n        return \'(\';\n    }}\n    {MAIN}\n        assert(open() == \'(\');\n    }}\n    static void after() {{ }}\n}}'
+    ] + [program.rstrip('\n') for program in multiple_programs()]
+    for method in methods:
+        assert extractor.remove_assert_from_java_method(method) == reference_remove_assert(method, tmp_path)
+    removed = extractor.remove_assert_from_java_methods(pd.Series(methods), workers = 1)
+    assert removed.iloc[:, 0].tolist() == [reference_remove_assert(method, tmp_path) for method in methods]